@@ -1,11 +1,8 @@
-from django.contrib.postgres.aggregates import ArrayAgg
-from django.db.models import Q, Value
+from django.db.models import F
 from django.http import JsonResponse
 from django.views.generic.detail import BaseDetailView
 from django.views.generic.list import BaseListView
-from movies.models import Filmwork, PersonFilmwork
-
-PersonRoles = PersonFilmwork.PersonRoles
+from movies.models import Filmwork
 
 
 class MoviesApiMixin:
@@ -13,34 +10,20 @@ class MoviesApiMixin:
     http_method_names = ["get"]
 
     def get_queryset(self):
-        qs = (
-            self.model.objects.prefetch_related("genres", "persons")
-            .values("id", "title", "description", "creation_date", "rating", "type")
-            .annotate(genres=ArrayAgg("genres__name", distinct=True, default=Value([])))
-            .annotate(
-                actors=ArrayAgg(
-                    "persons__full_name",
-                    filter=Q(personfilmwork__role=PersonRoles.ACTOR),
-                    distinct=True,
-                    default=Value([]),
-                ),
-            )
-            .annotate(
-                directors=ArrayAgg(
-                    "persons__full_name",
-                    filter=Q(personfilmwork__role=PersonRoles.DIRECTOR),
-                    distinct=True,
-                    default=Value([]),
-                ),
-            )
-            .annotate(
-                writers=ArrayAgg(
-                    "persons__full_name",
-                    filter=Q(personfilmwork__role=PersonRoles.WRITER),
-                    distinct=True,
-                    default=Value([]),
-                ),
-            )
+        # genres and persons are read from precomputed search document instead
+        # of aggregating joins of film_work
+        qs = self.model.objects.values(
+            "id",
+            "title",
+            "description",
+            "creation_date",
+            "rating",
+            "type",
+        ).annotate(
+            genres=F("document__document__genre"),
+            actors=F("document__document__actors_names"),
+            directors=F("document__document__director"),
+            writers=F("document__document__writers_names"),
         )
 
         return qs
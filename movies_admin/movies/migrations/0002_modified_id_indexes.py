@@ -0,0 +1,30 @@
+from django.db import migrations
+
+TABLES = ("film_work", "person", "genre")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("movies", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                f"CREATE INDEX IF NOT EXISTS {table}_modified_id "
+                f"ON content.{table} (modified, id);"
+                for table in TABLES
+            ]
+            + [f"DROP INDEX IF EXISTS content.{table}_modified;" for table in TABLES],
+            reverse_sql=[
+                f"CREATE INDEX IF NOT EXISTS {table}_modified "
+                f"ON content.{table} (modified);"
+                for table in TABLES
+            ]
+            + [
+                f"DROP INDEX IF EXISTS content.{table}_modified_id;"
+                for table in TABLES
+            ],
+        ),
+    ]
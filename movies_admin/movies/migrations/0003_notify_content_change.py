@@ -0,0 +1,60 @@
+from django.db import migrations
+
+# Notifies ETL about changes of content on channel content_changes. Payload is
+# "entity:id", changes of link tables are notified as changes of film_work.
+NOTIFY_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.notify_content_change() RETURNS trigger AS $$
+DECLARE
+    -- TG_ARGV[0] is name of entity, TG_ARGV[1] is column with id of entity
+    old_id text;
+    new_id text;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        old_id := to_jsonb(OLD) ->> TG_ARGV[1];
+        PERFORM pg_notify('content_changes', TG_ARGV[0] || ':' || old_id);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        new_id := to_jsonb(NEW) ->> TG_ARGV[1];
+        IF new_id IS DISTINCT FROM old_id THEN
+            PERFORM pg_notify('content_changes', TG_ARGV[0] || ':' || new_id);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# table, entity, column with id of entity
+TRIGGERS = (
+    ("film_work", "film_work", "id"),
+    ("person", "person", "id"),
+    ("genre", "genre", "id"),
+    ("person_film_work", "film_work", "film_work_id"),
+    ("genre_film_work", "film_work", "film_work_id"),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("movies", "0002_modified_id_indexes"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[NOTIFY_FUNCTION]
+            + [
+                f"DROP TRIGGER IF EXISTS {table}_notify ON content.{table}; "
+                f"CREATE TRIGGER {table}_notify "
+                f"AFTER INSERT OR UPDATE OR DELETE ON content.{table} "
+                f"FOR EACH ROW EXECUTE FUNCTION "
+                f"content.notify_content_change('{entity}', '{column}');"
+                for table, entity, column in TRIGGERS
+            ],
+            reverse_sql=[
+                f"DROP TRIGGER IF EXISTS {table}_notify ON content.{table};"
+                for table, _, _ in TRIGGERS
+            ]
+            + ["DROP FUNCTION IF EXISTS content.notify_content_change();"],
+        ),
+    ]
@@ -0,0 +1,75 @@
+from django.db import migrations
+
+# Append-only log of content changes for ETL. Rows are written by triggers in
+# the same transaction as changes and deleted by ETL after loading.
+CREATE_OUTBOX = """
+CREATE TABLE IF NOT EXISTS content.search_outbox (
+    id bigserial PRIMARY KEY,
+    entity VARCHAR(255) NOT NULL,
+    entity_id uuid NOT NULL,
+    operation VARCHAR(6) NOT NULL,
+    created timestamp with time zone NOT NULL DEFAULT now()
+);
+"""
+
+RECORD_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.record_content_change() RETURNS trigger AS $$
+DECLARE
+    -- TG_ARGV[0] is name of entity, TG_ARGV[1] is column with id of entity
+    old_id uuid;
+    new_id uuid;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        old_id := (to_jsonb(OLD) ->> TG_ARGV[1])::uuid;
+        INSERT INTO content.search_outbox (entity, entity_id, operation)
+            VALUES (TG_ARGV[0], old_id, TG_OP);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        new_id := (to_jsonb(NEW) ->> TG_ARGV[1])::uuid;
+        IF new_id IS DISTINCT FROM old_id THEN
+            INSERT INTO content.search_outbox (entity, entity_id, operation)
+                VALUES (TG_ARGV[0], new_id, TG_OP);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# table, entity, column with id of entity
+TRIGGERS = (
+    ("film_work", "film_work", "id"),
+    ("person", "person", "id"),
+    ("genre", "genre", "id"),
+    ("person_film_work", "film_work", "film_work_id"),
+    ("genre_film_work", "film_work", "film_work_id"),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("movies", "0003_notify_content_change"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[CREATE_OUTBOX, RECORD_FUNCTION]
+            + [
+                f"DROP TRIGGER IF EXISTS {table}_outbox ON content.{table}; "
+                f"CREATE TRIGGER {table}_outbox "
+                f"AFTER INSERT OR UPDATE OR DELETE ON content.{table} "
+                f"FOR EACH ROW EXECUTE FUNCTION "
+                f"content.record_content_change('{entity}', '{column}');"
+                for table, entity, column in TRIGGERS
+            ],
+            reverse_sql=[
+                f"DROP TRIGGER IF EXISTS {table}_outbox ON content.{table};"
+                for table, _, _ in TRIGGERS
+            ]
+            + [
+                "DROP FUNCTION IF EXISTS content.record_content_change();",
+                "DROP TABLE IF EXISTS content.search_outbox;",
+            ],
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations
+
+# Ids of deleted film_works, so ETL could delete their documents from index.
+# Row is written by trigger in the same transaction as deletion.
+CREATE_TOMBSTONE = """
+CREATE TABLE IF NOT EXISTS content.film_work_tombstone (
+    id uuid PRIMARY KEY,
+    deleted timestamp with time zone NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS film_work_tombstone_deleted_id
+    ON content.film_work_tombstone (deleted, id);
+"""
+
+RECORD_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.record_film_work_deletion() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO content.film_work_tombstone (id) VALUES (OLD.id)
+        ON CONFLICT (id) DO UPDATE SET deleted = EXCLUDED.deleted;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+CREATE_TRIGGER = """
+DROP TRIGGER IF EXISTS film_work_tombstone ON content.film_work;
+CREATE TRIGGER film_work_tombstone
+    AFTER DELETE ON content.film_work
+    FOR EACH ROW EXECUTE FUNCTION content.record_film_work_deletion();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("movies", "0004_search_outbox"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[CREATE_TOMBSTONE, RECORD_FUNCTION, CREATE_TRIGGER],
+            reverse_sql=[
+                "DROP TRIGGER IF EXISTS film_work_tombstone ON content.film_work;",
+                "DROP FUNCTION IF EXISTS content.record_film_work_deletion();",
+                "DROP TABLE IF EXISTS content.film_work_tombstone;",
+            ],
+        ),
+    ]
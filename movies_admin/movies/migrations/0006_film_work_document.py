@@ -0,0 +1,186 @@
+from django.db import migrations, models
+
+# Search documents of film_works, precomputed and refreshed by triggers, so ETL
+# and API read single row per film_work instead of aggregating genres and persons.
+CREATE_DOCUMENTS = """
+CREATE TABLE IF NOT EXISTS content.film_work_document (
+    id uuid PRIMARY KEY REFERENCES content.film_work(id) ON DELETE CASCADE,
+    document jsonb NOT NULL,
+    modified timestamp with time zone
+);
+"""
+
+REFRESH_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.refresh_film_work_documents(film_work_ids uuid[])
+RETURNS void AS $$
+BEGIN
+    -- concurrent refreshes of the same film_work wait for each other, so each
+    -- one builds document from snapshot with changes of previous one
+    PERFORM 1 FROM content.film_work
+        WHERE id = ANY(film_work_ids) ORDER BY id FOR NO KEY UPDATE;
+    INSERT INTO content.film_work_document (id, document, modified)
+    SELECT d.id, to_jsonb(d) - 'modified', d.modified
+    FROM (
+        SELECT
+            f.id,
+            f.rating AS imdb_rating,
+            COALESCE(
+                ARRAY_AGG(DISTINCT g.name) FILTER (WHERE g.name IS NOT NULL), '{}'
+            ) AS genre,
+            f.title,
+            f.description,
+            COALESCE(
+                ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'director'),
+                '{}'
+            ) AS director,
+            COALESCE(
+                ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'actor'), '{}'
+            ) AS actors_names,
+            COALESCE(
+                ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'writer'), '{}'
+            ) AS writers_names,
+            ARRAY_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name))
+                FILTER (WHERE pfw.role = 'actor') AS actors,
+            ARRAY_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name))
+                FILTER (WHERE pfw.role = 'writer') AS writers,
+            GREATEST(f.modified, MAX(p.modified), MAX(g.modified)) AS modified
+        FROM
+            content.film_work AS f
+            LEFT JOIN content.genre_film_work AS gfw ON f.id = gfw.film_work_id
+            LEFT JOIN content.genre AS g ON gfw.genre_id = g.id
+            LEFT JOIN content.person_film_work AS pfw ON f.id = pfw.film_work_id
+            LEFT JOIN content.person AS p ON pfw.person_id = p.id
+        WHERE f.id = ANY(film_work_ids)
+        GROUP BY f.id
+    ) AS d
+    ON CONFLICT (id) DO UPDATE
+        SET document = EXCLUDED.document, modified = EXCLUDED.modified;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+REFRESH_CHANGED_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.refresh_changed_film_work_documents()
+RETURNS trigger AS $$
+DECLARE
+    -- TG_ARGV[0] is column with id of film_work or, if TG_ARGV[1] is set, with
+    -- id of person or genre linked to film_works by table TG_ARGV[1] through
+    -- column TG_ARGV[2]; old_rows and new_rows are transition tables
+    changed_ids uuid[] := '{}';
+    film_work_ids uuid[];
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        changed_ids := changed_ids || ARRAY(
+            SELECT (to_jsonb(o) ->> TG_ARGV[0])::uuid FROM old_rows AS o
+        );
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        changed_ids := changed_ids || ARRAY(
+            SELECT (to_jsonb(n) ->> TG_ARGV[0])::uuid FROM new_rows AS n
+        );
+    END IF;
+    IF TG_NARGS = 1 THEN
+        film_work_ids := changed_ids;
+    ELSE
+        EXECUTE format(
+            'SELECT ARRAY(SELECT DISTINCT film_work_id FROM content.%I '
+            'WHERE %I = ANY($1))',
+            TG_ARGV[1],
+            TG_ARGV[2]
+        ) INTO film_work_ids USING changed_ids;
+    END IF;
+    PERFORM content.refresh_film_work_documents(film_work_ids);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# transition tables of triggers by event
+TRANSITION_TABLES = {
+    "INSERT": "NEW TABLE AS new_rows",
+    "UPDATE": "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+    "DELETE": "OLD TABLE AS old_rows",
+}
+
+# table, name of trigger, event, arguments of trigger function; documents of
+# deleted film_works are deleted by foreign key, deleted persons and genres have
+# no links left
+TRIGGERS = (
+    ("film_work", "film_work_document_insert", "INSERT", "'id'"),
+    ("film_work", "film_work_document_update", "UPDATE", "'id'"),
+    (
+        "person",
+        "person_document_update",
+        "UPDATE",
+        "'id', 'person_film_work', 'person_id'",
+    ),
+    (
+        "genre",
+        "genre_document_update",
+        "UPDATE",
+        "'id', 'genre_film_work', 'genre_id'",
+    ),
+    *(
+        (table, f"{table}_document_{event.lower()}", event, "'film_work_id'")
+        for table in ("person_film_work", "genre_film_work")
+        for event in ("INSERT", "UPDATE", "DELETE")
+    ),
+)
+
+FILL_DOCUMENTS = """
+SELECT content.refresh_film_work_documents(ARRAY(SELECT id FROM content.film_work));
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("movies", "0005_film_work_tombstone"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[CREATE_DOCUMENTS, REFRESH_FUNCTION, REFRESH_CHANGED_FUNCTION]
+            + [
+                f"DROP TRIGGER IF EXISTS {name} ON content.{table}; "
+                f"CREATE TRIGGER {name} AFTER {event} ON content.{table} "
+                f"REFERENCING {TRANSITION_TABLES[event]} "
+                f"FOR EACH STATEMENT EXECUTE FUNCTION "
+                f"content.refresh_changed_film_work_documents({arguments});"
+                for table, name, event, arguments in TRIGGERS
+            ]
+            + [FILL_DOCUMENTS],
+            reverse_sql=[
+                f"DROP TRIGGER IF EXISTS {name} ON content.{table};"
+                for table, name, _, _ in TRIGGERS
+            ]
+            + [
+                "DROP FUNCTION IF EXISTS "
+                "content.refresh_changed_film_work_documents();",
+                "DROP FUNCTION IF EXISTS content.refresh_film_work_documents(uuid[]);",
+                "DROP TABLE IF EXISTS content.film_work_document;",
+            ],
+        ),
+        migrations.CreateModel(
+            name="FilmworkDocument",
+            fields=[
+                (
+                    "film_work",
+                    models.OneToOneField(
+                        db_column="id",
+                        on_delete=models.deletion.DO_NOTHING,
+                        primary_key=True,
+                        related_name="document",
+                        serialize=False,
+                        to="movies.filmwork",
+                    ),
+                ),
+                ("document", models.JSONField()),
+                ("modified", models.DateTimeField(null=True)),
+            ],
+            options={
+                "db_table": "film_work_document",
+                "managed": False,
+            },
+        ),
+    ]
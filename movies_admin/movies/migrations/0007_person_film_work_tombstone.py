@@ -0,0 +1,70 @@
+from django.db import migrations
+
+# Ids of persons, whose links to film_works were deleted or moved, so ETL could
+# rebuild their documents without film_works they are no longer linked to.
+# Row is written by trigger in the same transaction as change of link.
+CREATE_TOMBSTONE = """
+CREATE TABLE IF NOT EXISTS content.person_film_work_tombstone (
+    person_id uuid PRIMARY KEY,
+    deleted timestamp with time zone NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS person_film_work_tombstone_deleted_person_id
+    ON content.person_film_work_tombstone (deleted, person_id);
+"""
+
+RECORD_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.record_person_film_work_deletion()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE'
+        OR OLD.person_id IS DISTINCT FROM NEW.person_id
+        OR OLD.film_work_id IS DISTINCT FROM NEW.film_work_id
+    THEN
+        INSERT INTO content.person_film_work_tombstone (person_id)
+            VALUES (OLD.person_id)
+            ON CONFLICT (person_id) DO UPDATE SET deleted = EXCLUDED.deleted;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+CREATE_TRIGGERS = """
+DROP TRIGGER IF EXISTS person_film_work_tombstone ON content.person_film_work;
+CREATE TRIGGER person_film_work_tombstone
+    AFTER UPDATE OR DELETE ON content.person_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.record_person_film_work_deletion();
+DROP TRIGGER IF EXISTS person_film_work_person_outbox ON content.person_film_work;
+CREATE TRIGGER person_film_work_person_outbox
+    AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+    FOR EACH ROW EXECUTE FUNCTION
+    content.record_content_change('person_film_work', 'person_id');
+DROP TRIGGER IF EXISTS person_film_work_person_notify ON content.person_film_work;
+CREATE TRIGGER person_film_work_person_notify
+    AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+    FOR EACH ROW EXECUTE FUNCTION
+    content.notify_content_change('person_film_work', 'person_id');
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("movies", "0006_film_work_document"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[CREATE_TOMBSTONE, RECORD_FUNCTION, CREATE_TRIGGERS],
+            reverse_sql=[
+                "DROP TRIGGER IF EXISTS person_film_work_person_notify "
+                "ON content.person_film_work;",
+                "DROP TRIGGER IF EXISTS person_film_work_person_outbox "
+                "ON content.person_film_work;",
+                "DROP TRIGGER IF EXISTS person_film_work_tombstone "
+                "ON content.person_film_work;",
+                "DROP FUNCTION IF EXISTS content.record_person_film_work_deletion();",
+                "DROP TABLE IF EXISTS content.person_film_work_tombstone;",
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+# With "modified" change source ETL deletes outdated records of outbox by time
+# of their creation, so deletion doesn't scan whole table.
+CREATE_INDEX = """
+CREATE INDEX IF NOT EXISTS search_outbox_created
+    ON content.search_outbox (created);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("movies", "0007_person_film_work_tombstone"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=CREATE_INDEX,
+            reverse_sql="DROP INDEX IF EXISTS content.search_outbox_created;",
+        ),
+    ]
@@ -160,3 +160,21 @@ class PersonFilmwork(UUIDMixin):
 
     def __str__(self):
         return ""
+
+
+class FilmworkDocument(models.Model):
+    """Search document of film_work, maintained by triggers of database."""
+
+    film_work = models.OneToOneField(
+        Filmwork,
+        primary_key=True,
+        db_column="id",
+        on_delete=models.DO_NOTHING,
+        related_name="document",
+    )
+    document = models.JSONField()
+    modified = models.DateTimeField(null=True)
+
+    class Meta:
+        managed = False
+        db_table = "film_work_document"
@@ -0,0 +1,278 @@
+"""Asyncio ETL runner.
+
+Changes are extracted through asynchronous PostgreSQL connection and loaded
+by AsyncElasticsearch, so extraction of next chunks goes on while bulk requests
+are in flight. At most APP_CONFIG.loader_workers bulk requests are in flight
+and at most APP_CONFIG.pipeline_queue_size chunks wait for loading. Checkpoints
+are saved in the order of extraction and only after all earlier chunks are
+loaded, the same as by load_elastic(). Chunks of one round may contain the same
+documents, so without external versioning chunks are loaded one by one in the
+order of extraction and older snapshot of document never overwrites newer one.
+"""
+import asyncio
+import collections
+import logging
+import time
+from contextlib import (
+    AbstractAsyncContextManager,
+    AsyncExitStack,
+    aclosing,
+    nullcontext,
+)
+from typing import Any, AsyncIterator
+
+import backoff
+import psycopg
+from elasticsearch import helpers
+
+import postgres_to_es.bulk_sizing
+import postgres_to_es.digests
+import postgres_to_es.extractor
+import postgres_to_es.loader
+import postgres_to_es.metrics
+import postgres_to_es.state_
+import postgres_to_es.transformer
+import postgres_to_es.utils
+from postgres_to_es.settings import APP_CONFIG, get_backoff_config
+
+logger = logging.getLogger(__name__)
+
+Checkpoint = postgres_to_es.extractor.Checkpoint
+ESActions = postgres_to_es.transformer.ESActions
+
+
+async def _run_steps(
+    conn: psycopg.AsyncConnection,
+    steps: postgres_to_es.extractor.Steps,
+) -> AsyncIterator[Any]:
+    """Run extraction steps by asynchronous PostgreSQL connection.
+
+    The same as extractor.run_steps(), but rows are fetched without blocking
+    event loop.
+
+    Args:
+        conn: Asynchronous PostgreSQL connection.
+        steps: Extraction steps, see extractor.get_extraction_steps().
+
+    Yields:
+        Items yielded by steps except requests of rows.
+    """
+    async with AsyncExitStack() as stack:
+        stack.callback(steps.close)
+        cursor = await stack.enter_async_context(conn.cursor())
+        # cursor of each open stream
+        streams: dict[str, tuple[AsyncExitStack, psycopg.AsyncCursor]] = {}
+        rows = None
+        while True:
+            try:
+                item = steps.send(rows)
+            except StopIteration:
+                return
+            rows = None
+            if isinstance(item, postgres_to_es.extractor.Query):
+                with postgres_to_es.metrics.EXTRACT_SECONDS.time():
+                    await cursor.execute(item.query, item.params)
+                    rows = await cursor.fetchall()
+            elif isinstance(item, postgres_to_es.extractor.Stream):
+                stream = await stack.enter_async_context(AsyncExitStack())
+                stream_cursor = await stream.enter_async_context(
+                    postgres_to_es.utils.open_async_cursor(conn, item.name),
+                )
+                await stream_cursor.execute(item.query, item.params)
+                streams[item.name] = (stream, stream_cursor)
+            elif isinstance(item, postgres_to_es.extractor.Fetch):
+                stream, stream_cursor = streams[item.name]
+                rows = await stream_cursor.fetchmany(APP_CONFIG.chunk_size)
+                if not rows:
+                    del streams[item.name]
+                    await stream.aclose()
+            else:
+                yield item
+
+
+@backoff.on_exception(
+    **get_backoff_config(
+        postgres_to_es.utils.reset_shared_async_elasticsearch_client,
+    ),
+)
+async def _send_bulk(
+    semaphore: asyncio.Semaphore,
+    actions: ESActions,
+    by_id: dict[str, dict],
+    sizes: dict[str, int],
+    handled: dict[str, bool],
+) -> ESActions:
+    """Send actions in single bulk request, see loader._send_bulk().
+
+    Waits for semaphore, so number of requests in flight is limited. Shared
+    client is recreated on each retry.
+
+    Args:
+        semaphore: Semaphore limiting number of requests in flight.
+        actions: Serialized actions.
+        by_id: Original actions by document id.
+        sizes: Size of serialized sources by document id.
+        handled: Whether document is loaded by id of handled document.
+
+    Returns:
+        Original actions rejected with 429.
+    """
+    actions = postgres_to_es.loader.get_unhandled(actions, handled)
+    rejected: ESActions = []
+    if not actions:
+        return rejected
+    async with semaphore:
+        start = time.perf_counter()
+        async for ok, item in helpers.async_streaming_bulk(
+            client=postgres_to_es.utils.get_shared_async_elasticsearch_client(),
+            actions=actions,
+            **postgres_to_es.loader.get_bulk_options(actions),
+        ):
+            postgres_to_es.loader.handle_item(
+                ok,
+                item,
+                by_id,
+                sizes,
+                handled,
+                rejected,
+            )
+        latency = time.perf_counter() - start
+    postgres_to_es.loader.record_bulk(actions, sizes, latency, bool(rejected))
+    return rejected
+
+
+async def _load_bulk(semaphore: asyncio.Semaphore, actions: ESActions) -> list[str]:
+    """Bulk load chunk of documents into Elasticsearch.
+
+    The same as loader._load_bulk(), but bulk requests of chunk are sent
+    concurrently.
+
+    Args:
+        semaphore: Semaphore limiting number of requests in flight.
+        actions: A list of documents to load.
+
+    Returns:
+        Ids of loaded documents.
+    """
+    client = postgres_to_es.utils.get_shared_async_elasticsearch_client()
+    handled: dict[str, bool] = {}
+    while actions:
+        by_id = {str(action["_id"]): action for action in actions}
+        serialized, sizes = postgres_to_es.loader.serialize(client, actions)
+        results = await asyncio.gather(
+            *(
+                _send_bulk(semaphore, batch, by_id, sizes, handled)
+                for batch in postgres_to_es.bulk_sizing.BULK_SIZER.split(
+                    serialized,
+                    [sizes.get(str(action["_id"]), 0) for action in serialized],
+                )
+            ),
+        )
+        rejected = [action for batch in results for action in batch]
+
+        if rejected:
+            logger.warning(
+                "%s documents still rejected with 429, retry them",
+                len(rejected),
+            )
+            await asyncio.sleep(APP_CONFIG.backoff_interval)
+        actions = rejected
+    return [document_id for document_id, loaded in handled.items() if loaded]
+
+
+async def _load_chunk(
+    semaphore: asyncio.Semaphore,
+    order: AbstractAsyncContextManager,
+    actions: ESActions,
+) -> int:
+    """Load chunk of documents into Elasticsearch, see loader.load_chunk().
+
+    Digests of documents are stored by blocking calls, so they are made
+    in thread.
+
+    Args:
+        semaphore: Semaphore limiting number of requests in flight.
+        order: Context held during loading of chunk, lock orders loading of
+            chunks.
+        actions: A list of documents to load.
+
+    Returns:
+        Number of loaded and deleted documents
+    """
+    deleted_ids = [
+        action["_id"] for action in actions if action.get("_op_type") == "delete"
+    ]
+    async with order:
+        if not APP_CONFIG.suppress_unchanged:
+            loaded_ids = await _load_bulk(semaphore, actions) if actions else []
+        else:
+            store = postgres_to_es.digests.DIGESTS
+            actions, digests = await asyncio.to_thread(
+                store.suppress_unchanged,
+                actions,
+            )
+            loaded_ids = await _load_bulk(semaphore, actions) if actions else []
+            await asyncio.to_thread(store.save, digests, loaded_ids)
+            await asyncio.to_thread(
+                store.discard,
+                postgres_to_es.loader.get_stale_digest_ids(actions),
+            )
+    if deleted_ids:
+        logger.info("Deleted %s documents from elasticsearch", len(deleted_ids))
+    return len(loaded_ids)
+
+
+async def _commit(
+    state: postgres_to_es.state_.State,
+    task: asyncio.Task | None,
+    checkpoint: Checkpoint,
+) -> None:
+    """Wait for loading of chunk and save its checkpoint."""
+    if task is not None:
+        loaded = await task
+        logger.info("Loaded %s documents into elasticsearch", loaded)
+    # acknowledgement of outbox uses blocking connection
+    await asyncio.to_thread(postgres_to_es.loader.save_checkpoint, state, checkpoint)
+
+
+async def run_async(
+    state: postgres_to_es.state_.State,
+    steps: postgres_to_es.extractor.Steps,
+) -> None:
+    """Run asyncio ETL round.
+
+    Args:
+        state: Persistent state storage.
+        steps: Extraction steps, see extractor.get_extraction_steps().
+    """
+    semaphore = asyncio.Semaphore(APP_CONFIG.loader_workers)
+    # lock is fair, so chunks are loaded in the order of their tasks
+    order = nullcontext() if APP_CONFIG.external_versioning else asyncio.Lock()
+    # tasks loading chunks with their checkpoints, in order of extraction
+    pending: collections.deque[tuple[asyncio.Task | None, Checkpoint]] = (
+        collections.deque()
+    )
+    try:
+        conn = await postgres_to_es.utils.get_async_postgres_connection()
+        chunks = _run_steps(conn, steps)
+        async with conn, aclosing(chunks):
+            async for models, checkpoint in chunks:
+                actions = postgres_to_es.transformer.transform_chunk(models)
+                task = None
+                if actions:
+                    task = asyncio.create_task(_load_chunk(semaphore, order, actions))
+                pending.append((task, checkpoint))
+                while pending and (
+                    len(pending) > APP_CONFIG.pipeline_queue_size
+                    or pending[0][0] is None
+                    or pending[0][0].done()
+                ):
+                    await _commit(state, *pending.popleft())
+            while pending:
+                await _commit(state, *pending.popleft())
+    finally:
+        tasks = [task for task, _ in pending if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await postgres_to_es.utils.reset_shared_async_elasticsearch_client()
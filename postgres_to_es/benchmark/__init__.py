@@ -0,0 +1,19 @@
+"""Benchmark of ETL.
+
+Synthetic catalogue is generated in PostgreSQL, then single ETL round loads it
+into in-process stand-in of Elasticsearch bulk API. Results are saved as json,
+so they could be compared with results of previous runs::
+
+    python -m postgres_to_es.benchmark generate --films 10000 --reset
+    python -m postgres_to_es.benchmark run --latency 0.02 --output new.json \
+        --baseline old.json
+
+Memory command checks that peak RSS with STREAM_RESULTS doesn't grow with
+number of film_works affected by single change. It generates catalogues of
+given sizes and fails if peak RSS grew more than tolerance in megabytes::
+
+    python -m postgres_to_es.benchmark memory --films 5000 50000 --reset
+
+Benchmark should be run against scratch database, generate --reset truncates
+all content tables.
+"""
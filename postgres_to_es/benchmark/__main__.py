@@ -0,0 +1,616 @@
+"""Command line interface of benchmark, see postgres_to_es.benchmark."""
+import argparse
+import datetime
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Any
+
+import postgres_to_es.extractor
+import postgres_to_es.logging_config
+import postgres_to_es.main
+import postgres_to_es.metrics
+import postgres_to_es.reindex
+import postgres_to_es.state_
+import postgres_to_es.utils
+from postgres_to_es.benchmark import catalogue
+from postgres_to_es.benchmark.fake_elasticsearch import FakeElasticsearch
+from postgres_to_es.settings import APP_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# settings affecting performance, they are saved with results
+REPORTED_SETTINGS = (
+    "chunk_size",
+    "etl_engine",
+    "pipeline_queue_size",
+    "loader_workers",
+    "raw_documents",
+    "validation_sample_rate",
+    "stream_results",
+    "postgres_itersize",
+    "suppress_unchanged",
+    "person_partial_updates",
+    "external_versioning",
+    "bulk_target_bytes",
+    "bulk_min_bytes",
+    "bulk_max_bytes",
+    "bulk_target_latency",
+)
+
+
+def _count_catalogue() -> dict[str, int]:
+    with closing(postgres_to_es.utils.get_postgres_connection()) as conn:
+        with conn.cursor() as cursor:
+            counts = {}
+            for table in catalogue.CONTENT_TABLES:
+                cursor.execute(f"SELECT count(*) FROM content.{table}")  # noqa: S608
+                counts[table] = cursor.fetchone()[0]
+            cursor.execute("SELECT now()")
+            counts_at = cursor.fetchone()[0].isoformat()
+    return counts | {"counted_at": counts_at}
+
+
+STAGES = {
+    "extract": postgres_to_es.metrics.EXTRACT_SECONDS,
+    "transform": postgres_to_es.metrics.TRANSFORM_SECONDS,
+    "bulk": postgres_to_es.metrics.BULK_SECONDS,
+}
+
+
+def _measure_round(
+    checkpoints: list[tuple[str, str, list[str]]],
+    catch_up_from: str | None = None,
+) -> dict[str, Any]:
+    """Run single ETL round from given checkpoints and measure it.
+
+    Runs in child process started by _run_round(), so settings, paths of
+    stores and address of Elasticsearch are taken from its environment.
+
+    Args:
+        checkpoints: Entity, index name and checkpoint of each set checkpoint.
+        catch_up_from: Start of reindex, if catch-up of reindex is measured
+            instead of regular round.
+
+    Returns:
+        Results of round.
+    """
+    state = postgres_to_es.state_.State(
+        postgres_to_es.state_.JsonFileStorage(APP_CONFIG.json_storage_path),
+    )
+    for entity, index_name, keyset in checkpoints:
+        state.set_value(
+            postgres_to_es.extractor.get_state_key(entity, index_name),
+            keyset,
+        )
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    if catch_up_from is None:
+        postgres_to_es.main.etl(state)
+    else:
+        postgres_to_es.reindex.catch_up(state, catch_up_from)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    documents = int(postgres_to_es.metrics.DOCUMENTS.total())
+    return {
+        "settings": {name: getattr(APP_CONFIG, name) for name in REPORTED_SETTINGS},
+        "documents": documents,
+        "wall_seconds": round(wall, 3),
+        "cpu_seconds": round(cpu, 3),
+        "docs_per_second": round(documents / wall, 1),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            1,
+        ),
+        # stages overlap in pipeline engine, so their sum could exceed wall time
+        "stages": {
+            name: {
+                "seconds": round(histogram.sum, 3),
+                "calls": histogram.count,
+            }
+            for name, histogram in STAGES.items()
+        },
+    }
+
+
+def _run_round(
+    latency: float,
+    checkpoints: dict[tuple[str, str], list[str]],
+    catch_up_from: str | None = None,
+    **settings: str,
+) -> dict[str, Any]:
+    """Run single measured ETL round in child process.
+
+    Child process reads settings from environment, so overridden settings
+    apply everywhere, including defaults bound on import. State, digests and
+    dead letters are kept in temporary directory, stand-in of Elasticsearch
+    runs in this process.
+
+    Args:
+        latency: Latency of bulk requests to stand-in of Elasticsearch.
+        checkpoints: Checkpoints by entity and index name.
+        catch_up_from: Start of reindex, if catch-up of reindex is measured
+            instead of regular round.
+        settings: Environment variables overriding settings.
+
+    Returns:
+        Results of round.
+    """
+    with FakeElasticsearch(latency) as fake, tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        output = directory / "result.json"
+        _run_command(
+            "round",
+            "--checkpoints",
+            json.dumps(
+                [
+                    [entity, index_name, keyset]
+                    for (entity, index_name), keyset in checkpoints.items()
+                ],
+            ),
+            *(("--catch-up-from", catch_up_from) if catch_up_from else ()),
+            "--output",
+            str(output),
+            ELASTICSEARCH_HOST=fake.host,
+            ELASTICSEARCH_PORT=str(fake.port),
+            JSON_STORAGE_PATH=str(directory / "state.json"),
+            DIGEST_STORAGE_PATH=str(directory / "digests.sqlite3"),
+            DEAD_LETTER_PATH=str(directory / "dead_letter.jsonl"),
+            **settings,
+        )
+        result = json.loads(output.read_text())
+        elasticsearch_stats = fake.get_stats()
+    result["settings"]["latency"] = latency
+    return {**result, "elasticsearch": elasticsearch_stats}
+
+
+def run(latency: float) -> dict[str, Any]:
+    """Load whole catalogue by single ETL round and measure it.
+
+    Every film_work is loaded exactly once: checkpoints of persons and genres,
+    as well as all checkpoints of indices of persons and genres, are set after
+    their generation, as if they were already loaded.
+
+    Args:
+        latency: Latency of bulk requests to stand-in of Elasticsearch.
+
+    Returns:
+        Results of benchmark.
+    """
+    counts = _count_catalogue()
+    started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    index_entities = postgres_to_es.extractor.get_index_entities()
+    loaded = [
+        (entity, index_name)
+        for index_name, entities in index_entities.items()
+        for entity in entities
+        if index_name != APP_CONFIG.es_index_name
+    ]
+    loaded.extend((entity, APP_CONFIG.es_index_name) for entity in ("person", "genre"))
+    keyset = [counts["counted_at"], postgres_to_es.extractor.MAX_ID]
+    result = _run_round(
+        latency,
+        {key: keyset for key in loaded},
+        # generator empties outbox, so changes are detected by modified columns
+        CHANGE_SOURCE="modified",
+    )
+    return {
+        "started_at": started_at,
+        "catalogue": {table: counts[table] for table in catalogue.CONTENT_TABLES},
+        **result,
+    }
+
+
+def run_renames(persons: int, latency: float) -> dict[str, Any]:
+    """Measure loading of renames of most prolific persons.
+
+    Persons are renamed and loaded twice, with whole documents of movies and
+    with partial updates, see APP_CONFIG.person_partial_updates. Only index
+    of movies is loaded.
+
+    Args:
+        persons: Number of persons to rename.
+        latency: Latency of bulk requests to stand-in of Elasticsearch.
+
+    Returns:
+        Results of both modes.
+    """
+    results = {}
+    for mode, partial in (("whole", "false"), ("partial", "true")):
+        with closing(postgres_to_es.utils.get_postgres_connection()) as conn:
+            renamed_at = catalogue.rename_persons(conn, persons)
+        results[mode] = _run_round(
+            latency,
+            _get_movies_checkpoints(renamed_at),
+            CHANGE_SOURCE="modified",
+            PERSONS_GENRES_INDICES="false",
+            PERSON_PARTIAL_UPDATES=partial,
+        )
+    return results
+
+
+def _get_movies_checkpoints(changed_at: str) -> dict[tuple[str, str], list[str]]:
+    return {
+        (entity, APP_CONFIG.es_index_name): [
+            changed_at,
+            postgres_to_es.extractor.MAX_ID,
+        ]
+        for entity in (
+            *postgres_to_es.extractor.ENTITIES,
+            postgres_to_es.extractor.TOMBSTONE,
+        )
+    }
+
+
+def run_genre_renames(latency: float) -> dict[str, Any]:
+    """Rename all genres and load film_works of them.
+
+    Only index of movies is loaded.
+
+    Args:
+        latency: Latency of bulk requests to stand-in of Elasticsearch.
+
+    Returns:
+        Results of round.
+    """
+    with closing(postgres_to_es.utils.get_postgres_connection()) as conn:
+        renamed_at = catalogue.rename_genres(conn)
+    return _run_round(
+        latency,
+        _get_movies_checkpoints(renamed_at),
+        CHANGE_SOURCE="modified",
+        PERSONS_GENRES_INDICES="false",
+    )
+
+
+def run_catch_up(persons: int, latency: float) -> dict[str, Any]:
+    """Rename most prolific persons and load them by catch-up of reindex.
+
+    Catch-up starts from empty state, so it must load only records changed
+    since start of reindex: documents of renamed persons and their film_works.
+
+    Args:
+        persons: Number of persons to rename.
+        latency: Latency of bulk requests to stand-in of Elasticsearch.
+
+    Returns:
+        Results of round and expected number of documents.
+    """
+    with closing(postgres_to_es.utils.get_postgres_connection()) as conn:
+        renamed_at = catalogue.rename_persons(conn, persons)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+SELECT count(DISTINCT pfw.film_work_id), count(DISTINCT p.id)
+FROM content.person p
+LEFT JOIN content.person_film_work pfw ON pfw.person_id = p.id
+WHERE p.modified > %s
+                """,
+                (renamed_at,),
+            )
+            film_works, renamed = cursor.fetchone()
+    result = _run_round(latency, {}, catch_up_from=renamed_at)
+    expected = film_works + (renamed if APP_CONFIG.persons_genres_indices else 0)
+    return {**result, "expected_documents": expected}
+
+
+def _run_command(*args: str, **env: str) -> None:
+    """Run command of benchmark in child process.
+
+    Args:
+        args: Command and its arguments.
+        env: Environment variables to override.
+
+    Raises:
+        RuntimeError: If command failed.
+    """
+    completed = subprocess.run(  # noqa: S603
+        (sys.executable, "-m", "postgres_to_es.benchmark", *args),
+        env=os.environ | env,
+        stdout=subprocess.DEVNULL,
+        check=False,
+    )
+    if completed.returncode:
+        raise RuntimeError(f"Command {args[0]} failed")
+
+
+def run_memory(
+    sizes: list[int],
+    latency: float,
+    reset: bool,
+    ddl_path: Path = catalogue.DDL_PATH,
+) -> dict[str, Any]:
+    """Measure peak RSS of loading changes of catalogues of growing size.
+
+    For each size catalogue with single genre of all film_works is generated,
+    so renaming of the genre changes every film_work. Then the genre is
+    renamed and loaded with results streamed by server-side cursors and
+    fetched at once, see APP_CONFIG.stream_results. Catalogues are generated
+    and rounds are run by commands in child processes: peak RSS can't be
+    reset and child process inherits it from parent, so RSS of parent must
+    not grow with catalogue.
+
+    Args:
+        sizes: Numbers of film_works of catalogues.
+        latency: Latency of bulk requests to stand-in of Elasticsearch.
+        reset: Whether to truncate content tables with existing data.
+        ddl_path: Path to ddl of database.
+
+    Returns:
+        Results of both modes by number of film_works.
+
+    Raises:
+        RuntimeError: If command in child process failed, e.g. content tables
+            have data and reset is False.
+    """
+    results = {}
+    for films in sorted(sizes):
+        _run_command(
+            "generate",
+            "--films",
+            str(films),
+            "--genres",
+            "1",
+            "--persons-per-film",
+            "1",
+            "--genres-per-film",
+            "1",
+            "--ddl",
+            str(ddl_path),
+            *(("--reset",) if reset else ()),
+        )
+        # the catalogue is generated here, so it's truncated for the next size
+        reset = True
+        results[films] = {}
+        for mode, stream_results in (("streamed", "true"), ("fetched", "false")):
+            with tempfile.TemporaryDirectory() as tmp:
+                output = Path(tmp) / "result.json"
+                _run_command(
+                    "run",
+                    "--rename-genres",
+                    "--latency",
+                    str(latency),
+                    "--output",
+                    str(output),
+                    STREAM_RESULTS=stream_results,
+                )
+                results[films][mode] = json.loads(output.read_text())
+    return results
+
+
+def check_memory(results: dict[int, dict[str, Any]], tolerance: float) -> bool:
+    """Print peak RSS by catalogue size and check it is bounded when streamed.
+
+    Args:
+        results: Results of run_memory().
+        tolerance: Allowed growth of peak RSS in megabytes between the smallest
+            and the largest catalogue with streamed results.
+
+    Returns:
+        False if peak RSS of streamed results grew more than tolerance.
+    """
+    print(f"{'films':>10} {'streamed_mb':>12} {'fetched_mb':>12}")  # noqa: T201
+    for films, modes in results.items():
+        print(  # noqa: T201
+            f"{films:>10} {modes['streamed']['peak_rss_mb']:>12} "
+            f"{modes['fetched']['peak_rss_mb']:>12}",
+        )
+    peaks = [modes["streamed"]["peak_rss_mb"] for modes in results.values()]
+    return peaks[-1] - peaks[0] <= tolerance
+
+
+def compare(
+    result: dict[str, Any],
+    baseline: dict[str, Any],
+    tolerance: float,
+) -> bool:
+    """Print comparison of results with baseline.
+
+    Args:
+        result: Results of current run.
+        baseline: Results of previous run.
+        tolerance: Allowed relative decrease of throughput.
+
+    Returns:
+        False if throughput decreased more than tolerance.
+    """
+    rows = [
+        ("docs_per_second", baseline["docs_per_second"], result["docs_per_second"]),
+        ("peak_rss_mb", baseline["peak_rss_mb"], result["peak_rss_mb"]),
+        ("cpu_seconds", baseline["cpu_seconds"], result["cpu_seconds"]),
+    ]
+    rows.extend(
+        (
+            f"{stage}_seconds",
+            baseline["stages"][stage]["seconds"],
+            result["stages"][stage]["seconds"],
+        )
+        for stage in result["stages"]
+    )
+    for name, old, new in rows:
+        change = (new - old) / old * 100 if old else 0
+        print(f"{name:20} {old:>12} {new:>12} {change:>+8.1f}%")  # noqa: T201
+
+    if baseline["settings"] != result["settings"]:
+        logger.warning("Settings differ from baseline, results are not comparable")
+    return result["docs_per_second"] >= baseline["docs_per_second"] * (1 - tolerance)
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m postgres_to_es.benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="generate synthetic catalogue")
+    generate.add_argument("--films", type=int, default=10_000)
+    generate.add_argument("--persons", type=int, help="defaults to films")
+    generate.add_argument("--genres", type=int, default=30)
+    generate.add_argument("--persons-per-film", type=int, default=8)
+    generate.add_argument("--genres-per-film", type=int, default=2)
+    generate.add_argument("--seed", type=int, default=0)
+    generate.add_argument(
+        "--reset",
+        action="store_true",
+        help="truncate content tables if they have data",
+    )
+    generate.add_argument("--ddl", type=Path, default=catalogue.DDL_PATH)
+
+    run_parser = commands.add_parser("run", help="run benchmark")
+    run_parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="seconds of latency of each bulk request",
+    )
+    run_parser.add_argument("--output", type=Path, help="file to save results")
+    run_parser.add_argument(
+        "--rename-persons",
+        type=int,
+        help="instead of loading catalogue, rename given number of most prolific "
+        "persons and compare loading of whole and partial documents",
+    )
+    run_parser.add_argument(
+        "--catch-up",
+        type=int,
+        help="instead of loading catalogue, rename given number of most prolific "
+        "persons and check that catch-up of reindex loads only their documents",
+    )
+    run_parser.add_argument(
+        "--rename-genres",
+        action="store_true",
+        help="instead of loading catalogue, rename all genres and load their "
+        "film_works",
+    )
+    run_parser.add_argument("--baseline", type=Path, help="results to compare with")
+    run_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="allowed relative decrease of docs/sec compared to baseline",
+    )
+
+    memory = commands.add_parser(
+        "memory",
+        help="check that peak RSS with STREAM_RESULTS doesn't grow with catalogue",
+    )
+    memory.add_argument(
+        "--films",
+        type=int,
+        nargs="+",
+        default=[5_000, 50_000],
+        help="numbers of film_works of generated catalogues",
+    )
+    memory.add_argument("--latency", type=float, default=0)
+    memory.add_argument(
+        "--tolerance",
+        type=float,
+        default=10,
+        help="allowed growth of peak RSS in megabytes",
+    )
+    memory.add_argument(
+        "--reset",
+        action="store_true",
+        help="truncate content tables if they have data",
+    )
+    memory.add_argument("--ddl", type=Path, default=catalogue.DDL_PATH)
+    memory.add_argument("--output", type=Path, help="file to save results")
+
+    round_parser = commands.add_parser(
+        "round",
+        help="run single measured ETL round, used by other commands",
+    )
+    round_parser.add_argument(
+        "--checkpoints",
+        type=json.loads,
+        default=[],
+        help="json list of entity, index name and checkpoint to set",
+    )
+    round_parser.add_argument(
+        "--catch-up-from",
+        help="measure catch-up of reindex started at given time",
+    )
+    round_parser.add_argument("--output", type=Path, required=True)
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = _parse_args()
+    if args.command == "generate":
+        with closing(postgres_to_es.utils.get_postgres_connection()) as conn:
+            try:
+                catalogue.prepare_schema(conn, args.reset, args.ddl)
+            except RuntimeError as error:
+                logger.error(error)
+                return 1
+            catalogue.generate(
+                conn,
+                films=args.films,
+                persons=args.persons or args.films,
+                genres=args.genres,
+                persons_per_film=args.persons_per_film,
+                genres_per_film=args.genres_per_film,
+                seed=args.seed,
+            )
+        return 0
+
+    if args.command == "round":
+        result = _measure_round(args.checkpoints, args.catch_up_from)
+        args.output.write_text(json.dumps(result, indent=2) + "\n")
+        return 0
+
+    if args.command == "memory":
+        try:
+            result = run_memory(args.films, args.latency, args.reset, args.ddl)
+        except RuntimeError as error:
+            logger.error(error)
+            return 1
+        if args.output:
+            args.output.parent.mkdir(parents=True, exist_ok=True)
+            args.output.write_text(json.dumps(result, indent=2) + "\n")
+        if not check_memory(result, args.tolerance):
+            logger.error("Peak RSS grew more than %s MB", args.tolerance)
+            return 1
+        return 0
+
+    if args.rename_persons:
+        result = run_renames(args.rename_persons, args.latency)
+    elif args.rename_genres:
+        result = run_genre_renames(args.latency)
+    elif args.catch_up:
+        result = run_catch_up(args.catch_up, args.latency)
+    else:
+        result = run(args.latency)
+    report = json.dumps(result, indent=2)
+    print(report)  # noqa: T201
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(report + "\n")
+    if args.catch_up and result["documents"] != result["expected_documents"]:
+        logger.error(
+            "Catch-up loaded %s documents instead of %s",
+            result["documents"],
+            result["expected_documents"],
+        )
+        return 1
+    if args.baseline and not (
+        args.rename_persons or args.rename_genres or args.catch_up
+    ):
+        baseline = json.loads(args.baseline.read_text())
+        if not compare(result, baseline, args.tolerance):
+            logger.error("Throughput decreased more than %.0f%%", args.tolerance * 100)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    postgres_to_es.logging_config.setup_logging()
+    sys.exit(main())
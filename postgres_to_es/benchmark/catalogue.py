@@ -0,0 +1,287 @@
+"""Generator of synthetic catalogue of film_works in PostgreSQL."""
+import csv
+import datetime
+import io
+import logging
+import random
+import uuid
+from pathlib import Path
+from typing import Any, Iterable
+
+from psycopg2.extensions import connection, cursor
+
+logger = logging.getLogger(__name__)
+
+DDL_PATH = (
+    Path(__file__).resolve().parents[2] / "docker" / "postgres" / "movies_database.ddl"
+)
+
+CONTENT_TABLES = (
+    "person_film_work",
+    "genre_film_work",
+    "film_work",
+    "person",
+    "genre",
+)
+# tables filled by triggers, they exist only in recent schema
+CHANGE_TABLES = (
+    "search_outbox",
+    "film_work_tombstone",
+    "person_film_work_tombstone",
+)
+# tables filled by triggers from content tables, truncated only with them
+DOCUMENT_TABLES = ("film_work_document",)
+
+FILM_WORK_TYPES = ("movie", "tv_show")
+ROLES = ("actor", "director", "writer")
+WORDS = (
+    "star", "night", "war", "love", "city", "last", "dark", "return", "empire",
+    "ghost", "river", "storm", "secret", "king", "road", "blood", "dream", "moon",
+)  # fmt: skip
+
+COPY_BATCH_SIZE = 10_000
+
+
+def _get_uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _get_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def _copy(
+    cursor: cursor,
+    table: str,
+    columns: tuple[str, ...],
+    rows: Iterable[tuple[Any, ...]],
+) -> None:
+    """Copy rows into table in csv format."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY content.{table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer,
+    )
+
+
+def _table_exists(cursor: cursor, table: str) -> bool:
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"content.{table}",))
+    return cursor.fetchone()[0]
+
+
+def prepare_schema(conn: connection, reset: bool, ddl_path: Path = DDL_PATH) -> None:
+    """Create schema from ddl if it doesn't exist, otherwise check it is empty.
+
+    Args:
+        conn: PostgreSQL connection.
+        reset: Whether to truncate content tables with existing data.
+        ddl_path: Path to ddl of database.
+
+    Raises:
+        RuntimeError: If content tables have data and reset is False.
+    """
+    with conn.cursor() as cursor:
+        if not _table_exists(cursor, "film_work"):
+            logger.info("Create schema from %s", ddl_path)
+            cursor.execute(ddl_path.read_text())
+            return
+
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM content.film_work)")
+        if cursor.fetchone()[0] and not reset:
+            raise RuntimeError(
+                "Database already contains film_works, use scratch database "
+                "or reset to truncate content tables",
+            )
+        tables = [
+            f"content.{table}"
+            for table in (*CONTENT_TABLES, *CHANGE_TABLES, *DOCUMENT_TABLES)
+            if _table_exists(cursor, table)
+        ]
+        cursor.execute(f"TRUNCATE {', '.join(tables)}")
+        logger.info("Truncated %s", ", ".join(tables))
+
+
+def rename_persons(conn: connection, persons: int) -> str:
+    """Rename persons with the most film_works.
+
+    Args:
+        conn: PostgreSQL connection.
+        persons: Number of persons to rename.
+
+    Returns:
+        Time before renaming by clock of PostgreSQL in isoformat.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT now()")
+        renamed_at = cursor.fetchone()[0].isoformat()
+        cursor.execute(
+            """
+UPDATE content.person
+SET full_name = full_name || '*', modified = now()
+WHERE id IN (
+    SELECT person_id
+    FROM content.person_film_work
+    GROUP BY person_id
+    ORDER BY count(*) DESC, person_id
+    LIMIT %s
+)
+            """,
+            (persons,),
+        )
+    logger.info("Renamed %s persons", persons)
+    return renamed_at
+
+
+def rename_genres(conn: connection) -> str:
+    """Rename all genres.
+
+    Args:
+        conn: PostgreSQL connection.
+
+    Returns:
+        Time before renaming by clock of PostgreSQL in isoformat.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT now()")
+        renamed_at = cursor.fetchone()[0].isoformat()
+        cursor.execute(
+            "UPDATE content.genre SET name = name || '*', modified = now()",
+        )
+    logger.info("Renamed %s genres", cursor.rowcount)
+    return renamed_at
+
+
+def generate(
+    conn: connection,
+    films: int,
+    persons: int,
+    genres: int,
+    persons_per_film: int,
+    genres_per_film: int,
+    seed: int = 0,
+) -> None:
+    """Generate catalogue in single transaction.
+
+    Data is reproducible for the same arguments and seed.
+
+    Args:
+        conn: PostgreSQL connection.
+        films: Number of film_works.
+        persons: Number of persons.
+        genres: Number of genres.
+        persons_per_film: Number of persons with random roles in each film_work.
+        genres_per_film: Number of genres of each film_work.
+        seed: Seed of random generator.
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    persons_per_film = min(persons_per_film, persons)
+    genres_per_film = min(genres_per_film, genres)
+
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cursor:
+            genre_ids = [_get_uuid(rng) for _ in range(genres)]
+            _copy(
+                cursor,
+                "genre",
+                ("id", "name", "description", "created", "modified"),
+                (
+                    (id_, f"Genre {number}", _get_text(rng, 8), now, now)
+                    for number, id_ in enumerate(genre_ids)
+                ),
+            )
+            person_ids = [_get_uuid(rng) for _ in range(persons)]
+            _copy(
+                cursor,
+                "person",
+                ("id", "full_name", "created", "modified"),
+                (
+                    (id_, f"Person {number}", now, now)
+                    for number, id_ in enumerate(person_ids)
+                ),
+            )
+
+            for start in range(0, films, COPY_BATCH_SIZE):
+                film_works, person_links, genre_links = [], [], []
+                for number in range(start, min(start + COPY_BATCH_SIZE, films)):
+                    film_work_id = _get_uuid(rng)
+                    film_works.append(
+                        (
+                            film_work_id,
+                            f"{_get_text(rng, 3)} {number}",
+                            _get_text(rng, 30),
+                            datetime.date(1950, 1, 1)
+                            + datetime.timedelta(days=rng.randrange(365 * 70)),
+                            round(rng.uniform(1, 10), 1),
+                            rng.choice(FILM_WORK_TYPES),
+                            now,
+                            now,
+                        ),
+                    )
+                    person_links.extend(
+                        (
+                            _get_uuid(rng),
+                            person_id,
+                            film_work_id,
+                            rng.choice(ROLES),
+                            now,
+                        )
+                        for person_id in rng.sample(person_ids, persons_per_film)
+                    )
+                    genre_links.extend(
+                        (_get_uuid(rng), genre_id, film_work_id, now)
+                        for genre_id in rng.sample(genre_ids, genres_per_film)
+                    )
+                _copy(
+                    cursor,
+                    "film_work",
+                    (
+                        "id",
+                        "title",
+                        "description",
+                        "creation_date",
+                        "rating",
+                        "type",
+                        "created",
+                        "modified",
+                    ),
+                    film_works,
+                )
+                _copy(
+                    cursor,
+                    "person_film_work",
+                    ("id", "person_id", "film_work_id", "role", "created"),
+                    person_links,
+                )
+                _copy(
+                    cursor,
+                    "genre_film_work",
+                    ("id", "genre_id", "film_work_id", "created"),
+                    genre_links,
+                )
+                logger.info(
+                    "Generated %s of %s film_works",
+                    start + len(film_works),
+                    films,
+                )
+
+            # changes recorded by triggers are not needed for benchmark
+            for table in CHANGE_TABLES:
+                if _table_exists(cursor, table):
+                    cursor.execute(f"TRUNCATE content.{table}")
+            analyzed = [
+                f"content.{table}"
+                for table in (*CONTENT_TABLES, *DOCUMENT_TABLES)
+                if _table_exists(cursor, table)
+            ]
+            cursor.execute(f"ANALYZE {', '.join(analyzed)}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = autocommit
@@ -0,0 +1,130 @@
+"""In-process stand-in of Elasticsearch for benchmarks.
+
+Server accepts bulk requests and acknowledges every action after configured
+latency without storing documents, so benchmark measures ETL itself. Requests
+used by client on startup, e.g. info and index existence, are answered too.
+"""
+import gzip
+import http
+import http.server
+import json
+import threading
+import time
+from typing import Any
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.bulk_requests = 0
+        self.actions = 0
+        self.received_bytes = 0
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: _Server
+
+    def _read_body(self) -> bytes:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def _send(self, status: int, payload: dict[str, Any]) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _bulk(self, body: bytes) -> None:
+        time.sleep(self.server.latency)
+        lines = body.splitlines()
+        items = []
+        line_number = 0
+        while line_number < len(lines):
+            op_type, meta = next(iter(json.loads(lines[line_number]).items()))
+            # delete has no source line
+            line_number += 1 if op_type == "delete" else 2
+            if op_type == "delete":
+                status = http.HTTPStatus.OK
+            else:
+                status = http.HTTPStatus.CREATED
+            items.append({op_type: {"_id": meta.get("_id"), "status": status}})
+        with self.server.lock:
+            self.server.bulk_requests += 1
+            self.server.actions += len(items)
+            self.server.received_bytes += len(body)
+        self._send(http.HTTPStatus.OK, {"took": 0, "errors": False, "items": items})
+
+    def _handle(self) -> None:
+        body = self._read_body()
+        if self.path.split("?")[0].endswith("/_bulk"):
+            self._bulk(body)
+        elif self.path == "/":
+            self._send(
+                http.HTTPStatus.OK,
+                {"version": {"number": "8.5.0"}, "tagline": "You Know, for Search"},
+            )
+        else:
+            self._send(http.HTTPStatus.OK, {"acknowledged": True})
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = _handle  # noqa: N815
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        """Don't log requests."""
+
+
+class FakeElasticsearch:
+    """Bulk API stand-in running in background thread.
+
+    Can be used as context manager.
+    """
+
+    def __init__(self, latency: float = 0):
+        """Initialize server.
+
+        Args:
+            latency: Seconds to wait before answering each bulk request.
+        """
+        self._server = _Server(latency)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def host(self) -> str:
+        return self._server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def get_stats(self) -> dict[str, int]:
+        """Return number of bulk requests, actions and received bytes."""
+        with self._server.lock:
+            return {
+                "bulk_requests": self._server.bulk_requests,
+                "actions": self._server.actions,
+                "received_bytes": self._server.received_bytes,
+            }
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeElasticsearch":
+        self.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
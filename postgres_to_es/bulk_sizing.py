@@ -0,0 +1,106 @@
+"""Adaptive size of bulk requests.
+
+Chunks of documents are split into bulk requests by size in bytes rather than
+by number of documents, because size of documents differs a lot. Target size
+is adjusted after each request: it is decreased if Elasticsearch answers slower
+than target latency or rejects documents with 429 Too Many Requests, and it is
+increased while requests are fast.
+"""
+import threading
+from typing import Iterator
+
+import postgres_to_es.metrics
+from postgres_to_es.settings import APP_CONFIG
+
+# approximate size of action line and newlines of each document in request
+ACTION_OVERHEAD = 100
+
+GROWTH_FACTOR = 1.25
+MIN_SHRINK_FACTOR = 0.5
+
+
+class BulkSizer:
+    """Target size of bulk requests, shared by all loaders of process."""
+
+    def __init__(
+        self,
+        target_bytes: int,
+        min_bytes: int,
+        max_bytes: int,
+        target_latency: float,
+    ):
+        """Initialize sizer.
+
+        Args:
+            target_bytes: Initial target size of request.
+            min_bytes: Lower bound of target size.
+            max_bytes: Upper bound of target size.
+            target_latency: Desired duration of request in seconds.
+        """
+        self._min_bytes = min_bytes
+        self._max_bytes = max_bytes
+        self._target_latency = target_latency
+        self._target_bytes = self._clamp(target_bytes)
+        self._lock = threading.Lock()
+
+    @property
+    def target_bytes(self) -> int:
+        """Current target size of request."""
+        return self._target_bytes
+
+    def _clamp(self, size: float) -> int:
+        return int(min(max(size, self._min_bytes), self._max_bytes))
+
+    def record(self, size: int, latency: float, rejected: bool) -> None:
+        """Adjust target size by result of request.
+
+        Args:
+            size: Size of request in bytes.
+            latency: Duration of request in seconds.
+            rejected: Whether some documents were rejected with 429.
+        """
+        with self._lock:
+            if rejected:
+                factor = MIN_SHRINK_FACTOR
+            elif latency > self._target_latency:
+                factor = max(self._target_latency / latency, MIN_SHRINK_FACTOR)
+            elif size >= self._target_bytes / 2:
+                # small requests, e.g. of short chunks, say nothing about limit
+                factor = GROWTH_FACTOR
+            else:
+                factor = 1
+            self._target_bytes = self._clamp(self._target_bytes * factor)
+
+    def split(self, actions: list[dict], sizes: list[int]) -> Iterator[list[dict]]:
+        """Split actions into requests of at most target size.
+
+        Action larger than target size is sent in request of its own.
+
+        Args:
+            actions: A list of actions.
+            sizes: Size of source of each action in bytes.
+
+        Yields:
+            Lists of actions.
+        """
+        target_bytes = self._target_bytes
+        batch: list[dict] = []
+        batch_bytes = 0
+        for action, size in zip(actions, sizes):
+            size += ACTION_OVERHEAD
+            if batch and batch_bytes + size > target_bytes:
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(action)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+
+BULK_SIZER = BulkSizer(
+    target_bytes=APP_CONFIG.bulk_target_bytes,
+    min_bytes=APP_CONFIG.bulk_min_bytes,
+    max_bytes=APP_CONFIG.bulk_max_bytes,
+    target_latency=APP_CONFIG.bulk_target_latency,
+)
+postgres_to_es.metrics.BULK_TARGET_BYTES.set_function(lambda: BULK_SIZER.target_bytes)
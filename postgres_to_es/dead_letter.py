@@ -0,0 +1,70 @@
+"""Storage of documents permanently rejected by Elasticsearch.
+
+Rejected bulk actions are appended to json lines file together with error, so
+they could be replayed after fixing the cause, see replay_dead_letters.
+"""
+import datetime
+import fcntl
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any
+
+from postgres_to_es.settings import APP_CONFIG
+
+
+class DeadLetterStore:
+    """Append-only json lines file of rejected bulk actions.
+
+    File is locked on every access, so store is safe to use from several
+    threads and processes.
+    """
+
+    def __init__(self, file_path: Path):
+        """Initialize store at file path. File is created on first append."""
+        self._file_path = file_path
+        self._lock = threading.Lock()
+
+    def append(self, action: dict[str, Any], error: dict[str, Any]) -> None:
+        """Append rejected action with error returned by Elasticsearch."""
+        record = {
+            "failed_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "error": error,
+            "action": action,
+        }
+        line = json.dumps(record, default=str) + "\n"
+        self._file_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock, self._file_path.open("a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            file.write(line)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def retrieve(self) -> list[dict[str, Any]]:
+        """Load all records from store."""
+        if not self._file_path.is_file():
+            return []
+        with self._lock, self._file_path.open("r") as file:
+            fcntl.flock(file, fcntl.LOCK_SH)
+            return [json.loads(line) for line in file if line.strip()]
+
+    def discard(self, count: int) -> None:
+        """Remove first count records from store.
+
+        Records appended after retrieve() are kept.
+        """
+        if not self._file_path.is_file():
+            return
+        with self._lock, self._file_path.open("r+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            lines = [line for line in file if line.strip()]
+            file.seek(0)
+            file.writelines(lines[count:])
+            file.truncate()
+            file.flush()
+            os.fsync(file.fileno())
+
+
+DEAD_LETTERS = DeadLetterStore(APP_CONFIG.dead_letter_path)
+
@@ -0,0 +1,157 @@
+"""Suppression of re-indexing of unchanged documents.
+
+Digest of source of each loaded document is kept in SQLite database next to
+state. Documents with the same digest as already loaded one are not sent
+to Elasticsearch.
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+from pathlib import Path
+from typing import Any
+
+import postgres_to_es.transformer
+from postgres_to_es.settings import APP_CONFIG
+
+logger = logging.getLogger(__name__)
+
+ESActions = postgres_to_es.transformer.ESActions
+Digests = dict[bytes, bytes]
+
+DIGEST_SIZE = 16
+
+
+def get_digest(source: dict[str, Any] | str) -> bytes:
+    """Return stable digest of document source.
+
+    Args:
+        source: Source of document as dict or as serialized json.
+
+    Returns:
+        Digest of DIGEST_SIZE bytes.
+    """
+    if not isinstance(source, str):
+        source = json.dumps(
+            source,
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+            default=str,
+        )
+    return hashlib.blake2b(source.encode(), digest_size=DIGEST_SIZE).digest()
+
+
+def _get_key(document_id: Any) -> bytes:
+    """Return compact key of document id, which is uuid in this index."""
+    return uuid.UUID(str(document_id)).bytes
+
+
+class DigestStore:
+    """SQLite storage of digests of loaded documents.
+
+    Both ids and digests are stored as bytes, so store takes about 50 bytes
+    per document. Store is safe to use from several threads.
+    """
+
+    def __init__(self, file_path: Path):
+        """Initialize store at file path. File is created on first access."""
+        self._file_path = file_path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self.suppressed_total = 0
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._file_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self._file_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS digests "
+                "(id BLOB PRIMARY KEY, digest BLOB NOT NULL) WITHOUT ROWID",
+            )
+        return self._conn
+
+    def retrieve(self, keys: list[bytes]) -> Digests:
+        """Load digests of documents by keys."""
+        if not keys:
+            return {}
+        placeholders = ",".join("?" * len(keys))
+        with self._lock:
+            rows = self._get_connection().execute(
+                f"SELECT id, digest FROM digests WHERE id IN ({placeholders})",  # noqa: S608
+                keys,
+            )
+            return dict(rows.fetchall())
+
+    def save(self, digests: Digests, loaded_ids: list[Any]) -> None:
+        """Save digests of loaded documents.
+
+        Args:
+            digests: Digests returned by suppress_unchanged().
+            loaded_ids: Ids of documents actually loaded, digests of other
+                documents, e.g. rejected ones, are not saved.
+        """
+        loaded = {_get_key(document_id) for document_id in loaded_ids}
+        digests = {key: digest for key, digest in digests.items() if key in loaded}
+        if not digests:
+            return
+        with self._lock:
+            conn = self._get_connection()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO digests (id, digest) VALUES (?, ?)",
+                    digests.items(),
+                )
+
+    def discard(self, ids: list[Any]) -> None:
+        """Remove digests of deleted documents by their ids."""
+        if not ids:
+            return
+        with self._lock:
+            conn = self._get_connection()
+            with conn:
+                conn.executemany(
+                    "DELETE FROM digests WHERE id = ?",
+                    [(_get_key(document_id),) for document_id in ids],
+                )
+
+    def suppress_unchanged(self, actions: ESActions) -> tuple[ESActions, Digests]:
+        """Drop actions with documents that are already loaded unchanged.
+
+        Delete and update actions are always kept.
+
+        Args:
+            actions: A list of index actions.
+
+        Returns:
+            Actions to load and digests to save after successful loading.
+        """
+        digests = {
+            _get_key(action["_id"]): get_digest(action["_source"])
+            for action in actions
+            if "_source" in action
+        }
+        stored = self.retrieve(list(digests))
+        changed = []
+        for action in actions:
+            if "_source" not in action:
+                # deletion or partial update
+                changed.append(action)
+                continue
+            key = _get_key(action["_id"])
+            if stored.get(key) == digests[key]:
+                del digests[key]
+            else:
+                changed.append(action)
+
+        suppressed = len(actions) - len(changed)
+        if suppressed:
+            with self._lock:
+                self.suppressed_total += suppressed
+            logger.info("Skipped %s unchanged documents", suppressed)
+        return changed, digests
+
+
+DIGESTS = DigestStore(APP_CONFIG.digest_storage_path)
@@ -1,45 +1,900 @@
 import datetime
+import json
 import logging
-from contextlib import closing
-from typing import Iterator
+import random
+from contextlib import ExitStack, closing
+from typing import Any, Generator, Iterator, NamedTuple
 
 import pydantic
 
+import postgres_to_es.leases
+import postgres_to_es.metrics
 import postgres_to_es.models
+import postgres_to_es.state_
 import postgres_to_es.utils
 from postgres_to_es.settings import APP_CONFIG
 
 logger = logging.getLogger(__name__)
 
+# Tables whose changes affect documents in index. Each table keeps own checkpoint.
+ENTITIES = ("film_work", "person", "genre")
+# Table with ids of deleted film_works, it keeps own checkpoint too.
+TOMBSTONE = "film_work_tombstone"
+# Table with ids of persons, whose links to film_works were deleted, it keeps
+# checkpoint of index of persons.
+PERSON_LINK_TOMBSTONE = "person_film_work_tombstone"
+# Key of ids of persons unlinked from film_works in changed ids. Outbox records
+# them under the same entity.
+UNLINKED_PERSONS = "person_film_work"
+
+MIN_ID = "00000000-0000-0000-0000-000000000000"
+MAX_ID = "ffffffff-ffff-ffff-ffff-ffffffffffff"
+
+# Key of checkpoint with ids of outbox records to delete after loading. Unlike
+# other checkpoints it is not saved in state.
+OUTBOX_ACK_KEY = "outbox_ack"
+# Key of time of last purge of outbox in state, see purge_outbox()
+OUTBOX_PURGED_KEY = "outbox_purged_at"
+
+Checkpoint = dict[str, Any]
+Keyset = tuple[str, str]
+Rows = list[Any]
+ModelsChunk = tuple[
+    postgres_to_es.models.MovieDocument
+    | postgres_to_es.models.RawMovieDocument
+    | postgres_to_es.models.MoviePersons
+    | postgres_to_es.models.PersonDocument
+    | postgres_to_es.models.GenreDocument
+    | postgres_to_es.models.DeletedDocument,
+    ...,
+]
+
+
+class Query(NamedTuple):
+    """Request of extraction step to execute query and send its rows back."""
+
+    query: str
+    params: Any
+
+
+class Stream(NamedTuple):
+    """Request of extraction step to execute query with possibly large result.
+
+    Query is executed by cursor from utils.open_cursor(), its rows are sent
+    back on Fetch with the same name.
+    """
+
+    name: str
+    query: str
+    params: Any
+
+
+class Fetch(NamedTuple):
+    """Request of extraction step to send back next rows of stream.
+
+    At most APP_CONFIG.chunk_size rows are sent, empty list when stream is
+    exhausted, then its cursor is closed.
+    """
+
+    name: str
+
+
+# Extraction steps are generators, which yield Query, Stream or Fetch to get
+# rows from PostgreSQL and yield extracted documents otherwise. So the same
+# steps are run by blocking connection, see run_steps(), and by asynchronous
+# one, see async_engine.
+Steps = Generator[Any, Rows | None, None]
+
+
+def get_index_entities() -> dict[str, tuple[str, ...]]:
+    """Return tables whose changes affect documents by name of index.
+
+    Persons are affected by changes of their film_works too, e.g. of title, and
+    by deletion of their links to film_works.
+    """
+    indices = {APP_CONFIG.es_index_name: (*ENTITIES, TOMBSTONE)}
+    if APP_CONFIG.persons_genres_indices:
+        indices[APP_CONFIG.es_persons_index_name] = (
+            "person",
+            "film_work",
+            PERSON_LINK_TOMBSTONE,
+        )
+        indices[APP_CONFIG.es_genres_index_name] = ("genre",)
+    return indices
+
+
+def get_state_key(entity: str, index_name: str = APP_CONFIG.es_index_name) -> str:
+    """Return key of checkpoint of entity of index in state."""
+    return f"{index_name}.{entity}"
+
+
+def _get_keyset(
+    state: postgres_to_es.state_.State,
+    entity: str,
+    index_name: str = APP_CONFIG.es_index_name,
+) -> Keyset:
+    """Return (modified, id) checkpoint of entity of index from state.
+
+    Falls back to the timestamp checkpoint of whole index saved by previous
+    versions of ETL, so upgrade doesn't trigger full reindex.
+    """
+    keyset = state.get_value(get_state_key(entity, index_name))
+    if keyset is None:
+        keyset = state.get_value(index_name)
+    if keyset is None:
+        keyset = datetime.datetime.min.isoformat()
+    if isinstance(keyset, str):
+        return keyset, MIN_ID
+    modified, id_ = keyset
+    return modified, id_
+
+
+def _validate_sample(
+    documents: tuple[postgres_to_es.models.RawMovieDocument, ...],
+) -> None:
+    """Validate random sample of raw documents by pydantic model.
+
+    Invalid documents are only logged, they are loaded anyway.
+    """
+    for document in documents:
+        if random.random() >= APP_CONFIG.validation_sample_rate:
+            continue
+        try:
+            postgres_to_es.models.MovieDocument(
+                **json.loads(document.source),
+                modified=document.modified,
+            )
+        except pydantic.ValidationError:
+            postgres_to_es.metrics.ERRORS.inc(kind="invalid_document")
+            logger.exception(
+                "Invalid document %s. Check definitions of model and SQL query.",
+                document.id,
+            )
+
+
+def get_enrich_query() -> str:
+    """Return query of documents of film_works by ids selected in settings."""
+    if APP_CONFIG.raw_documents:
+        return postgres_to_es.utils.get_document_query()
+    return postgres_to_es.utils.get_query()
+
+
+def _get_documents(rows: list[Any]) -> ModelsChunk | None:
+    """Build documents from rows of document query.
+
+    Args:
+        rows: Rows of query returned by get_enrich_query().
+
+    Returns:
+        A tuple of pydantic models or, if raw documents are enabled in settings,
+        of raw documents. None if models are invalid, error is logged then.
+    """
+    if APP_CONFIG.raw_documents:
+        documents = tuple(
+            postgres_to_es.models.RawMovieDocument(
+                row["id"],
+                row["modified"],
+                row["source"],
+                row["version"],
+            )
+            for row in rows
+        )
+        _validate_sample(documents)
+        return documents
+    try:
+        return tuple(
+            postgres_to_es.models.MovieDocument(
+                **row["document"],
+                modified=row["modified"],
+                version=row["version"],
+            )
+            for row in rows
+        )
+    except pydantic.ValidationError:
+        postgres_to_es.metrics.ERRORS.inc(kind="invalid_document")
+        logger.exception(
+            "Error on validation. Check definitions of model and SQL query.",
+        )
+        return None
+
+
+def _enrich(changed_ids: dict[str, list[str]]) -> Steps:
+    """Extract documents of film_works affected by changed records.
+
+    Args:
+        changed_ids: Changed ids by entity.
+
+    Yields:
+        Requests of rows and a tuple of pydantic models or, if raw documents
+        are enabled in settings, of raw documents. Tuple contains at most
+        APP_CONFIG.chunk_size elements.
+    """
+    if APP_CONFIG.person_partial_updates and changed_ids.get("person"):
+        yield from _enrich({**changed_ids, "person": []})
+        yield from _enrich_person_updates(changed_ids)
+        return
+
+    query = get_enrich_query()
+    # change of single genre or person could affect huge number of film_works,
+    # so ids are streamed when streaming is enabled
+    yield Stream(
+        "film_work_ids",
+        postgres_to_es.utils.get_film_work_ids_query(),
+        changed_ids,
+    )
+    while id_rows := (yield Fetch("film_work_ids")):
+        rows = yield Query(query, ([row["id"] for row in id_rows],))
+        documents = _get_documents(rows)
+        if documents is not None:
+            yield documents
+
+
+def _enrich_person_updates(changed_ids: dict[str, list[str]]) -> Steps:
+    """Extract fields of persons of film_works affected only by changed persons.
+
+    Change of person is change of its name, so only fields of persons
+    in documents of its film_works are updated.
+
+    Args:
+        changed_ids: Changed ids by entity.
+
+    Yields:
+        Requests of rows and a tuple of partial documents. Tuple contains at
+        most APP_CONFIG.chunk_size elements.
+    """
+    yield Stream(
+        "person_film_work_ids",
+        postgres_to_es.utils.get_person_film_work_ids_query(),
+        changed_ids,
+    )
+    while id_rows := (yield Fetch("person_film_work_ids")):
+        rows = yield Query(
+            postgres_to_es.utils.get_movie_persons_query(),
+            ([row["id"] for row in id_rows],),
+        )
+        yield _get_movie_persons(rows)
+
+
+def _get_movie_persons(rows: list[Any]) -> ModelsChunk:
+    return tuple(postgres_to_es.models.MoviePersons(**row) for row in rows)
+
+
+def _get_entity_documents(
+    entity: str,
+    ids: list[str],
+    rows: list[Any],
+) -> ModelsChunk:
+    """Build documents of persons or genres from rows of their query.
+
+    Args:
+        entity: Either person or genre.
+        ids: Requested ids.
+        rows: Rows of query returned by _get_entity_query().
+
+    Returns:
+        A tuple of pydantic models and deleted documents of requested ids,
+        which are not found.
+    """
+    model = {
+        "person": postgres_to_es.models.PersonDocument,
+        "genre": postgres_to_es.models.GenreDocument,
+    }[entity]
+    found = {str(row["id"]) for row in rows}
+    return (
+        *(model(**row) for row in rows),
+        *(
+            postgres_to_es.models.DeletedDocument(id_, None, entity)
+            for id_ in ids
+            if id_ not in found
+        ),
+    )
+
+
+def _get_entity_query(entity: str) -> str:
+    if entity == "person":
+        return postgres_to_es.utils.get_person_query()
+    return postgres_to_es.utils.get_genre_query()
+
+
+def _enrich_persons_genres(changed_ids: dict[str, list[str]]) -> Steps:
+    """Extract documents of persons and genres affected by changed records.
+
+    Persons are affected by own changes, by changes of their film_works and by
+    deletion of their links to film_works, including links of deleted
+    film_works, which can't be found through current links. Genres are
+    affected only by own changes. Affected persons and genres, which don't
+    exist anymore, are deleted.
+
+    Args:
+        changed_ids: Changed ids of person, genre, film_work and ids of persons
+            unlinked from film_works.
+
+    Yields:
+        Requests of rows and a tuple of documents. Tuple contains at most
+        APP_CONFIG.chunk_size elements. No documents are yielded if indices of
+        persons and genres are disabled in settings.
+    """
+    if not APP_CONFIG.persons_genres_indices:
+        return
+    person_ids = {
+        *changed_ids.get("person", ()),
+        *changed_ids.get(UNLINKED_PERSONS, ()),
+    }
+    if changed_ids.get("film_work"):
+        rows = yield Query(
+            postgres_to_es.utils.get_film_work_persons_query(),
+            (list(changed_ids["film_work"]),),
+        )
+        person_ids.update(str(row["id"]) for row in rows)
+    affected = {"person": sorted(person_ids), "genre": changed_ids.get("genre", [])}
+    for entity, ids in affected.items():
+        for chunk in postgres_to_es.utils.iter_chunks(ids, APP_CONFIG.chunk_size):
+            rows = yield Query(_get_entity_query(entity), (chunk,))
+            yield _get_entity_documents(entity, chunk, rows)
+
+
+def _extract_deleted(film_work_ids: list[str]) -> Steps:
+    """Extract documents of deleted film_works among given ones.
+
+    Args:
+        film_work_ids: Ids of changed film_works.
+
+    Yields:
+        Requests of rows and a tuple of deleted documents, if there are any.
+        Tuple contains at most APP_CONFIG.chunk_size elements.
+    """
+    if not film_work_ids:
+        return
+    rows = yield Query(postgres_to_es.utils.get_deleted_query(), (film_work_ids,))
+    yield from _get_deleted_chunks(rows)
+
+
+def _get_deleted_chunks(rows: list[Any]) -> Iterator[ModelsChunk]:
+    """Split rows of deleted film_works query into chunks of documents.
+
+    Args:
+        rows: Rows of query returned by get_deleted_query().
+
+    Yields:
+        A tuple of deleted documents, if there are any. Tuple contains at most
+        APP_CONFIG.chunk_size elements.
+    """
+    if not rows:
+        return
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    lags = [(now - row["deleted"]).total_seconds() for row in rows if row["deleted"]]
+    logger.info(
+        "Extracted %s deleted film_works, max delete lag %.1f seconds",
+        len(rows),
+        max(lags, default=0),
+    )
+    for chunk in postgres_to_es.utils.iter_chunks(rows, APP_CONFIG.chunk_size):
+        yield tuple(
+            postgres_to_es.models.DeletedDocument(
+                str(row["id"]),
+                row["deleted"],
+                version=row["version"],
+            )
+            for row in chunk
+        )
+
+
+def _chain(*steps: Steps) -> Steps:
+    """Run steps one after another, unlike itertools.chain() rows are sent."""
+    for step in steps:
+        yield from step
+
+
+def _with_checkpoint(steps: Steps, checkpoint: Checkpoint) -> Steps:
+    """Attach checkpoint to the last of chunks yielded by steps.
+
+    So checkpoint is saved only after all chunks are loaded. If there are
+    no chunks, checkpoint is yielded with empty chunk. Requests of rows are
+    passed through.
+    """
+    previous = None
+    rows = None
+    while True:
+        try:
+            item = steps.send(rows)
+        except StopIteration:
+            break
+        rows = None
+        if isinstance(item, (Query, Stream, Fetch)):
+            rows = yield item
+            continue
+        if previous is not None:
+            yield previous, {}
+        previous = item
+    yield previous or (), checkpoint
+
+
+def _group_outbox(rows: list[Any]) -> tuple[dict[str, list[str]], Checkpoint]:
+    """Return changed ids by entity and checkpoint of outbox records."""
+    changed_ids: dict[str, set[str]] = {
+        entity: set() for entity in (*ENTITIES, UNLINKED_PERSONS)
+    }
+    for row in rows:
+        changed_ids[row["entity"]].add(row["entity_id"])
+    checkpoint = {OUTBOX_ACK_KEY: [row["id"] for row in rows]}
+    return {entity: list(ids) for entity, ids in changed_ids.items()}, checkpoint
+
+
+def _get_outbox_params(last_id: int) -> tuple[Any, ...]:
+    """Return parameters of outbox query, see utils.get_outbox_query().
+
+    Args:
+        last_id: Id of last read record of outbox.
+
+    Returns:
+        Parameters of query, reading only leased shards if leasing is enabled.
+    """
+    leases = postgres_to_es.leases.LEASES
+    if leases is None:
+        return last_id, APP_CONFIG.chunk_size
+    return last_id, leases.total, leases.shards, APP_CONFIG.chunk_size
+
+
+def _extract_outbox() -> Steps:
+    """Extract documents of film_works affected by changes recorded in outbox.
+
+    Records are read in order of recording. Processed records are acknowledged
+    by deleting them after loading of all affected documents, so records
+    committed later out of order are picked up by next round.
+
+    Yields:
+        Requests of rows and a tuple of documents with checkpoint with ids of
+        outbox records to acknowledge. Tuple contains at most
+        APP_CONFIG.chunk_size elements.
+    """
+    last_id = 0
+    while True:
+        rows = yield Query(
+            postgres_to_es.utils.get_outbox_query(
+                sharded=postgres_to_es.leases.LEASES is not None,
+            ),
+            _get_outbox_params(last_id),
+        )
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        changed_ids, checkpoint = _group_outbox(rows)
+        yield from _with_checkpoint(
+            _chain(
+                _extract_deleted(changed_ids["film_work"]),
+                _enrich(changed_ids),
+                _enrich_persons_genres(changed_ids),
+            ),
+            checkpoint,
+        )
+
+
+def acknowledge_outbox(ids: list[int]) -> None:
+    """Delete processed records from outbox.
+
+    Args:
+        ids: Ids of processed records.
+    """
+    with closing(postgres_to_es.utils.get_postgres_connection()) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(postgres_to_es.utils.get_outbox_ack_query(), (ids,))
+
+
+def purge_outbox(state: postgres_to_es.state_.State) -> None:
+    """Delete records older than APP_CONFIG.outbox_retention from outbox.
+
+    Outbox is filled by triggers whatever change source, but records are
+    acknowledged only when outbox is read, so ETL detecting changes by modified
+    columns purges outdated records instead. Records are purged at most once
+    per APP_CONFIG.outbox_purge_interval. Time of last purge is kept in state,
+    so restarted processes don't purge right away.
+
+    Args:
+        state: Persistent state storage.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    purged_at = state.get_value(OUTBOX_PURGED_KEY)
+    if (
+        purged_at is not None
+        and (now - datetime.datetime.fromisoformat(purged_at)).total_seconds()
+        < APP_CONFIG.outbox_purge_interval
+    ):
+        return
+    with closing(postgres_to_es.utils.get_postgres_connection()) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                postgres_to_es.utils.get_outbox_purge_query(),
+                (APP_CONFIG.outbox_retention,),
+            )
+            if cursor.rowcount:
+                logger.info("Purged %s outdated records of outbox", cursor.rowcount)
+    state.set_value(OUTBOX_PURGED_KEY, now.isoformat())
+    state.flush()
+
+
+def get_extraction_steps(state: postgres_to_es.state_.State) -> Steps:
+    """Return steps extracting changes from PostgreSQL.
+
+    Changes are read from outbox or detected by modified columns depending on
+    settings, see _extract_outbox() and extract_modified().
+
+    Args:
+        state: Persistent state storage with checkpoint of each entity.
+
+    Returns:
+        Steps yielding requests of rows and tuples of documents and checkpoints
+        to save after successful loading of these documents.
+    """
+    if APP_CONFIG.change_source == "outbox":
+        return _extract_outbox()
+    return _extract_modified(state)
+
+
+def run_steps(steps: Steps) -> Iterator[Any]:
+    """Run extraction steps by blocking PostgreSQL connection.
+
+    Args:
+        steps: Extraction steps.
+
+    Yields:
+        Items yielded by steps except requests of rows.
+    """
+    with ExitStack() as stack:
+        stack.callback(steps.close)
+        conn = stack.enter_context(
+            closing(postgres_to_es.utils.get_postgres_connection()),
+        )
+        cursor = stack.enter_context(conn.cursor())
+        # cursor of each open stream and iterator of its chunks
+        streams: dict[str, tuple[ExitStack, Iterator[Rows]]] = {}
+        rows = None
+        while True:
+            try:
+                item = steps.send(rows)
+            except StopIteration:
+                return
+            rows = None
+            if isinstance(item, Query):
+                with postgres_to_es.metrics.EXTRACT_SECONDS.time():
+                    cursor.execute(item.query, item.params)
+                    rows = cursor.fetchall()
+            elif isinstance(item, Stream):
+                stream = stack.enter_context(ExitStack())
+                stream_cursor = stream.enter_context(
+                    postgres_to_es.utils.open_cursor(conn, item.name),
+                )
+                stream_cursor.execute(item.query, item.params)
+                streams[item.name] = (
+                    stream,
+                    postgres_to_es.utils.iter_chunks(
+                        stream_cursor,
+                        APP_CONFIG.chunk_size,
+                    ),
+                )
+            elif isinstance(item, Fetch):
+                rows = next(streams[item.name][1], [])
+                if not rows:
+                    streams.pop(item.name)[0].close()
+            else:
+                yield item
+
 
 def extract_postgres(
-    timestamp: str | None,
-) -> Iterator[tuple[postgres_to_es.models.MovieDocument, ...]]:
+    state: postgres_to_es.state_.State,
+) -> Iterator[tuple[ModelsChunk, Checkpoint]]:
     """Extract records from PostgreSQL.
 
-    Retrieves all records that were modified after timestamp.
+    Args:
+        state: Persistent state storage with checkpoint of each entity.
+
+    Returns:
+        An iterator of tuples of documents and checkpoints to save after
+        successful loading of these documents, see get_extraction_steps().
+    """
+    return run_steps(get_extraction_steps(state))
+
+
+def _get_modified_queries() -> dict[str, str]:
+    """Return keyset queries of changed records by entity, tombstones included."""
+    queries = {
+        entity: postgres_to_es.utils.get_modified_query(entity) for entity in ENTITIES
+    }
+    queries[TOMBSTONE] = postgres_to_es.utils.get_tombstone_query()
+    queries[PERSON_LINK_TOMBSTONE] = (
+        postgres_to_es.utils.get_person_link_tombstone_query()
+    )
+    return queries
+
+
+def _parse_keyset(keyset: Keyset) -> tuple[datetime.datetime, str]:
+    """Return keyset with modified as aware datetime, so keysets are comparable."""
+    modified = datetime.datetime.fromisoformat(keyset[0])
+    if modified.tzinfo is None:
+        modified = modified.replace(tzinfo=datetime.timezone.utc)
+    return modified, keyset[1]
+
+
+def _get_index_keysets(
+    state: postgres_to_es.state_.State,
+) -> dict[str, dict[str, Keyset]]:
+    """Return keysets of entities by index from state."""
+    return {
+        index_name: {
+            entity: _get_keyset(state, entity, index_name) for entity in entities
+        }
+        for index_name, entities in get_index_entities().items()
+    }
+
+
+def _get_scan_keysets(
+    index_keysets: dict[str, dict[str, Keyset]],
+) -> dict[str, Keyset]:
+    """Return the earliest keyset of each entity among indices.
+
+    Each table is scanned once for all indices, starting from the earliest
+    checkpoint.
+    """
+    keysets: dict[str, Keyset] = {}
+    for entity_keysets in index_keysets.values():
+        for entity, keyset in entity_keysets.items():
+            if entity not in keysets or _parse_keyset(keyset) < _parse_keyset(
+                keysets[entity],
+            ):
+                keysets[entity] = keyset
+    return keysets
+
+
+def _advance_keysets(
+    keysets: dict[str, Keyset],
+    changed: dict[str, list[Any]],
+) -> None:
+    """Move scan keysets to last changed records.
+
+    Keysets of exhausted entities are removed, so they are not queried again
+    in this round.
 
     Args:
-        timestamp: A timestamp after which to retrieve records. If None, datetime.min
-        used instead. Format of timestamp must be accepted by PostgreSQL.
+        keysets: Keysets of entities, which are not exhausted yet.
+        changed: Records changed after keysets by entity.
+    """
+    for entity, rows in changed.items():
+        if rows:
+            last = rows[-1]
+            keysets[entity] = (last["modified"].isoformat(), last["id"])
+        if len(rows) < APP_CONFIG.chunk_size:
+            # entity is exhausted in this round
+            del keysets[entity]
 
-    Yields:
-        A tuple of pydantic models. Tuple contains at most APP_CONFIG.chunk_size
-        elements.
+
+def _split_changed(
+    index_keysets: dict[str, dict[str, Keyset]],
+    changed: dict[str, list[Any]],
+) -> tuple[dict[str, dict[str, list[str]]], Checkpoint]:
+    """Select records changed after checkpoints of each index.
+
+    Checkpoints of indices are moved to last changed records.
+
+    Args:
+        index_keysets: Keysets of entities by index.
+        changed: Records changed after scan keysets by entity.
+
+    Returns:
+        Ids of changed records by entity by index and checkpoints by state key.
     """
-    if timestamp is None:
-        timestamp = datetime.datetime.min.isoformat()
+    changed_ids: dict[str, dict[str, list[str]]] = {}
+    checkpoint = {}
+    for index_name, keysets in index_keysets.items():
+        changed_ids[index_name] = {}
+        for entity, keyset in keysets.items():
+            after = _parse_keyset(keyset)
+            rows = [
+                row
+                for row in changed.get(entity, ())
+                if (row["modified"], row["id"]) > after
+            ]
+            changed_ids[index_name][entity] = [row["id"] for row in rows]
+            if rows:
+                # each checkpoint points exactly to last extracted record, so
+                # restart resumes right after it
+                last = rows[-1]
+                keysets[entity] = (last["modified"].isoformat(), last["id"])
+                checkpoint[get_state_key(entity, index_name)] = list(keysets[entity])
+    return changed_ids, checkpoint
+
+
+def _get_persons_genres_ids(
+    changed_ids: dict[str, dict[str, list[str]]],
+) -> dict[str, list[str]]:
+    """Return ids changed after checkpoints of indices of persons and genres."""
+    persons = changed_ids.get(APP_CONFIG.es_persons_index_name, {})
+    genres = changed_ids.get(APP_CONFIG.es_genres_index_name, {})
+    return {
+        "person": persons.get("person", []),
+        "film_work": persons.get("film_work", []),
+        UNLINKED_PERSONS: persons.get(PERSON_LINK_TOMBSTONE, []),
+        "genre": genres.get("genre", []),
+    }
 
-    query = postgres_to_es.utils.get_query(timestamp)
+
+def get_seconds_behind(state: postgres_to_es.state_.State) -> float:
+    """Return age of the oldest change not loaded yet.
+
+    Change is not loaded yet, if it is after checkpoint in state or, with
+    outbox, if it is still in outbox.
+
+    Args:
+        state: Persistent state storage with checkpoint of each entity.
+
+    Returns:
+        Seconds by clock of PostgreSQL, 0 if all changes are loaded.
+    """
     with closing(postgres_to_es.utils.get_postgres_connection()) as conn:
         with conn.cursor() as cursor:
-            cursor.execute(query)
-            while rows := cursor.fetchmany(APP_CONFIG.chunk_size):
-                try:
-                    yield tuple(
-                        postgres_to_es.models.MovieDocument(**row) for row in rows
-                    )
-                except pydantic.ValidationError:
-                    logger.exception(
-                        "Error on validation. Check definitions of model and SQL query.",
-                    )
+            cursor.execute("SELECT now()")
+            now = cursor.fetchone()[0]
+            if APP_CONFIG.change_source == "outbox":
+                cursor.execute("SELECT min(created) FROM search_outbox")
+                oldest = [cursor.fetchone()[0]]
+            else:
+                queries = _get_modified_queries()
+                keysets = _get_scan_keysets(_get_index_keysets(state))
+                oldest = []
+                for entity, keyset in keysets.items():
+                    cursor.execute(queries[entity], (*keyset, 1))
+                    oldest.extend(row["modified"] for row in cursor.fetchall())
+    oldest = [modified for modified in oldest if modified is not None]
+    if not oldest:
+        return 0
+    return max((now - min(oldest)).total_seconds(), 0)
+
+
+def extract_modified(
+    state: postgres_to_es.state_.State,
+) -> Iterator[tuple[ModelsChunk, Checkpoint]]:
+    """Extract records modified after checkpoints from PostgreSQL.
+
+    Args:
+        state: Persistent state storage with checkpoint of each entity.
+
+    Returns:
+        An iterator of tuples of documents and checkpoints to save after
+        successful loading of these documents, see _extract_modified().
+    """
+    return run_steps(_extract_modified(state))
+
+
+def _extract_modified(state: postgres_to_es.state_.State) -> Steps:
+    """Extract records modified after checkpoints.
+
+    Changes are detected in stages. Ids of changed film_works, persons and genres
+    are found by their own (modified, id) index using keyset pagination, so each
+    chunk is a cheap index range scan. Then persons and genres are mapped
+    to affected film_works through link tables. Only affected film_works are
+    extracted with all related data. Deleted film_works are found the same way
+    in tombstone table.
+
+    Each table is scanned once for all indices, but each index keeps own
+    checkpoints and gets only records changed after them. Documents of persons
+    and genres are extracted from the same changed records.
+
+    Args:
+        state: Persistent state storage with checkpoint of each entity.
+
+    Yields:
+        Requests of rows and a tuple of documents with checkpoints to save
+        after successful loading of these documents. Tuple contains at most
+        APP_CONFIG.chunk_size elements.
+    """
+    queries = _get_modified_queries()
+    index_keysets = _get_index_keysets(state)
+    keysets = _get_scan_keysets(index_keysets)
+    while keysets:
+        changed = {}
+        for entity, (modified, id_) in keysets.items():
+            changed[entity] = yield Query(
+                queries[entity],
+                (modified, id_, APP_CONFIG.chunk_size),
+            )
+
+        _advance_keysets(keysets, changed)
+        if not any(changed.values()):
+            break
+
+        changed_ids, checkpoint = _split_changed(index_keysets, changed)
+        movies_ids = changed_ids[APP_CONFIG.es_index_name]
+        yield from _with_checkpoint(
+            _chain(
+                _extract_deleted(movies_ids[TOMBSTONE]),
+                _enrich({entity: movies_ids[entity] for entity in ENTITIES}),
+                _enrich_persons_genres(_get_persons_genres_ids(changed_ids)),
+            ),
+            checkpoint,
+        )
+
+
+def get_changed_steps(changed_ids: dict[str, set[str]]) -> Steps:
+    """Extract documents affected by known changed records.
+
+    Used when changes are notified by PostgreSQL, so checkpoints are not
+    advanced.
+
+    Args:
+        changed_ids: Changed ids by entity.
+
+    Yields:
+        Requests of rows and a tuple of documents with empty checkpoints. Tuple
+        contains at most APP_CONFIG.chunk_size elements.
+    """
+    ids = {
+        entity: list(changed_ids.get(entity, ()))
+        for entity in (*ENTITIES, UNLINKED_PERSONS)
+    }
+    steps = _chain(
+        _extract_deleted(ids["film_work"]),
+        _enrich(ids),
+        _enrich_persons_genres(ids),
+    )
+    rows = None
+    while True:
+        try:
+            item = steps.send(rows)
+        except StopIteration:
+            return
+        if isinstance(item, (Query, Stream, Fetch)):
+            rows = yield item
+        else:
+            rows = None
+            yield item, {}
+
+
+def extract_film_works(
+    state: postgres_to_es.state_.State,
+    lower: str = MIN_ID,
+    upper: str = MAX_ID,
+) -> Iterator[tuple[ModelsChunk, Checkpoint]]:
+    """Extract all film_works with ids in range from PostgreSQL.
+
+    Used for full reindex, film_works are paginated by primary key and id of
+    last extracted film_work is saved as checkpoint.
+
+    Args:
+        state: Persistent state storage with checkpoint of range.
+        lower: Lower bound of ids, exclusive.
+        upper: Upper bound of ids, inclusive.
+
+    Returns:
+        An iterator of tuples of documents and checkpoints to save after
+        successful loading of these documents. Tuple contains at most
+        APP_CONFIG.chunk_size elements.
+    """
+    state_key = get_state_key("film_work")
+    return run_steps(
+        _extract_film_works(state_key, state.get_value(state_key) or lower, upper),
+    )
+
+
+def _extract_film_works(state_key: str, last_id: str, upper: str) -> Steps:
+    """Extract film_works with ids after last_id up to upper.
+
+    Args:
+        state_key: Key of checkpoint of range in state.
+        last_id: Id of last loaded film_work.
+        upper: Upper bound of ids, inclusive.
+
+    Yields:
+        Requests of rows and a tuple of documents with checkpoint.
+    """
+    while True:
+        rows = yield Query(
+            postgres_to_es.utils.get_film_work_range_query(),
+            (last_id, upper, APP_CONFIG.chunk_size),
+        )
+        ids = [row["id"] for row in rows]
+        if not ids:
+            break
+        last_id = ids[-1]
+        yield from _with_checkpoint(
+            _enrich({"film_work": ids, "person": [], "genre": []}),
+            {state_key: last_id},
+        )
@@ -0,0 +1,191 @@
+"""Leasing of outbox shards between several ETL workers.
+
+Records of outbox are split into APP_CONFIG.lease_shards shards, see
+utils.get_outbox_shard_query(), and worker reads only records of shards it
+leases, so several workers share changes without duplicating each other.
+
+Workers register themselves in table etl_worker and lease shards through rows of
+table etl_lease. At start of each round worker takes its fair share of shards,
+i.e. total number of shards divided by number of live workers, and releases
+shards above it, so started worker takes over part of shards of others. Heartbeat
+thread renews registration and leases every third of APP_CONFIG.lease_ttl, leases
+of dead worker expire and are taken by other workers.
+"""
+import logging
+import math
+import os
+import socket
+import threading
+from typing import Any
+
+import backoff
+from psycopg2.extensions import connection
+
+import postgres_to_es.metrics
+import postgres_to_es.utils
+from postgres_to_es.settings import APP_CONFIG, backoff_exceptions, get_backoff_config
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _reset_connection(details: dict[str, Any]) -> None:
+    """Close connection of lease manager, whose method is retried by backoff."""
+    details["args"][0].reset_connection()
+
+
+class LeaseManager:
+    """Leases of outbox shards held by this worker."""
+
+    def __init__(self, shards: int, ttl: float, worker_id: str):
+        """Initialize manager. Tables are created on first access.
+
+        Args:
+            shards: Total number of shards, the same for all workers.
+            ttl: Seconds after which lease not renewed by worker expires.
+            worker_id: Unique id of worker.
+        """
+        self._total = shards
+        self._ttl = ttl
+        self._worker_id = worker_id
+        self._shards: frozenset[int] = frozenset()
+        self._conn: connection | None = None
+        # connection is shared by heartbeat thread and ETL round
+        self._lock = threading.Lock()
+        self._heartbeat: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    @property
+    def total(self) -> int:
+        """Total number of shards."""
+        return self._total
+
+    @property
+    def shards(self) -> list[int]:
+        """Shards leased by this worker."""
+        return sorted(self._shards)
+
+    def _get_connection(self) -> connection:
+        if self._conn is None or self._conn.closed:
+            self._conn = postgres_to_es.utils.get_postgres_connection()
+            with self._conn.cursor() as cursor:
+                cursor.execute(
+                    postgres_to_es.utils.get_lease_tables_query(),
+                    (self._total,),
+                )
+        return self._conn
+
+    def reset_connection(self) -> None:
+        """Close connection, new one is opened on next access."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _renew(self) -> None:
+        """Renew registration of worker and its leases, forget expired leases."""
+        with self._get_connection().cursor() as cursor:
+            cursor.execute(
+                """
+INSERT INTO etl_worker (worker, expires)
+VALUES (%(worker)s, now() + %(ttl)s * interval '1 second')
+ON CONFLICT (worker) DO UPDATE SET expires = EXCLUDED.expires
+""",
+                {"worker": self._worker_id, "ttl": self._ttl},
+            )
+            cursor.execute(
+                """
+UPDATE etl_lease
+SET expires = now() + %(ttl)s * interval '1 second'
+WHERE worker = %(worker)s AND expires > now()
+RETURNING shard
+""",
+                {"worker": self._worker_id, "ttl": self._ttl},
+            )
+            shards = frozenset(row["shard"] for row in cursor.fetchall())
+        if self._shards - shards:
+            logger.warning("Leases of shards %s expired", sorted(self._shards - shards))
+        self._shards = shards
+
+    @backoff.on_exception(**get_backoff_config(_reset_connection))
+    def acquire(self) -> list[int]:
+        """Renew leases and lease fair share of shards.
+
+        Called at start of each ETL round, also starts heartbeat.
+
+        Returns:
+            Shards leased by this worker.
+        """
+        with self._lock:
+            self._renew()
+            with self._get_connection().cursor() as cursor:
+                cursor.execute("DELETE FROM etl_worker WHERE expires < now()")
+                cursor.execute("SELECT count(*) FROM etl_worker")
+                share = math.ceil(self._total / cursor.fetchone()[0])
+                if len(self._shards) > share:
+                    released = self.shards[share:]
+                    cursor.execute(
+                        "UPDATE etl_lease SET worker = NULL, expires = '-infinity' "
+                        "WHERE worker = %s AND shard = ANY(%s)",
+                        (self._worker_id, released),
+                    )
+                    self._shards -= set(released)
+                    logger.info("Released shards %s", released)
+                elif len(self._shards) < share:
+                    cursor.execute(
+                        postgres_to_es.utils.get_lease_acquire_query(),
+                        {
+                            "worker": self._worker_id,
+                            "ttl": self._ttl,
+                            "shards": self._total,
+                            "limit": share - len(self._shards),
+                        },
+                    )
+                    acquired = [row["shard"] for row in cursor.fetchall()]
+                    if acquired:
+                        self._shards |= set(acquired)
+                        logger.info("Leased shards %s", acquired)
+
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._run_heartbeat, daemon=True)
+            self._heartbeat.start()
+        return self.shards
+
+    def _run_heartbeat(self) -> None:
+        while not self._stopped.wait(self._ttl / 3):
+            with self._lock:
+                try:
+                    self._renew()
+                except backoff_exceptions as error:
+                    logger.warning("Couldn't renew leases: %s", error)
+                    self.reset_connection()
+
+    def release(self) -> None:
+        """Stop heartbeat and release all leases, e.g. on shutdown."""
+        self._stopped.set()
+        with self._lock:
+            try:
+                with self._get_connection().cursor() as cursor:
+                    cursor.execute(
+                        "UPDATE etl_lease SET worker = NULL, expires = '-infinity' "
+                        "WHERE worker = %s",
+                        (self._worker_id,),
+                    )
+                    cursor.execute(
+                        "DELETE FROM etl_worker WHERE worker = %s",
+                        (self._worker_id,),
+                    )
+            except backoff_exceptions as error:
+                logger.warning("Couldn't release leases, they will expire: %s", error)
+            finally:
+                self._shards = frozenset()
+                self.reset_connection()
+
+
+LEASES = (
+    LeaseManager(APP_CONFIG.lease_shards, APP_CONFIG.lease_ttl, WORKER_ID)
+    if APP_CONFIG.lease_shards
+    else None
+)
+if LEASES is not None:
+    postgres_to_es.metrics.LEASED_SHARDS.set_function(lambda: len(LEASES.shards))
@@ -0,0 +1,114 @@
+"""Near real-time ETL driven by PostgreSQL notifications.
+
+Triggers on content tables notify channel content_changes with payload
+"entity:id". Listener waits for notifications, coalesces bursts of them and
+loads only affected documents by the same engine as polling rounds. Regular
+polling ETL round still runs every APP_CONFIG.etl_interval seconds as a safety
+net for missed notifications.
+"""
+import collections
+import logging
+import select
+import time
+from contextlib import closing
+from typing import Callable
+
+import backoff
+from psycopg2.extensions import connection
+
+import postgres_to_es.leases
+import postgres_to_es.scheduler
+import postgres_to_es.state_
+import postgres_to_es.utils
+from postgres_to_es.settings import APP_CONFIG, BACKOFF_CONFIG
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "content_changes"
+
+ChangedIds = dict[str, set[str]]
+
+
+def _is_readable(conn: connection, timeout: float) -> bool:
+    """Wait until connection has data to read or timeout expires."""
+    return select.select([conn], [], [], max(timeout, 0)) != ([], [], [])
+
+
+def _collect_notifications(conn: connection, changed_ids: ChangedIds) -> None:
+    """Move received notifications into changed ids."""
+    conn.poll()
+    while conn.notifies:
+        notification = conn.notifies.pop(0)
+        entity, _, id_ = notification.payload.partition(":")
+        changed_ids[entity].add(id_)
+
+
+def wait_changes(conn: connection, timeout: float) -> ChangedIds:
+    """Wait for notifications about changes.
+
+    After first notification waits for more of them, until there are no new
+    notifications in APP_CONFIG.notify_debounce seconds, but at most
+    APP_CONFIG.notify_max_delay seconds. So burst of changes is loaded at once.
+
+    Args:
+        conn: PostgreSQL connection listening CHANNEL.
+        timeout: Maximum time to wait for first notification in seconds.
+
+    Returns:
+        Changed ids by entity, empty if there were no notifications.
+    """
+    changed_ids: ChangedIds = collections.defaultdict(set)
+    if not _is_readable(conn, timeout):
+        return changed_ids
+
+    deadline = time.monotonic() + APP_CONFIG.notify_max_delay
+    while True:
+        _collect_notifications(conn, changed_ids)
+        remaining = min(APP_CONFIG.notify_debounce, deadline - time.monotonic())
+        if remaining <= 0 or not _is_readable(conn, remaining):
+            return changed_ids
+
+
+def listen(
+    state: postgres_to_es.state_.State,
+    poll: Callable[[postgres_to_es.state_.State], None],
+    load: Callable[[postgres_to_es.state_.State, ChangedIds], None],
+) -> None:
+    """Load changes as soon as they are notified.
+
+    Runs polling round on start, because notifications could be missed while
+    listener wasn't connected, and then every APP_CONFIG.etl_interval seconds.
+    Both polling rounds and loading of notified changes are paused while
+    Elasticsearch is overloaded, see scheduler.pause_if_overloaded(). Uses
+    backoff to reconnect on errors.
+
+    Args:
+        state: Persistent state storage.
+        poll: Function running regular polling ETL round.
+        load: Function loading documents affected by notified changes.
+    """
+    detector = postgres_to_es.scheduler.OverloadDetector()
+    with closing(postgres_to_es.utils.get_postgres_connection()) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+
+        next_poll = time.monotonic()
+        while True:
+            if time.monotonic() >= next_poll:
+                if postgres_to_es.scheduler.pause_if_overloaded(detector):
+                    continue
+                logger.debug("Start polling ETL round")
+                poll(state)
+                next_poll = time.monotonic() + APP_CONFIG.etl_interval
+            changed_ids = wait_changes(conn, next_poll - time.monotonic())
+            if not changed_ids:
+                continue
+            while postgres_to_es.scheduler.pause_if_overloaded(detector):
+                # notified changes are loaded after pause
+                pass
+            if postgres_to_es.leases.LEASES is None:
+                load(state, changed_ids)
+            else:
+                # notifications are received by all workers, so each of them
+                # loads changes of own shards from outbox
+                poll(state)
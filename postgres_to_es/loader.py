@@ -1,46 +1,290 @@
-import datetime
+import http
 import logging
-from contextlib import closing
+import sys
+import time
 from typing import Any, Iterator
 
 import backoff
-from elasticsearch import helpers
+from elasticsearch import AsyncElasticsearch, Elasticsearch, helpers
 
+import postgres_to_es.bulk_sizing
+import postgres_to_es.dead_letter
+import postgres_to_es.digests
+import postgres_to_es.extractor
+import postgres_to_es.metrics
 import postgres_to_es.state_
+import postgres_to_es.transformer
 import postgres_to_es.utils
-from postgres_to_es.settings import APP_CONFIG, BACKOFF_CONFIG
+from postgres_to_es.settings import APP_CONFIG, get_backoff_config
 
 logger = logging.getLogger(__name__)
 
-ESActions = Iterator[dict[str, Any]]
+ESActions = postgres_to_es.transformer.ESActions
 
-DELTA = datetime.timedelta(milliseconds=1)
 
+def serialize(
+    client: Elasticsearch | AsyncElasticsearch,
+    actions: ESActions,
+) -> tuple[ESActions, dict[str, int]]:
+    """Serialize sources of actions by serializer of client.
 
-@backoff.on_exception(**BACKOFF_CONFIG)
-def _load_bulk(actions: ESActions) -> int:
+    Sources are serialized once, so their size is known before splitting
+    actions into bulk requests. Partial documents of update actions are only
+    measured, bulk helpers require them to be dicts.
+
+    Args:
+        client: Elasticsearch client.
+        actions: A list of documents.
+
+    Returns:
+        Serialized actions and size of serialized sources by document id.
+    """
+    sizes = {}
+    serialized = []
+    for action in actions:
+        if "_source" in action:
+            source = client.transport.serializers.dumps(action["_source"])
+            sizes[str(action["_id"])] = len(source)
+            action = {**action, "_source": source}
+        elif "doc" in action:
+            sizes[str(action["_id"])] = len(
+                client.transport.serializers.dumps(action["doc"]),
+            )
+        serialized.append(action)
+    return serialized, sizes
+
+
+def get_bulk_options(actions: ESActions) -> dict[str, Any]:
+    """Return options of bulk helpers sending actions in single bulk request."""
+    return {
+        # actions are already split by bulk sizer
+        "chunk_size": len(actions),
+        "max_chunk_bytes": sys.maxsize,
+        "raise_on_error": False,
+        "max_retries": APP_CONFIG.bulk_max_retries,
+        "initial_backoff": APP_CONFIG.bulk_initial_backoff,
+        "max_backoff": APP_CONFIG.backoff_interval,
+    }
+
+
+def get_unhandled(actions: ESActions, handled: dict[str, bool]) -> ESActions:
+    """Return actions, whose results are not handled yet."""
+    return [action for action in actions if str(action["_id"]) not in handled]
+
+
+def handle_item(
+    ok: bool,
+    item: dict[str, Any],
+    by_id: dict[str, dict],
+    sizes: dict[str, int],
+    handled: dict[str, bool],
+    rejected: ESActions,
+) -> None:
+    """Handle result of single action of bulk request.
+
+    Original action rejected with 429 is appended to rejected, action rejected
+    because of version conflict is counted, action rejected with other error
+    is saved to dead letter store. Results of other actions than rejected
+    with 429 are added to handled.
+
+    Args:
+        ok: Whether action succeeded.
+        item: Result of action returned by bulk helpers.
+        by_id: Original actions by document id.
+        sizes: Size of serialized sources by document id.
+        handled: Whether document is loaded by id of handled document.
+        rejected: A list of actions rejected with 429.
+    """
+    op_type, result = item.popitem()
+    document_id = str(result["_id"])
+    status = result.get("status")
+    if ok or (
+        op_type in {"delete", "update"} and status == http.HTTPStatus.NOT_FOUND
+    ):
+        # deletion of already absent document is success too, as well as
+        # update of absent document, which is loaded whole when it's created
+        postgres_to_es.metrics.DOCUMENTS.inc(operation=op_type)
+        postgres_to_es.metrics.INDEXED_BYTES.inc(sizes.get(document_id, 0))
+        handled[document_id] = True
+    elif status == http.HTTPStatus.CONFLICT:
+        # newer version of document is already loaded, see external versioning
+        logger.debug("Document %s has newer version in index", document_id)
+        postgres_to_es.metrics.VERSION_CONFLICTS.inc(operation=op_type)
+        handled[document_id] = False
+    elif status == http.HTTPStatus.TOO_MANY_REQUESTS:
+        rejected.append(by_id[document_id])
+    else:
+        logger.error("Document %s rejected: %s", document_id, result)
+        postgres_to_es.metrics.ERRORS.inc(kind="rejected_document")
+        postgres_to_es.dead_letter.DEAD_LETTERS.append(by_id[document_id], result)
+        handled[document_id] = False
+
+
+def record_bulk(
+    actions: ESActions,
+    sizes: dict[str, int],
+    latency: float,
+    rejected: bool,
+) -> None:
+    """Record metrics of bulk request and pass its result to bulk sizer."""
+    size = sum(sizes.get(str(action["_id"]), 0) for action in actions)
+    postgres_to_es.metrics.BULK_SECONDS.observe(latency)
+    postgres_to_es.metrics.BULK_REQUEST_BYTES.observe(size)
+    postgres_to_es.metrics.BULK_REQUEST_DOCUMENTS.observe(len(actions))
+    postgres_to_es.bulk_sizing.BULK_SIZER.record(size, latency, rejected)
+
+
+@backoff.on_exception(
+    **get_backoff_config(postgres_to_es.utils.reset_shared_elasticsearch_client),
+)
+def _send_bulk(
+    actions: ESActions,
+    by_id: dict[str, dict],
+    sizes: dict[str, int],
+    handled: dict[str, bool],
+) -> ESActions:
+    """Send actions in single bulk request.
+
+    Documents rejected with other errors than 429 are saved to dead letter
+    store. Duration of request, including retries of rejected documents
+    by helpers, is recorded by bulk sizer.
+
+    Uses shared client, so connections are reused between requests. Uses
+    backoff to wait until Elasticsearch is available, client is recreated on
+    each retry. Documents handled before error are not sent again, so they
+    are neither loaded nor saved to dead letter store twice.
+
+    Args:
+        actions: Serialized actions.
+        by_id: Original actions by document id.
+        sizes: Size of serialized sources by document id.
+        handled: Whether document is loaded by id of handled document, results
+            of sent actions except rejected with 429 are added to it.
+
+    Returns:
+        Original actions rejected with 429.
+    """
+    client = postgres_to_es.utils.get_shared_elasticsearch_client()
+    actions = get_unhandled(actions, handled)
+    rejected: ESActions = []
+    if not actions:
+        return rejected
+    start = time.perf_counter()
+    for ok, item in helpers.streaming_bulk(
+        client=client,
+        actions=actions,
+        **get_bulk_options(actions),
+    ):
+        handle_item(ok, item, by_id, sizes, handled, rejected)
+    record_bulk(actions, sizes, time.perf_counter() - start, bool(rejected))
+    return rejected
+
+
+def _load_bulk(actions: ESActions) -> list[str]:
     """Bulk load chunk of documents into Elasticsearch.
 
-    Uses backoff to wait until successful loading.
+    Actions may index or delete documents. Chunk is split into bulk requests
+    by size of documents, see bulk_sizing. Errors are handled per document.
+    Documents rejected with 429 Too Many Requests are retried with own backoff
+    until loaded, other rejected documents are saved to dead letter store, so
+    healthy documents are not blocked by them. Deletion of absent document
+    is considered successful.
+
+    Each bulk request is retried by backoff while Elasticsearch is
+    unavailable, see _send_bulk(), so documents of requests sent before error
+    are not sent again.
 
     Args:
-        actions: A iterator of documents to load.
+        actions: A list of documents to load.
 
     Returns:
-        Number of loaded documents
+        Ids of loaded documents.
     """
-    with closing(postgres_to_es.utils.get_elasticsearch_client()) as es:
-        successes, _ = helpers.bulk(
-            client=es,
-            actions=actions,
-            chunk_size=APP_CONFIG.chunk_size,
-        )
-    return successes
+    client = postgres_to_es.utils.get_shared_elasticsearch_client()
+    handled: dict[str, bool] = {}
+    while actions:
+        by_id = {str(action["_id"]): action for action in actions}
+        serialized, sizes = serialize(client, actions)
+        rejected = []
+        for batch in postgres_to_es.bulk_sizing.BULK_SIZER.split(
+            serialized,
+            [sizes.get(str(action["_id"]), 0) for action in serialized],
+        ):
+            rejected.extend(_send_bulk(batch, by_id, sizes, handled))
+
+        if rejected:
+            logger.warning(
+                "%s documents still rejected with 429, retry them",
+                len(rejected),
+            )
+            time.sleep(APP_CONFIG.backoff_interval)
+        actions = rejected
+    return [document_id for document_id, loaded in handled.items() if loaded]
+
+
+def get_stale_digest_ids(actions: ESActions) -> list[str]:
+    """Return ids of deleted or partially updated documents."""
+    return [
+        action["_id"]
+        for action in actions
+        if action.get("_op_type") in {"delete", "update"}
+    ]
+
+
+def load_chunk(
+    actions: ESActions,
+    suppress_unchanged: bool = APP_CONFIG.suppress_unchanged,
+) -> int:
+    """Load chunk of documents into Elasticsearch.
+
+    If suppression of unchanged documents is enabled, documents are loaded only
+    if their source differs from previously loaded one. Deletions and partial
+    updates are never suppressed, digests of their documents are discarded.
+    Digests are saved only for loaded documents, so documents rejected by
+    Elasticsearch are not suppressed when they are extracted again.
+
+    Args:
+        actions: A list of documents to load.
+        suppress_unchanged: Whether to skip unchanged documents. Defaults to
+            value from settings.
+
+    Returns:
+        Number of loaded and deleted documents
+    """
+    deleted_ids = [
+        action["_id"] for action in actions if action.get("_op_type") == "delete"
+    ]
+    if not suppress_unchanged:
+        loaded_ids = _load_bulk(actions) if actions else []
+    else:
+        store = postgres_to_es.digests.DIGESTS
+        actions, digests = store.suppress_unchanged(actions)
+        loaded_ids = _load_bulk(actions) if actions else []
+        store.save(digests, loaded_ids)
+        store.discard(get_stale_digest_ids(actions))
+    if deleted_ids:
+        logger.info("Deleted %s documents from elasticsearch", len(deleted_ids))
+    return len(loaded_ids)
+
+
+def save_checkpoint(
+    state: postgres_to_es.state_.State,
+    checkpoint: postgres_to_es.extractor.Checkpoint,
+) -> None:
+    """Save checkpoints of loaded chunk in state or acknowledge outbox records."""
+    for key, value in checkpoint.items():
+        if key == postgres_to_es.extractor.OUTBOX_ACK_KEY:
+            postgres_to_es.extractor.acknowledge_outbox(value)
+        else:
+            state.set_value(key, value)
 
 
 def load_elastic(
     state: postgres_to_es.state_.State,
-    documents_generator: Iterator[tuple[ESActions, datetime.datetime]],
+    documents_generator: Iterator[
+        tuple[ESActions, postgres_to_es.extractor.Checkpoint]
+    ],
+    suppress_unchanged: bool = APP_CONFIG.suppress_unchanged,
 ) -> None:
     """Load documents into elasticsearch.
 
@@ -49,20 +293,13 @@ def load_elastic(
 
     Args:
         state: Persistent state storage.
-        documents_generator: An iterator containing generator of documents and
-            datetime to save in case of successful loading.
+        documents_generator: An iterator containing list of documents and
+            checkpoints to save in case of successful loading.
+        suppress_unchanged: Whether to skip unchanged documents. Defaults to
+            value from settings.
     """
-    # There could be a lot of documents with same datetime so save a little lower
-    # datetime for each chunk. If there was error in document generator then
-    # ETL would restart from that lower datetime and re pickup documents with same
-    # datetime. As for documents with different datetime, if there was error then
-    # ETL would re pickup only documents that were modified in small interval.
-    last_modified = None
-    for actions, last_modified in documents_generator:
-        loaded = _load_bulk(actions)
-        state.set_value(APP_CONFIG.es_index_name, (last_modified - DELTA).isoformat())
-        logger.info("Loaded %s documents into elasticsearch", loaded)
-
-    # Save actual datetime after loading of all chunks
-    if last_modified is not None:
-        state.set_value(APP_CONFIG.es_index_name, last_modified.isoformat())
+    for actions, checkpoint in documents_generator:
+        if actions:
+            loaded = load_chunk(actions, suppress_unchanged)
+            logger.info("Loaded %s documents into elasticsearch", loaded)
+        save_checkpoint(state, checkpoint)
@@ -1,11 +1,21 @@
+import argparse
+import asyncio
 import logging
 import time
+from pathlib import Path
 
 import backoff
 
+import postgres_to_es.async_engine
 import postgres_to_es.extractor
+import postgres_to_es.leases
+import postgres_to_es.listener
 import postgres_to_es.loader
 import postgres_to_es.logging_config
+import postgres_to_es.metrics
+import postgres_to_es.pipeline
+import postgres_to_es.profiling
+import postgres_to_es.scheduler
 import postgres_to_es.state_
 import postgres_to_es.transformer
 import postgres_to_es.utils
@@ -13,6 +23,47 @@ from postgres_to_es.settings import APP_CONFIG, BACKOFF_CONFIG
 
 logger = logging.getLogger(__name__)
 
+# lag behind PostgreSQL measured after last round and monotonic time of
+# measurement, so scrapes of metrics never query PostgreSQL
+_lag: tuple[float, float] | None = None
+
+
+def _measure_lag(state: postgres_to_es.state_.State) -> None:
+    """Measure lag behind PostgreSQL for metrics, see get_seconds_behind()."""
+    global _lag
+    _lag = (postgres_to_es.extractor.get_seconds_behind(state), time.monotonic())
+
+
+def _get_lag() -> float | None:
+    """Return lag measured after last round, None before first round.
+
+    While rounds fail, e.g. when PostgreSQL is down, lag is not measured, so
+    changes not loaded at last measurement keep aging by time since it.
+    """
+    if _lag is None:
+        return None
+    seconds, measured_at = _lag
+    if not seconds:
+        return 0
+    return seconds + time.monotonic() - measured_at
+
+
+def _run_engine(
+    state: postgres_to_es.state_.State,
+    steps: postgres_to_es.extractor.Steps,
+) -> None:
+    """Load documents extracted by steps with APP_CONFIG.etl_engine."""
+    if APP_CONFIG.etl_engine == "pipeline":
+        postgres_to_es.pipeline.run_pipeline(state, steps)
+    elif APP_CONFIG.etl_engine == "async":
+        asyncio.run(postgres_to_es.async_engine.run_async(state, steps))
+    else:
+        records_generator = postgres_to_es.extractor.run_steps(steps)
+        documents_generator = postgres_to_es.transformer.transform(
+            records_generator,
+        )
+        postgres_to_es.loader.load_elastic(state, documents_generator)
+
 
 @backoff.on_exception(**BACKOFF_CONFIG)
 def etl(state: postgres_to_es.state_.State) -> None:
@@ -24,10 +75,30 @@ def etl(state: postgres_to_es.state_.State) -> None:
     Args:
         state: Persistent state storage.
     """
-    timestamp = state.get_value(APP_CONFIG.es_index_name)
-    records_generator = postgres_to_es.extractor.extract_postgres(timestamp)
-    documents_generator = postgres_to_es.transformer.transform(records_generator)
-    postgres_to_es.loader.load_elastic(state, documents_generator)
+    try:
+        if postgres_to_es.leases.LEASES is not None:
+            postgres_to_es.leases.LEASES.acquire()
+        _run_engine(state, postgres_to_es.extractor.get_extraction_steps(state))
+    finally:
+        # state contains only checkpoints of loaded chunks, so it is safe
+        # to save them even after error
+        state.flush()
+    if APP_CONFIG.change_source == "modified":
+        postgres_to_es.extractor.purge_outbox(state)
+    if APP_CONFIG.metrics_port is not None:
+        _measure_lag(state)
+
+
+def load_changed(
+    state: postgres_to_es.state_.State,
+    changed_ids: postgres_to_es.listener.ChangedIds,
+) -> None:
+    """Load documents affected by notified changes with APP_CONFIG.etl_engine."""
+    logger.debug(
+        "Load changes of %s",
+        {entity: len(ids) for entity, ids in changed_ids.items()},
+    )
+    _run_engine(state, postgres_to_es.extractor.get_changed_steps(changed_ids))
 
 
 def main():
@@ -36,16 +107,49 @@ def main():
     Uses backoff to restart on certain exceptions.
     """
     # create State instance once at beginning of process
-    storage = postgres_to_es.state_.JsonFileStorage(APP_CONFIG.json_storage_path)
+    storage = postgres_to_es.state_.get_storage(APP_CONFIG.json_storage_path)
     state = postgres_to_es.state_.State(storage)
 
-    while True:
-        logger.debug("Start ETL round")
-        etl(state)
-        time.sleep(APP_CONFIG.etl_interval)
+    if APP_CONFIG.metrics_port is not None:
+        postgres_to_es.metrics.SECONDS_BEHIND.set_function(_get_lag)
+        postgres_to_es.metrics.start_server(APP_CONFIG.metrics_port)
+
+    try:
+        if APP_CONFIG.listen_notifications:
+            postgres_to_es.listener.listen(state, etl, load_changed)
+        else:
+            postgres_to_es.scheduler.run(state, etl)
+    finally:
+        # shards of stopped worker are taken by others without waiting for
+        # expiration of leases
+        if postgres_to_es.leases.LEASES is not None:
+            postgres_to_es.leases.LEASES.release()
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        metavar="DIRECTORY",
+        help="run rounds with profiling and write results into directory, "
+        "see postgres_to_es.profiling",
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=1,
+        help="number of profiled rounds",
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
+    args = _parse_args()
     postgres_to_es.logging_config.setup_logging()
-    postgres_to_es.utils.create_elasticsearch_index(APP_CONFIG.es_index_name)
-    main()
+    for index_name in postgres_to_es.extractor.get_index_entities():
+        postgres_to_es.utils.create_elasticsearch_index(index_name)
+    if args.profile:
+        postgres_to_es.profiling.profile(args.rounds, args.profile)
+    else:
+        main()
@@ -0,0 +1,318 @@
+"""Metrics of ETL in Prometheus text format.
+
+Metrics are collected in process and served over HTTP by start_server(), only
+standard library is used.
+"""
+import abc
+import bisect
+import http
+import http.server
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in labels)
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric(abc.ABC):
+    """Base of metrics, values are kept by labels."""
+
+    type_ = ""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        """Return lines of metric in text exposition format."""
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_}",
+            *self._render_samples(),
+        ]
+
+    @abc.abstractmethod
+    def _render_samples(self) -> list[str]:
+        """Return lines of samples, values are read under lock of metric."""
+
+
+class Counter(_Metric):
+    """Monotonically increasing value."""
+
+    type_ = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increase value of counter with labels by amount."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Return value of counter with labels."""
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def total(self) -> float:
+        """Return sum of values of counter with all labels."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def _render_samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(labels)} {_format_value(value)}"
+            for labels, value in values
+        ]
+
+
+class Gauge(_Metric):
+    """Value computed by function on every collection.
+
+    Function is called on every scrape, so it must be fast and must not block,
+    e.g. on queries to PostgreSQL. It's called without lock of metric, so it
+    may lock other objects.
+    """
+
+    type_ = "gauge"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._function: Callable[[], float | None] | None = None
+
+    def set_function(self, function: Callable[[], float | None]) -> None:
+        """Set function returning current value or None if it's unknown."""
+        with self._lock:
+            self._function = function
+
+    def _render_samples(self) -> list[str]:
+        with self._lock:
+            function = self._function
+        if function is None:
+            return []
+        try:
+            value = function()
+        except Exception:
+            logger.exception("Couldn't collect metric %s", self.name)
+            return []
+        if value is None:
+            return []
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values by buckets."""
+
+    type_ = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation)
+        self._buckets = (*buckets, float("inf"))
+        self._counts = [0] * len(self._buckets)
+        self._sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Add observed value."""
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @property
+    def sum(self) -> float:
+        """Sum of observed values."""
+        with self._lock:
+            return self._sum
+
+    @property
+    def count(self) -> int:
+        """Number of observed values."""
+        with self._lock:
+            return sum(self._counts)
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """Observe duration of block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def _render_samples(self) -> list[str]:
+        with self._lock:
+            counts = list(self._counts)
+            sum_ = self._sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._buckets, counts):
+            cumulative += count
+            lines.append(
+                f'{self.name}_bucket{{le="{_format_value(bound)}"}} {cumulative}',
+            )
+        lines.append(f"{self.name}_sum {_format_value(sum_)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+EXTRACT_SECONDS = Histogram(
+    "etl_extract_query_seconds",
+    "Time of queries extracting changes and documents from PostgreSQL.",
+)
+TRANSFORM_SECONDS = Histogram(
+    "etl_transform_seconds",
+    "Time of transforming chunk of documents into bulk actions.",
+)
+BULK_SECONDS = Histogram(
+    "etl_bulk_request_seconds",
+    "Time of bulk requests to Elasticsearch.",
+)
+BULK_REQUEST_BYTES = Histogram(
+    "etl_bulk_request_bytes",
+    "Size of sources in bulk requests to Elasticsearch.",
+    buckets=tuple(2**power for power in range(16, 28, 2)),
+)
+BULK_REQUEST_DOCUMENTS = Histogram(
+    "etl_bulk_request_documents",
+    "Number of documents in bulk requests to Elasticsearch.",
+    buckets=(1, 10, 50, 100, 500, 1000, 5000),
+)
+BULK_TARGET_BYTES = Gauge(
+    "etl_bulk_target_bytes",
+    "Current target size of bulk requests, adjusted by their latency.",
+)
+EXTRACTED_DOCUMENTS = Counter(
+    "etl_extracted_documents_total",
+    "Documents extracted from PostgreSQL and transformed into bulk actions.",
+)
+DOCUMENTS = Counter(
+    "etl_documents_total",
+    "Documents successfully indexed or deleted by operation.",
+)
+INDEXED_BYTES = Counter(
+    "etl_indexed_bytes_total",
+    "Size of sources of successfully indexed documents.",
+)
+ERRORS = Counter(
+    "etl_errors_total",
+    "Errors by kind: rejected documents and invalid documents.",
+)
+VERSION_CONFLICTS = Counter(
+    "etl_version_conflicts_total",
+    "Actions skipped by Elasticsearch because newer version is loaded.",
+)
+BACKOFF_RETRIES = Counter(
+    "etl_backoff_retries_total",
+    "Retries of operations failed with connection errors.",
+)
+SECONDS_BEHIND = Gauge(
+    "etl_seconds_behind_postgres",
+    "Age of the oldest change in PostgreSQL not yet loaded into Elasticsearch.",
+)
+ROUND_DELAY = Gauge(
+    "etl_round_delay_seconds",
+    "Delay before next polling round chosen by scheduler.",
+)
+OVERLOAD_PAUSES = Counter(
+    "etl_overload_pauses_total",
+    "Polling rounds skipped because Elasticsearch was overloaded.",
+)
+LEASED_SHARDS = Gauge(
+    "etl_leased_shards",
+    "Outbox shards leased by this worker.",
+)
+
+REGISTRY: tuple[_Metric, ...] = (
+    EXTRACT_SECONDS,
+    TRANSFORM_SECONDS,
+    BULK_SECONDS,
+    BULK_REQUEST_BYTES,
+    BULK_REQUEST_DOCUMENTS,
+    BULK_TARGET_BYTES,
+    EXTRACTED_DOCUMENTS,
+    DOCUMENTS,
+    INDEXED_BYTES,
+    ERRORS,
+    VERSION_CONFLICTS,
+    BACKOFF_RETRIES,
+    SECONDS_BEHIND,
+    ROUND_DELAY,
+    OVERLOAD_PAUSES,
+    LEASED_SHARDS,
+)
+
+
+def count_backoff_retry(details: dict[str, Any]) -> None:
+    """Count retry, used as backoff handler."""
+    BACKOFF_RETRIES.inc(target=details["target"].__name__)
+
+
+def render() -> str:
+    """Return all metrics in Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:  # noqa: N802
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(http.HTTPStatus.NOT_FOUND)
+            return
+        body = render().encode()
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        logger.debug(format, *args)
+
+
+def start_server(port: int) -> http.server.ThreadingHTTPServer:
+    """Serve metrics at /metrics in background thread.
+
+    Args:
+        port: Port to listen on all interfaces.
+
+    Returns:
+        Running server.
+    """
+    server = http.server.ThreadingHTTPServer(("", port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info("Serving metrics on port %s", port)
+    return server
@@ -1,5 +1,6 @@
 import datetime
 import uuid
+from typing import NamedTuple
 
 from pydantic import BaseModel, validator
 
@@ -21,7 +22,68 @@ class MovieDocument(BaseModel):
     actors: list[Person] | None
     writers: list[Person] | None
     modified: datetime.datetime
+    # external version, see utils.VERSION_COLUMN
+    version: int | None = None
 
     @validator("director", "actors_names", "writers_names", pre=True)
     def not_none(cls, v):  # noqa: N805
         return v if v is not None else []
+
+
+class MoviePersons(BaseModel):
+    """Fields of MovieDocument, which depend on persons only.
+
+    Used for partial update of document after renaming of persons.
+    """
+
+    id: uuid.UUID
+    director: list[str]
+    actors_names: list[str]
+    writers_names: list[str]
+    actors: list[Person] | None
+    writers: list[Person] | None
+
+    @validator("director", "actors_names", "writers_names", pre=True)
+    def not_none(cls, v):  # noqa: N805
+        return v if v is not None else []
+
+
+class PersonFilmWork(BaseModel):
+    id: uuid.UUID
+    title: str
+    roles: list[str]
+
+
+class PersonDocument(BaseModel):
+    id: uuid.UUID
+    full_name: str
+    films: list[PersonFilmWork]
+    version: int | None = None
+
+
+class GenreDocument(BaseModel):
+    id: uuid.UUID
+    name: str
+    description: str | None
+    version: int | None = None
+
+
+class RawMovieDocument(NamedTuple):
+    """Document built by PostgreSQL, source is serialized MovieDocument."""
+
+    id: str
+    modified: datetime.datetime
+    source: str
+    version: int | None = None
+
+
+class DeletedDocument(NamedTuple):
+    """Document of deleted record, which should be deleted from index."""
+
+    id: str
+    # time of deletion, None if it is unknown
+    deleted: datetime.datetime | None
+    # table of deleted record, it defines index of document
+    entity: str = "film_work"
+    # None if deletion is found without query of snapshot
+    version: int | None = None
@@ -0,0 +1,153 @@
+"""Pipelined ETL runner.
+
+Extraction, transformation and loading run in separate threads joined by bounded
+queues, so PostgreSQL and Elasticsearch work at the same time. Checkpoints are
+saved in the order of extraction and only after all earlier chunks are loaded.
+"""
+import logging
+import queue
+import threading
+from contextlib import closing
+from typing import Any, Callable, Iterator
+
+import postgres_to_es.extractor
+import postgres_to_es.loader
+import postgres_to_es.state_
+import postgres_to_es.transformer
+from postgres_to_es.settings import APP_CONFIG
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+_POLL_INTERVAL = 0.1
+
+
+class _Stopped(Exception):
+    """Raised inside worker when pipeline is stopped by error in other worker."""
+
+
+class _Pipeline:
+    """Threads and queues of a single ETL round."""
+
+    def __init__(
+        self,
+        state: postgres_to_es.state_.State,
+        steps: postgres_to_es.extractor.Steps,
+    ):
+        self._state = state
+        self._steps = steps
+        self._extracted: queue.Queue = queue.Queue(APP_CONFIG.pipeline_queue_size)
+        self._transformed: queue.Queue = queue.Queue(APP_CONFIG.pipeline_queue_size)
+        self._loaded: queue.Queue = queue.Queue()
+        self._stop = threading.Event()
+        self._errors: list[BaseException] = []
+
+    def run(self) -> None:
+        """Run round and wait for its completion.
+
+        Raises:
+            BaseException: First error raised in any of workers.
+        """
+        workers = [
+            threading.Thread(target=self._worker, args=(self._extract,)),
+            threading.Thread(target=self._worker, args=(self._transform,)),
+        ]
+        workers.extend(
+            threading.Thread(target=self._worker, args=(self._load,))
+            for _ in range(APP_CONFIG.loader_workers)
+        )
+        for worker in workers:
+            worker.start()
+        try:
+            self._commit(workers)
+        finally:
+            self._stop.set()
+            for worker in workers:
+                worker.join()
+        if self._errors:
+            raise self._errors[0]
+
+    def _worker(self, target: Callable[[], None]) -> None:
+        try:
+            target()
+        except _Stopped:
+            pass
+        except BaseException as error:  # noqa: B902
+            self._errors.append(error)
+            self._stop.set()
+
+    def _put(self, target: queue.Queue, item: Any) -> None:
+        while True:
+            if self._stop.is_set():
+                raise _Stopped
+            try:
+                target.put(item, timeout=_POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def _iter(self, source: queue.Queue) -> Iterator[Any]:
+        while True:
+            if self._stop.is_set():
+                raise _Stopped
+            try:
+                item = source.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def _extract(self) -> None:
+        records_generator = postgres_to_es.extractor.run_steps(self._steps)
+        with closing(records_generator):
+            for records in records_generator:
+                self._put(self._extracted, records)
+        self._put(self._extracted, _DONE)
+
+    def _transform(self) -> None:
+        documents_generator = postgres_to_es.transformer.transform(
+            self._iter(self._extracted),
+        )
+        for seq, (actions, checkpoint) in enumerate(documents_generator):
+            self._put(self._transformed, (seq, actions, checkpoint))
+        for _ in range(APP_CONFIG.loader_workers):
+            self._put(self._transformed, _DONE)
+
+    def _load(self) -> None:
+        for seq, actions, checkpoint in self._iter(self._transformed):
+            loaded = postgres_to_es.loader.load_chunk(actions)
+            self._loaded.put((seq, loaded, checkpoint))
+
+    def _commit(self, workers: list[threading.Thread]) -> None:
+        """Save checkpoints of loaded chunks in order of extraction."""
+        pending = {}
+        next_seq = 0
+        while not self._stop.is_set():
+            try:
+                seq, loaded, checkpoint = self._loaded.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    if self._loaded.empty():
+                        return
+                continue
+            pending[seq] = (loaded, checkpoint)
+            while next_seq in pending:
+                loaded, checkpoint = pending.pop(next_seq)
+                if loaded:
+                    logger.info("Loaded %s documents into elasticsearch", loaded)
+                postgres_to_es.loader.save_checkpoint(self._state, checkpoint)
+                next_seq += 1
+
+
+def run_pipeline(
+    state: postgres_to_es.state_.State,
+    steps: postgres_to_es.extractor.Steps,
+) -> None:
+    """Run pipelined ETL round.
+
+    Args:
+        state: Persistent state storage.
+        steps: Extraction steps, see extractor.get_extraction_steps().
+    """
+    _Pipeline(state, steps).run()
@@ -0,0 +1,267 @@
+"""Profiling of ETL rounds.
+
+Regular ETL rounds are run with cProfile and tracemalloc enabled, results are
+written into directory, so they could be attached to performance tickets::
+
+    python main.py --profile profile --rounds 3
+
+Directory contains:
+
+- summary.json - wall and CPU time of each round and of its stages: lease
+  acquiring, extract, including time of queries to PostgreSQL, transform, load
+  and flush of state, as well as time of allocation snapshots, which isn't
+  attributed to any stage;
+- etl.pstats - dump of cProfile, e.g. for ``python -m pstats`` or snakeviz;
+- profile.txt - top functions by cumulative and own time;
+- allocations.txt - top allocation sites at the largest memory usage observed
+  between chunks;
+- explain.txt - ``EXPLAIN (ANALYZE, BUFFERS)`` of query of changes, keyset
+  query or query of outbox depending on APP_CONFIG.change_source, and query
+  of documents.
+
+Rounds are run one stage after another as by sync engine whatever
+APP_CONFIG.etl_engine, so time is attributed to stages exactly and profiler sees
+all work. Checkpoints are saved as in regular rounds.
+"""
+import cProfile
+import io
+import json
+import logging
+import pstats
+import time
+import tracemalloc
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import Any, Iterator, TypeVar
+
+import postgres_to_es.extractor
+import postgres_to_es.leases
+import postgres_to_es.loader
+import postgres_to_es.metrics
+import postgres_to_es.state_
+import postgres_to_es.transformer
+import postgres_to_es.utils
+from postgres_to_es.settings import APP_CONFIG
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+TOP_FUNCTIONS = 50
+TOP_ALLOCATIONS = 30
+TRACEBACK_FRAMES = 10
+# new allocation snapshot is taken when memory usage grows by this factor
+SNAPSHOT_GROWTH = 1.1
+
+
+class _Stage:
+    """Wall and CPU time spent in iterations of generator."""
+
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    @contextmanager
+    def measure(self) -> Iterator[None]:
+        """Measure time of block."""
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.wall += time.perf_counter() - wall_start
+            self.cpu += time.process_time() - cpu_start
+
+    def wrap(self, iterator: Iterator[T]) -> Iterator[T]:
+        """Yield items of iterator, measuring time of producing them."""
+        while True:
+            with self.measure():
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def render(self, minus: tuple["_Stage", ...] = ()) -> dict[str, float]:
+        """Return time of stage without time of nested stages."""
+        return {
+            "wall_seconds": round(self.wall - sum(stage.wall for stage in minus), 3),
+            "cpu_seconds": round(self.cpu - sum(stage.cpu for stage in minus), 3),
+        }
+
+
+class _AllocationTracker:
+    """Snapshots of allocations at the largest observed memory usage."""
+
+    def __init__(self):
+        self.baseline = tracemalloc.take_snapshot()
+        self.snapshot: tracemalloc.Snapshot | None = None
+        self._traced = 0
+
+    def track(self, iterator: Iterator[T], snapshots: _Stage) -> Iterator[T]:
+        """Yield items of iterator, taking snapshot if memory usage grew.
+
+        Time of taking snapshots is measured by snapshots stage, so it's not
+        attributed to stage consuming items.
+        """
+        for item in iterator:
+            with snapshots.measure():
+                traced, _ = tracemalloc.get_traced_memory()
+                if traced > self._traced * SNAPSHOT_GROWTH:
+                    self.snapshot = tracemalloc.take_snapshot()
+                    self._traced = traced
+            yield item
+
+    def render(self) -> str:
+        """Return top allocation sites compared to start of profiling."""
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"traced memory: current {current / 2**20:.1f} MiB, "
+            f"peak {peak / 2**20:.1f} MiB, "
+            f"at snapshot {self._traced / 2**20:.1f} MiB",
+            "",
+        ]
+        if self.snapshot is None:
+            return "\n".join(lines) + "\n"
+        statistics = self.snapshot.compare_to(self.baseline, "lineno")
+        lines.append(f"top {TOP_ALLOCATIONS} allocation sites by size:")
+        lines.extend(str(statistic) for statistic in statistics[:TOP_ALLOCATIONS])
+        for statistic in self.snapshot.compare_to(self.baseline, "traceback")[:3]:
+            lines.extend(["", f"{statistic.size_diff / 2**20:.1f} MiB allocated at:"])
+            lines.extend(statistic.traceback.format())
+        return "\n".join(lines) + "\n"
+
+
+def _run_round(
+    state: postgres_to_es.state_.State,
+    allocations: _AllocationTracker,
+) -> dict[str, Any]:
+    """Run ETL round and measure its stages."""
+    total, lease, extract, transform, snapshots, flush = (_Stage() for _ in range(6))
+    documents_before = postgres_to_es.metrics.DOCUMENTS.total()
+    queries_before = postgres_to_es.metrics.EXTRACT_SECONDS.sum
+    with total.measure():
+        if postgres_to_es.leases.LEASES is not None:
+            with lease.measure():
+                postgres_to_es.leases.LEASES.acquire()
+        try:
+            records = extract.wrap(postgres_to_es.extractor.extract_postgres(state))
+            # transform stage includes extract stage, which it pulls chunks from
+            documents = transform.wrap(postgres_to_es.transformer.transform(records))
+            postgres_to_es.loader.load_elastic(
+                state,
+                allocations.track(documents, snapshots),
+            )
+        finally:
+            with flush.measure():
+                state.flush()
+
+    return {
+        "documents": int(postgres_to_es.metrics.DOCUMENTS.total() - documents_before),
+        **total.render(),
+        "stages": {
+            "lease": lease.render(),
+            "extract": {
+                **extract.render(),
+                "postgres_seconds": round(
+                    postgres_to_es.metrics.EXTRACT_SECONDS.sum - queries_before,
+                    3,
+                ),
+            },
+            "transform": transform.render(minus=(extract,)),
+            # load stage is the rest of round, it pulls chunks through
+            # transform stage and allocation snapshots
+            "load": total.render(minus=(lease, transform, snapshots, flush)),
+            "flush": flush.render(),
+        },
+        "allocation_snapshots": snapshots.render(),
+    }
+
+
+def _render_profile(profiler: cProfile.Profile) -> str:
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(TOP_FUNCTIONS)
+    return stream.getvalue()
+
+
+def _explain(state: postgres_to_es.state_.State) -> str:
+    """Return plans of query of changes and query of documents.
+
+    Query of changes is the first query of extraction in current state, keyset
+    query of film_works from their checkpoint or query of outbox records.
+    Documents are queried for chunk of most recently modified film_works.
+    """
+    steps = postgres_to_es.extractor.get_extraction_steps(state)
+    with closing(steps):
+        changes = next(steps)
+    with closing(postgres_to_es.utils.get_postgres_connection()) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT id FROM film_work ORDER BY modified DESC LIMIT %s",
+                (APP_CONFIG.chunk_size,),
+            )
+            ids = [row["id"] for row in cursor.fetchall()]
+            queries = [
+                (
+                    f"query of changes, {APP_CONFIG.change_source} change source",
+                    changes.query,
+                    changes.params,
+                ),
+                (
+                    f"document query of {len(ids)} film_works",
+                    postgres_to_es.extractor.get_enrich_query(),
+                    (ids,),
+                ),
+            ]
+            sections = []
+            for title, query, params in queries:
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {query}", params)
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+                sections.append(f"-- {title}\n{query.strip()}\n\n{plan}\n")
+    return "\n".join(sections)
+
+
+def profile(rounds: int, directory: Path) -> None:
+    """Run ETL rounds with profiling and write results into directory.
+
+    Args:
+        rounds: Number of rounds to run.
+        directory: Directory for results, created if doesn't exist.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    storage = postgres_to_es.state_.get_storage(APP_CONFIG.json_storage_path)
+    state = postgres_to_es.state_.State(storage)
+    # plan is taken before rounds, which move checkpoint to the end of changes
+    (directory / "explain.txt").write_text(_explain(state))
+
+    tracemalloc.start(TRACEBACK_FRAMES)
+    allocations = _AllocationTracker()
+    profiler = cProfile.Profile()
+    results = []
+    try:
+        for number in range(rounds):
+            logger.info("Start profiled ETL round %s/%s", number + 1, rounds)
+            profiler.enable()
+            try:
+                results.append(_run_round(state, allocations))
+            finally:
+                profiler.disable()
+    finally:
+        if postgres_to_es.leases.LEASES is not None:
+            postgres_to_es.leases.LEASES.release()
+        profiler.dump_stats(directory / "etl.pstats")
+        (directory / "profile.txt").write_text(_render_profile(profiler))
+        (directory / "allocations.txt").write_text(allocations.render())
+        tracemalloc.stop()
+        summary = {
+            "settings": {
+                "chunk_size": APP_CONFIG.chunk_size,
+                "change_source": APP_CONFIG.change_source,
+                "raw_documents": APP_CONFIG.raw_documents,
+                "stream_results": APP_CONFIG.stream_results,
+            },
+            "rounds": results,
+        }
+        (directory / "summary.json").write_text(json.dumps(summary, indent=2) + "\n")
+    logger.info("Profile of %s rounds is written into %s", rounds, directory)
@@ -0,0 +1,279 @@
+"""Zero-downtime full reindex.
+
+All documents are loaded into new versioned index, e.g. movies_v2, created with
+settings optimized for bulk loading. Then serving settings are restored, index
+is force merged and alias movies is atomically switched to it. Changes made
+during reindex are loaded once more after switching.
+
+Film_works are split by id into APP_CONFIG.reindex_shards ranges, each range
+is loaded by separate process. Reindex is resumable, running it again after
+failure continues loading of each range into the same index::
+
+    python reindex.py
+"""
+import logging
+import multiprocessing
+from contextlib import closing
+from typing import Any
+
+from elasticsearch import Elasticsearch
+
+import postgres_to_es.extractor
+import postgres_to_es.loader
+import postgres_to_es.logging_config
+import postgres_to_es.state_
+import postgres_to_es.transformer
+import postgres_to_es.utils
+from postgres_to_es.settings import APP_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# settings of new index during bulk loading
+BULK_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
+# default settings of serving index, if they are not in index definition
+SERVING_SETTINGS = {"refresh_interval": "1s", "number_of_replicas": 1}
+
+FORCE_MERGE_TIMEOUT = 60 * 60
+
+INDEX_KEY = "index"
+STARTED_KEY = "started"
+
+
+def get_index_versions(es: Elasticsearch, alias: str) -> dict[int, str]:
+    """Return existing versioned indices behind alias by version."""
+    pattern = postgres_to_es.utils.get_versioned_index_name(alias, "*")
+    prefix = pattern.rstrip("*")
+    return {
+        int(name.removeprefix(prefix)): name
+        for name in es.indices.get(index=pattern)
+        if name.removeprefix(prefix).isdigit()
+    }
+
+
+def _get_postgres_now() -> str:
+    with closing(postgres_to_es.utils.get_postgres_connection()) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT now()")
+            return cursor.fetchone()[0].isoformat()
+
+
+def _create_index(es: Elasticsearch, alias: str, index: str) -> None:
+    """Create new index with settings for bulk loading."""
+    definition = postgres_to_es.utils.get_index_definition(alias)
+    es.indices.create(
+        index=index,
+        settings={**definition.get("settings", {}), **BULK_SETTINGS},
+        mappings=definition.get("mappings"),
+    )
+    logger.info("Created index %s", index)
+
+
+def _restore_settings(es: Elasticsearch, alias: str, index: str) -> None:
+    """Restore serving settings of index and optimize it for search."""
+    definition_settings = postgres_to_es.utils.get_index_definition(alias).get(
+        "settings",
+        {},
+    )
+    es.indices.put_settings(
+        index=index,
+        settings={
+            key: definition_settings.get(key, default)
+            for key, default in SERVING_SETTINGS.items()
+        },
+    )
+    es.indices.refresh(index=index)
+    es.options(request_timeout=FORCE_MERGE_TIMEOUT).indices.forcemerge(
+        index=index,
+        max_num_segments=1,
+    )
+    logger.info("Restored serving settings of index %s", index)
+
+
+def swap_alias(es: Elasticsearch, alias: str, index: str) -> list[str]:
+    """Atomically point alias to index.
+
+    Concrete index with the name of alias, created by previous versions of ETL,
+    is deleted in the same request.
+
+    Args:
+        es: Elasticsearch client.
+        alias: Name of alias.
+        index: Name of new index.
+
+    Returns:
+        Names of indices, that alias pointed to before.
+    """
+    actions: list[dict[str, Any]] = [{"add": {"index": index, "alias": alias}}]
+    previous = []
+    if es.indices.exists_alias(name=alias):
+        previous = [name for name in es.indices.get_alias(name=alias) if name != index]
+        actions.extend(
+            {"remove": {"index": name, "alias": alias}} for name in previous
+        )
+    elif es.indices.exists(index=alias):
+        actions.append({"remove_index": {"index": alias}})
+    es.indices.update_aliases(actions=actions)
+    logger.info("Alias %s points to index %s", alias, index)
+    return previous
+
+
+def _delete_old_indices(es: Elasticsearch, alias: str, keep: set[str]) -> None:
+    """Delete versioned indices behind alias except ones in keep."""
+    for name in get_index_versions(es, alias).values():
+        if name not in keep:
+            es.indices.delete(index=name)
+            logger.info("Deleted old index %s", name)
+
+
+def _get_shard_state(shard: int) -> postgres_to_es.state_.State:
+    path = APP_CONFIG.reindex_storage_path
+    storage = postgres_to_es.state_.get_storage(
+        path.with_name(f"{path.stem}_shard_{shard}{path.suffix}"),
+    )
+    return postgres_to_es.state_.State(storage)
+
+
+def _load_shard(shard: int, shards: int, index: str) -> int:
+    """Load all film_works of shard into index.
+
+    Runs in separate process with own connections and own state.
+
+    Args:
+        shard: Number of shard, starting from 0.
+        shards: Total number of shards.
+        index: Name of index.
+
+    Returns:
+        Number of loaded documents.
+    """
+    postgres_to_es.logging_config.setup_logging()
+    state = _get_shard_state(shard)
+    lower, upper = postgres_to_es.utils.get_shard_bounds(shard, shards)
+
+    records_generator = postgres_to_es.extractor.extract_film_works(
+        state,
+        lower,
+        upper,
+    )
+    documents_generator = postgres_to_es.transformer.transform(
+        records_generator,
+        index_name=index,
+    )
+    total = 0
+    try:
+        for actions, checkpoint in documents_generator:
+            total += postgres_to_es.loader.load_chunk(
+                actions,
+                suppress_unchanged=False,
+            )
+            postgres_to_es.loader.save_checkpoint(state, checkpoint)
+            logger.info(
+                "Shard %s/%s: loaded %s documents, last id %s",
+                shard + 1,
+                shards,
+                total,
+                checkpoint.get(postgres_to_es.extractor.get_state_key("film_work")),
+            )
+    finally:
+        state.flush()
+    logger.info("Shard %s/%s finished, loaded %s documents", shard + 1, shards, total)
+    return total
+
+
+def _load_shards(index: str, shards: int) -> None:
+    """Load all film_works into index by shards in parallel processes."""
+    if shards == 1:
+        total = _load_shard(0, 1, index)
+    else:
+        # spawn, so children don't inherit connections of parent
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(shards) as pool:
+            total = sum(
+                pool.starmap(
+                    _load_shard,
+                    [(shard, shards, index) for shard in range(shards)],
+                ),
+            )
+    logger.info("Loaded %s documents into index %s", total, index)
+
+    for shard in range(shards):
+        _get_shard_state(shard).clear()
+
+
+def _load(state: postgres_to_es.state_.State, index_name: str) -> None:
+    """Load records modified after checkpoints in state into index."""
+    records_generator = postgres_to_es.extractor.extract_modified(state)
+    documents_generator = postgres_to_es.transformer.transform(
+        records_generator,
+        index_name=index_name,
+    )
+    postgres_to_es.loader.load_elastic(
+        state,
+        documents_generator,
+        suppress_unchanged=False,
+    )
+
+
+def catch_up(
+    state: postgres_to_es.state_.State,
+    started: str,
+    index_name: str = APP_CONFIG.es_index_name,
+) -> None:
+    """Load records changed since start of reindex.
+
+    extract_modified() scans changes of every index, so checkpoints of every
+    entity of every index are set to start of reindex. Otherwise missing
+    checkpoints of indices of persons and genres would rebuild them entirely.
+
+    Args:
+        state: State of reindex, checkpoints are saved in it.
+        started: Start of reindex by clock of PostgreSQL in isoformat.
+        index_name: Name of index or alias to load documents of movies into.
+    """
+    for name, entities in postgres_to_es.extractor.get_index_entities().items():
+        for entity in entities:
+            state.set_value(
+                postgres_to_es.extractor.get_state_key(entity, name),
+                [started, postgres_to_es.extractor.MIN_ID],
+            )
+    _load(state, index_name)
+
+
+def reindex() -> None:
+    """Rebuild index into new version and switch alias to it."""
+    alias = APP_CONFIG.es_index_name
+    storage = postgres_to_es.state_.get_storage(APP_CONFIG.reindex_storage_path)
+    # progress of reindex is saved by few explicit steps, so without coalescing
+    state = postgres_to_es.state_.State(storage, flush_count=1)
+
+    with closing(postgres_to_es.utils.get_elasticsearch_client()) as es:
+        index = state.get_value(INDEX_KEY)
+        if index is None:
+            version = max(get_index_versions(es, alias), default=0) + 1
+            index = postgres_to_es.utils.get_versioned_index_name(alias, version)
+            started = _get_postgres_now()
+            _create_index(es, alias, index)
+            state.set_value(INDEX_KEY, index)
+            state.set_value(STARTED_KEY, started)
+        else:
+            logger.info("Resume reindex into index %s", index)
+        started = state.get_value(STARTED_KEY)
+
+        _load_shards(index, APP_CONFIG.reindex_shards)
+        _restore_settings(es, alias, index)
+        previous = swap_alias(es, alias, index)
+
+        # incremental ETL loads changes into previous index until alias is
+        # switched, so load changes made since start of reindex once more
+        catch_up(state, started, alias)
+
+        # previous index is kept for rollback
+        _delete_old_indices(es, alias, keep={index, *previous})
+
+    state.clear()
+    logger.info("Reindex into index %s finished", index)
+
+
+if __name__ == "__main__":
+    postgres_to_es.logging_config.setup_logging()
+    reindex()
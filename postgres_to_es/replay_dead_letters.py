@@ -0,0 +1,38 @@
+"""Replay of documents permanently rejected by Elasticsearch.
+
+Dead letters are loaded into Elasticsearch again after fixing the cause of
+rejection, e.g. index mapping::
+
+    python -m postgres_to_es.replay_dead_letters
+"""
+import logging
+
+import postgres_to_es.dead_letter
+import postgres_to_es.loader
+import postgres_to_es.logging_config
+
+logger = logging.getLogger(__name__)
+
+
+def replay() -> None:
+    """Load all dead letters into Elasticsearch again.
+
+    Actions that fail again are appended to the end of store. Documents are
+    loaded whether suppression of unchanged documents is enabled or not.
+    """
+    store = postgres_to_es.dead_letter.DEAD_LETTERS
+    records = store.retrieve()
+    if not records:
+        logger.info("No dead letters to replay")
+        return
+    loaded = postgres_to_es.loader.load_chunk(
+        [record["action"] for record in records],
+        suppress_unchanged=False,
+    )
+    store.discard(len(records))
+    logger.info("Replayed %s of %s dead letters", loaded, len(records))
+
+
+if __name__ == "__main__":
+    postgres_to_es.logging_config.setup_logging()
+    replay()
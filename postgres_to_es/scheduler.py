@@ -0,0 +1,184 @@
+"""Adaptive scheduling of polling ETL rounds.
+
+Round drains all changes, so round which extracted at least a full chunk of
+documents means backlog: changes keep coming while round runs. Documents are
+counted when extracted, not when loaded, as unchanged documents and documents
+with version conflicts are skipped by loading, but still take time of round.
+Next round starts immediately after such round, after APP_CONFIG.etl_interval
+seconds after round which extracted less, and each empty round multiplies
+interval by APP_CONFIG.etl_backoff_factor up to APP_CONFIG.etl_max_interval.
+
+Rounds are paused while Elasticsearch is overloaded, i.e. health of indices of
+ETL is red or write thread pool rejected requests since previous check.
+"""
+import logging
+import time
+from typing import Callable
+
+import elastic_transport
+from elasticsearch import ApiError, Elasticsearch
+
+import postgres_to_es.extractor
+import postgres_to_es.metrics
+import postgres_to_es.state_
+import postgres_to_es.utils
+from postgres_to_es.settings import APP_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Interval between rounds adapted to amount of extracted documents."""
+
+    def __init__(
+        self,
+        min_interval: float,
+        max_interval: float,
+        backoff_factor: float,
+        busy_documents: int,
+    ):
+        """Initialize scheduler.
+
+        Args:
+            min_interval: Interval after round, which extracted some documents.
+            max_interval: Upper bound of interval after empty rounds.
+            backoff_factor: Factor of interval after each empty round.
+            busy_documents: Number of documents extracted by round, after
+                which next round starts immediately.
+        """
+        self._min_interval = min_interval
+        self._max_interval = max(max_interval, min_interval)
+        self._backoff_factor = backoff_factor
+        self._busy_documents = busy_documents
+        self._interval = 0.0
+
+    @property
+    def interval(self) -> float:
+        """Current delay before next round."""
+        return self._interval
+
+    def get_delay(self, extracted: float) -> float:
+        """Return delay before next round.
+
+        Args:
+            extracted: Number of documents extracted by previous round.
+
+        Returns:
+            Delay in seconds.
+        """
+        if extracted >= self._busy_documents:
+            self._interval = 0
+        elif extracted:
+            self._interval = self._min_interval
+        else:
+            self._interval = min(
+                max(self._interval * self._backoff_factor, self._min_interval),
+                self._max_interval,
+            )
+        return self._interval
+
+
+class OverloadDetector:
+    """Detector of overload of Elasticsearch by health and thread pool stats."""
+
+    def __init__(self):
+        """Initialize detector."""
+        # rejected requests of write thread pool by node on previous check
+        self._rejected: dict[str, int] | None = None
+
+    def is_overloaded(self, client: Elasticsearch) -> bool:
+        """Check whether Elasticsearch is overloaded.
+
+        Unavailable statistics, e.g. because of missing privileges or connection
+        errors, are logged and don't count as overload, errors of connection are
+        handled by ETL round itself.
+
+        Args:
+            client: Elasticsearch client.
+
+        Returns:
+            True if health of indices of ETL is red or write thread pool of any
+            node rejected requests since previous check.
+        """
+        try:
+            # red indices unrelated to ETL don't affect loading
+            health = client.cluster.health(
+                index=list(postgres_to_es.extractor.get_index_entities()),
+            )
+            pools = client.cat.thread_pool(
+                thread_pool_patterns="write",
+                format="json",
+                h="node_id,rejected",
+            )
+        except (ApiError, elastic_transport.TransportError) as error:
+            logger.warning("Couldn't check load of elasticsearch: %s", error)
+            return False
+
+        rejected = {pool["node_id"]: int(pool["rejected"]) for pool in pools}
+        previous, self._rejected = self._rejected, rejected
+        if health["status"] == "red":
+            logger.warning("Health of elasticsearch indices is red")
+            return True
+        if previous is not None and any(
+            count > previous.get(node, count) for node, count in rejected.items()
+        ):
+            logger.warning("Elasticsearch write thread pool rejects requests")
+            return True
+        return False
+
+
+def pause_if_overloaded(detector: OverloadDetector) -> bool:
+    """Pause ETL for APP_CONFIG.overload_pause seconds if ES is overloaded.
+
+    Args:
+        detector: Detector of overload, which keeps stats of previous check.
+
+    Returns:
+        Whether ETL was paused.
+    """
+    if not APP_CONFIG.pause_on_overload or not detector.is_overloaded(
+        postgres_to_es.utils.get_shared_elasticsearch_client(),
+    ):
+        return False
+    postgres_to_es.metrics.OVERLOAD_PAUSES.inc()
+    logger.info("Pause ETL for %s seconds", APP_CONFIG.overload_pause)
+    time.sleep(APP_CONFIG.overload_pause)
+    return True
+
+
+def run(
+    state: postgres_to_es.state_.State,
+    etl: Callable[[postgres_to_es.state_.State], None],
+) -> None:
+    """Run ETL rounds forever with adaptive intervals.
+
+    Args:
+        state: Persistent state storage.
+        etl: Function running ETL round.
+    """
+    scheduler = Scheduler(
+        min_interval=APP_CONFIG.etl_interval,
+        max_interval=APP_CONFIG.etl_max_interval,
+        backoff_factor=APP_CONFIG.etl_backoff_factor,
+        busy_documents=APP_CONFIG.chunk_size,
+    )
+    postgres_to_es.metrics.ROUND_DELAY.set_function(lambda: scheduler.interval)
+    detector = OverloadDetector()
+    while True:
+        if pause_if_overloaded(detector):
+            continue
+
+        logger.debug("Start ETL round")
+        extracted_before = postgres_to_es.metrics.EXTRACTED_DOCUMENTS.total()
+        etl(state)
+        extracted = (
+            postgres_to_es.metrics.EXTRACTED_DOCUMENTS.total() - extracted_before
+        )
+
+        delay = scheduler.get_delay(extracted)
+        logger.debug(
+            "Extracted %s documents, next round in %s seconds",
+            extracted,
+            delay,
+        )
+        time.sleep(delay)
@@ -1,19 +1,139 @@
 from pathlib import Path
-from typing import Callable, Generator, TypedDict
+from typing import Any, Callable, Generator, Literal, TypedDict
 
 import backoff
 import elastic_transport
+import psycopg
 import psycopg2
-from pydantic import BaseSettings, Field
+from pydantic import BaseSettings, Field, validator
+
+import postgres_to_es.metrics
 
 
 class AppConfig(BaseSettings):
     debug: bool
     chunk_size: int
+    # "modified" detects changes by modified columns, "outbox" reads changes
+    # recorded by triggers into outbox table, including changes of link tables
+    change_source: Literal["modified", "outbox"] = "modified"
+    # split outbox into lease_shards shards leased by several ETL workers, so
+    # they share changes, disabled if not set; requires "outbox" change source
+    # and external versioning, as workers could load the same documents, lease
+    # expires if worker doesn't renew it in lease_ttl seconds
+    lease_shards: int | None = Field(None, ge=1)
+    lease_ttl: float = 30
+    # triggers record changes into outbox whatever change source, so with
+    # "modified" change source records older than outbox_retention seconds are
+    # deleted by ETL, at most once per outbox_purge_interval seconds
+    outbox_retention: float = 24 * 60 * 60
+    outbox_purge_interval: float = 60 * 60
+    # stream large result sets through server-side cursor, fetching itersize
+    # rows per round trip instead of loading whole result into memory
+    stream_results: bool = False
+    postgres_itersize: int = 2000
+    # build documents as json in PostgreSQL and pass them to Elasticsearch
+    # without pydantic models, only validation_sample_rate of them is validated
+    raw_documents: bool = False
+    validation_sample_rate: float = Field(0, ge=0, le=1)
+    # update only fields of persons in documents of film_works affected only
+    # by renamed persons instead of loading whole documents
+    person_partial_updates: bool = False
+    # index and delete documents with external version, so documents read
+    # from older snapshot never overwrite newer ones, e.g. loaded by other
+    # worker; partial updates can't be versioned
+    external_versioning: bool = False
+    # load changes notified by PostgreSQL triggers in near real-time,
+    # etl_interval is interval of polling rounds then
+    listen_notifications: bool = False
+    notify_debounce: float = 0.5
+    notify_max_delay: float = 5
+    # "sync" runs stages one after another, "pipeline" runs them concurrently
+    # in threads, "async" runs them concurrently in event loop
+    etl_engine: Literal["sync", "pipeline", "async"] = "sync"
+    # maximum number of chunks waiting for loading
+    pipeline_queue_size: int = 4
+    # number of loader threads of pipeline engine or maximum number of bulk
+    # requests in flight of async engine; chunks of one round may contain
+    # the same documents, so loading of several chunks at once requires
+    # external versioning, without it async engine loads chunks one by one
+    loader_workers: int = Field(2, ge=1)
     etl_interval: int = Field(..., env="ETL_RUNS_INTERVAL")
+    # polling rounds: next round starts immediately after round which loaded
+    # at least chunk_size documents, interval is multiplied by
+    # etl_backoff_factor after each empty round up to etl_max_interval
+    etl_max_interval: float = 60
+    etl_backoff_factor: float = 2
+    # skip polling rounds for overload_pause seconds while cluster health is red
+    # or write thread pool of Elasticsearch rejects requests
+    pause_on_overload: bool = True
+    overload_pause: float = 30
+    # port of HTTP endpoint with Prometheus metrics, disabled if not set
+    metrics_port: int | None = None
     backoff_interval: float = Field(..., env="BACKOFF_MAX_RETRY_INTERVAL")
     es_index_name = "movies"
+    # maintain indices of persons and genres, they are updated in the same
+    # rounds as index of movies
+    persons_genres_indices: bool = True
+    es_persons_index_name = "persons"
+    es_genres_index_name = "genres"
+    # "json" file, "sqlite" database next to it or "postgres" table shared by
+    # several ETL processes
+    state_backend: Literal["json", "sqlite", "postgres"] = "json"
+    # checkpoints are written at most once per flush interval or after flush
+    # count changes, lost ones are reloaded after restart
+    state_flush_interval: float = 0
+    state_flush_count: int = Field(1, ge=1)
     json_storage_path = Path(__file__).resolve().parent / "storage" / "storage.json"
+    # number of processes loading film_works during full reindex
+    reindex_shards: int = Field(1, ge=1)
+    reindex_storage_path = (
+        Path(__file__).resolve().parent / "storage" / "reindex.json"
+    )
+    dead_letter_path = (
+        Path(__file__).resolve().parent / "storage" / "dead_letter.jsonl"
+    )
+    # skip documents whose source didn't change since last loading
+    suppress_unchanged: bool = False
+    digest_storage_path = (
+        Path(__file__).resolve().parent / "storage" / "digests.sqlite3"
+    )
+    # bulk requests are sized by bytes, target size is adjusted within bounds
+    # to keep requests faster than target latency
+    bulk_target_bytes: int = 5 * 1024 * 1024
+    bulk_min_bytes: int = 256 * 1024
+    bulk_max_bytes: int = 50 * 1024 * 1024
+    bulk_target_latency: float = 1
+    # retries of documents rejected with 429 Too Many Requests, with own backoff
+    bulk_max_retries: int = 5
+    bulk_initial_backoff: float = 1
+
+    @validator("lease_shards")
+    def check_lease_change_source(cls, value, values):  # noqa: N805
+        if value is not None and values.get("change_source") != "outbox":
+            raise ValueError("leasing of shards requires outbox change source")
+        return value
+
+    @validator("external_versioning")
+    def check_versioning_partial_updates(cls, value, values):  # noqa: N805
+        if value and values.get("person_partial_updates"):
+            raise ValueError("partial updates of persons can't be versioned")
+        return value
+
+    @validator("external_versioning")
+    def check_versioning_leases(cls, value, values):  # noqa: N805
+        if not value and values.get("lease_shards") is not None:
+            raise ValueError("leasing of shards requires external versioning")
+        return value
+
+    @validator("loader_workers")
+    def check_loader_workers_versioning(cls, value, values):  # noqa: N805
+        if (
+            value > 1
+            and values.get("etl_engine") != "sync"
+            and not values.get("external_versioning")
+        ):
+            raise ValueError("several loader workers require external versioning")
+        return value
 
 
 class PostgresDSN(BaseSettings):
@@ -36,14 +156,28 @@ class ElasticDSN(BaseSettings):
         env_prefix = "elasticsearch_"
 
 
+class ElasticClientConfig(BaseSettings):
+    # size of HTTP connection pool, should be not less than number of loaders
+    connections_per_node: int = 10
+    # compress bulk requests with gzip, saves network at cost of CPU
+    http_compress: bool = False
+    request_timeout: float = 30
+
+    class Config:
+        env_prefix = "elasticsearch_"
+
+
 POSTGRES_DSN = PostgresDSN()
 ELASTIC_DSN = ElasticDSN()
+ELASTIC_CLIENT_CONFIG = ElasticClientConfig()
 APP_CONFIG = AppConfig()
 
 backoff_exceptions = (
     elastic_transport.ConnectionError,
     psycopg2.OperationalError,
     psycopg2.InterfaceError,
+    psycopg.OperationalError,
+    psycopg.InterfaceError,
 )
 
 # backoff configured to wait indefinitely with at most max_value seconds between retries
@@ -60,6 +194,7 @@ class BackoffParameters(TypedDict):
     exception: tuple[type[Exception], ...]
     logger: str
     max_value: float
+    on_backoff: list[Callable[[dict[str, Any]], None]]
 
 
 BACKOFF_CONFIG: BackoffParameters = {
@@ -67,4 +202,15 @@ BACKOFF_CONFIG: BackoffParameters = {
     "exception": backoff_exceptions,
     "logger": "backoff",
     "max_value": APP_CONFIG.backoff_interval,
+    "on_backoff": [postgres_to_es.metrics.count_backoff_retry],
 }
+
+
+def get_backoff_config(
+    *handlers: Callable[[dict[str, Any]], None],
+) -> BackoffParameters:
+    """Return BACKOFF_CONFIG with additional handlers called on each retry."""
+    return {
+        **BACKOFF_CONFIG,
+        "on_backoff": [*BACKOFF_CONFIG["on_backoff"], *handlers],
+    }
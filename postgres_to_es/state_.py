@@ -1,13 +1,43 @@
 import json
 import logging
+import os
+import sqlite3
+import tempfile
+import time
 from pathlib import Path
-from typing import Any
+from typing import Any, Protocol
+
+import backoff
+from psycopg2.extensions import connection
+
+import postgres_to_es.utils
+from postgres_to_es.settings import APP_CONFIG, get_backoff_config
 
 logger = logging.getLogger(__name__)
 
 
+class Storage(Protocol):
+    """Backend of State.
+
+    save_state() saves given values and keeps values of other keys, so several
+    processes could share backend, if they use different keys.
+    """
+
+    def save_state(self, state: dict) -> None:
+        """Save values of keys in state."""
+
+    def retrieve_state(self) -> dict:
+        """Load all values."""
+
+    def clear(self) -> None:
+        """Remove all values."""
+
+
 class JsonFileStorage:
-    """File storage that saves and loads data in json format."""
+    """File storage that saves and loads data in json format.
+
+    File is replaced atomically, so it is never left partially written.
+    """
 
     def __init__(self, file_path: Path):
         """Initialize storage at file path.
@@ -17,20 +47,16 @@ class JsonFileStorage:
         self._file_path = file_path
         if not self._file_path.is_file():
             self._file_path.parent.mkdir(parents=True, exist_ok=True)
-            self._file_path.touch()
-            self.save_state({})
+            self._write({})
 
     def save_state(self, state: dict) -> None:
         """Save state in json."""
-        with self._file_path.open("w") as file:
-            try:
-                json.dump(state, file)
-            except TypeError:
-                logger.exception("Some state values isn't JSON serializable")
-                raise
+        self._write({**self.retrieve_state(), **state})
 
     def retrieve_state(self) -> dict:
         """Load state from json."""
+        if not self._file_path.is_file():
+            return {}
         with self._file_path.open("r") as file:
             try:
                 return json.load(file)
@@ -38,27 +64,214 @@ class JsonFileStorage:
                 logger.exception("Invalid saved state in file %s", self._file_path)
                 raise
 
+    def clear(self) -> None:
+        """Remove file of storage."""
+        self._file_path.unlink(missing_ok=True)
+
+    def _write(self, state: dict) -> None:
+        """Write state into temporary file and rename it over storage file."""
+        try:
+            data = json.dumps(state)
+        except TypeError:
+            logger.exception("Some state values isn't JSON serializable")
+            raise
+
+        directory = self._file_path.parent
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=self._file_path.name)
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self._file_path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        # make rename itself durable
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class SQLiteStorage:
+    """SQLite storage of json serialized values by key."""
+
+    def __init__(self, file_path: Path):
+        """Initialize storage at file path. File is created on first access."""
+        self._file_path = file_path
+        self._conn: sqlite3.Connection | None = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._file_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self._file_path, check_same_thread=False)
+            # FULL synchronous fsyncs on every commit
+            self._conn.execute("PRAGMA synchronous = FULL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID",
+            )
+        return self._conn
+
+    def save_state(self, state: dict) -> None:
+        """Save values in single transaction."""
+        conn = self._get_connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in state.items()],
+            )
+
+    def retrieve_state(self) -> dict:
+        """Load all values."""
+        rows = self._get_connection().execute("SELECT key, value FROM state")
+        return {key: json.loads(value) for key, value in rows.fetchall()}
+
+    def clear(self) -> None:
+        """Remove file of storage."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._file_path.unlink(missing_ok=True)
+
+
+def _reset_connection(details: dict[str, Any]) -> None:
+    """Close connection of storage, whose method is retried by backoff."""
+    details["args"][0].reset_connection()
+
+
+class PostgresStorage:
+    """Storage in PostgreSQL table shared by all ETL processes.
+
+    Values of each state are stored under own namespace.
+    """
+
+    def __init__(self, namespace: str):
+        """Initialize storage of namespace. Table is created on first access."""
+        self._namespace = namespace
+        self._conn: connection | None = None
+
+    def _get_connection(self) -> connection:
+        if self._conn is None or self._conn.closed:
+            self._conn = postgres_to_es.utils.get_postgres_connection()
+            with self._conn.cursor() as cursor:
+                cursor.execute(postgres_to_es.utils.get_state_table_query())
+        return self._conn
+
+    def reset_connection(self) -> None:
+        """Close connection, new one is opened on next access."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @backoff.on_exception(**get_backoff_config(_reset_connection))
+    def save_state(self, state: dict) -> None:
+        """Save values in single statement."""
+        if not state:
+            return
+        with self._get_connection().cursor() as cursor:
+            cursor.execute(
+                postgres_to_es.utils.get_state_save_query(),
+                (
+                    self._namespace,
+                    list(state),
+                    [json.dumps(value) for value in state.values()],
+                ),
+            )
+
+    @backoff.on_exception(**get_backoff_config(_reset_connection))
+    def retrieve_state(self) -> dict:
+        """Load all values."""
+        with self._get_connection().cursor() as cursor:
+            cursor.execute(
+                "SELECT key, value FROM etl_state WHERE namespace = %s",
+                (self._namespace,),
+            )
+            return {row["key"]: row["value"] for row in cursor.fetchall()}
+
+    @backoff.on_exception(**get_backoff_config(_reset_connection))
+    def clear(self) -> None:
+        """Remove all values of namespace."""
+        with self._get_connection().cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM etl_state WHERE namespace = %s",
+                (self._namespace,),
+            )
+
 
 class State:
     """Persistent state for storing serializable values.
 
-    Uses json internally.
+    Writes to storage are coalesced: changed values are saved at most once per
+    flush_interval seconds or after flush_count changes, whichever comes first.
+    Values changed since the last write are lost on crash, so they must be safe
+    to recompute, e.g. checkpoints of idempotent loading.
     """
 
-    def __init__(self, storage: JsonFileStorage):
+    def __init__(
+        self,
+        storage: Storage,
+        flush_interval: float = APP_CONFIG.state_flush_interval,
+        flush_count: int = APP_CONFIG.state_flush_count,
+    ):
         """Load state from storage on initialization."""
         self._storage = storage
+        self._flush_interval = flush_interval
+        self._flush_count = flush_count
         self._state = self._load_state()
+        self._pending: dict[str, Any] = {}
+        self._changes = 0
+        self._flushed_at = time.monotonic()
 
     def set_value(self, key: str, value: Any) -> None:
         """Set value for key."""
         self._state[key] = value
-        self._storage.save_state(self._state)
+        self._pending[key] = value
+        self._changes += 1
+        if (
+            self._changes >= self._flush_count
+            or time.monotonic() - self._flushed_at >= self._flush_interval
+        ):
+            self.flush()
 
     def get_value(self, key: str) -> Any:
         """Get value by key."""
         return self._state.get(key)
 
+    def flush(self) -> None:
+        """Save values changed since the last write to storage."""
+        if self._pending:
+            self._storage.save_state(self._pending)
+            self._pending = {}
+        self._changes = 0
+        self._flushed_at = time.monotonic()
+
+    def clear(self) -> None:
+        """Remove all values from state and storage."""
+        self._state = {}
+        self._pending = {}
+        self._storage.clear()
+
     def _load_state(self) -> dict:
         """Load state from storage."""
         return self._storage.retrieve_state()
+
+
+def get_storage(file_path: Path) -> Storage:
+    """Return storage of backend selected in settings.
+
+    Args:
+        file_path: Path of json file. SQLite database is stored next to it with
+            .sqlite3 suffix, in PostgreSQL stem of file name is used as
+            namespace.
+
+    Returns:
+        Storage instance.
+    """
+    if APP_CONFIG.state_backend == "sqlite":
+        return SQLiteStorage(file_path.with_suffix(".sqlite3"))
+    if APP_CONFIG.state_backend == "postgres":
+        return PostgresStorage(file_path.stem)
+    return JsonFileStorage(file_path)
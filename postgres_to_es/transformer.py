@@ -1,33 +1,130 @@
-import datetime
 from typing import Any, Iterator
 
+import postgres_to_es.extractor
+import postgres_to_es.metrics
 import postgres_to_es.models
 from postgres_to_es.settings import APP_CONFIG
 
-ESActions = Iterator[dict[str, Any]]
+ESActions = list[dict[str, Any]]
+
+
+Model = (
+    postgres_to_es.models.MovieDocument
+    | postgres_to_es.models.RawMovieDocument
+    | postgres_to_es.models.MoviePersons
+    | postgres_to_es.models.PersonDocument
+    | postgres_to_es.models.GenreDocument
+    | postgres_to_es.models.DeletedDocument
+)
+
+
+def _get_source(
+    model: postgres_to_es.models.MovieDocument
+    | postgres_to_es.models.RawMovieDocument
+    | postgres_to_es.models.PersonDocument
+    | postgres_to_es.models.GenreDocument,
+) -> dict[str, Any] | str:
+    if isinstance(model, postgres_to_es.models.RawMovieDocument):
+        return model.source
+    return model.dict(exclude={"modified", "version"})
+
+
+def _get_index_name(model: Model, index_name: str) -> str:
+    """Return index of document, index_name is index of movies."""
+    if isinstance(model, postgres_to_es.models.DeletedDocument):
+        entity = model.entity
+    elif isinstance(model, postgres_to_es.models.PersonDocument):
+        entity = "person"
+    elif isinstance(model, postgres_to_es.models.GenreDocument):
+        entity = "genre"
+    else:
+        entity = "film_work"
+    return {
+        "film_work": index_name,
+        "person": APP_CONFIG.es_persons_index_name,
+        "genre": APP_CONFIG.es_genres_index_name,
+    }[entity]
+
+
+def _get_version(model: Model) -> dict[str, Any]:
+    """Return external version of action, if external versioning is enabled.
+
+    Elasticsearch rejects action with version lower than version of stored
+    document with 409 Conflict, so document read from older snapshot never
+    overwrites newer one, whatever order of loading.
+    """
+    if not APP_CONFIG.external_versioning or getattr(model, "version", None) is None:
+        return {}
+    return {"_version": model.version, "_version_type": "external_gte"}
+
+
+def _get_action(model: Model, index_name: str) -> dict[str, Any]:
+    index_name = _get_index_name(model, index_name)
+    if isinstance(model, postgres_to_es.models.DeletedDocument):
+        return {
+            "_op_type": "delete",
+            "_index": index_name,
+            "_id": model.id,
+            **_get_version(model),
+        }
+    if isinstance(model, postgres_to_es.models.MoviePersons):
+        # partial document must stay dict, see helpers.expand_action()
+        return {
+            "_op_type": "update",
+            "_index": index_name,
+            "_id": model.id,
+            "doc": model.dict(exclude={"id"}),
+        }
+    return {
+        "_index": index_name,
+        "_id": model.id,
+        "_source": _get_source(model),
+        **_get_version(model),
+    }
+
+
+def transform_chunk(
+    models: postgres_to_es.extractor.ModelsChunk,
+    index_name: str = APP_CONFIG.es_index_name,
+) -> ESActions:
+    """Transform chunk of pydantic models into elasticsearch documents.
+
+    Args:
+        models: A tuple of models to transform.
+        index_name: Name of index or alias to load documents of movies into.
+
+    Returns:
+        A list of elasticsearch documents.
+    """
+    postgres_to_es.metrics.EXTRACTED_DOCUMENTS.inc(len(models))
+    with postgres_to_es.metrics.TRANSFORM_SECONDS.time():
+        return [_get_action(model, index_name) for model in models]
 
 
 def transform(
-    models_generator: Iterator[tuple[postgres_to_es.models.MovieDocument, ...]],
-) -> Iterator[tuple[ESActions, datetime.datetime]]:
+    models_generator: Iterator[
+        tuple[
+            postgres_to_es.extractor.ModelsChunk,
+            postgres_to_es.extractor.Checkpoint,
+        ]
+    ],
+    index_name: str = APP_CONFIG.es_index_name,
+) -> Iterator[tuple[ESActions, postgres_to_es.extractor.Checkpoint]]:
     """Transform pydantic models into elasticsearch documents.
 
+    Raw documents are already serialized, so their source is passed as is.
+    Deleted documents are transformed into delete actions, fields of persons
+    of movies into partial update actions. Documents of persons and genres are
+    loaded into their own indices.
+
     Args:
         models_generator: An iterator of tuples, containing pydantic models
-            to transform.
+            to transform and checkpoints.
+        index_name: Name of index or alias to load documents of movies into.
 
     Yields:
-        Tuple consisting of generator of elasticsearch documents and datetime
-        of modification of last document in that generator.
+        Tuple consisting of list of elasticsearch documents and checkpoints
+        to save in case of successful loading of these documents.
     """
-    for models_tuple in models_generator:
-        last_modified = models_tuple[-1].modified
-        actions = (
-            {
-                "_index": APP_CONFIG.es_index_name,
-                "_id": model.id,
-                "_source": model.dict(exclude={"modified"}),
-            }
-            for model in models_tuple
-        )
-        yield actions, last_modified
+    for models_tuple, checkpoint in models_generator:
+        yield transform_chunk(models_tuple, index_name), checkpoint
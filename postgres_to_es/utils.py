@@ -1,20 +1,37 @@
 import http
+import itertools
 import json
 import logging
-from contextlib import closing
+import threading
+import uuid
+from contextlib import asynccontextmanager, closing, contextmanager
 from pathlib import Path
-from typing import Any
+from typing import Any, AsyncIterator, Iterable, Iterator
 
 import backoff
+import psycopg
 import psycopg2
-from elasticsearch import Elasticsearch
-from psycopg2.extensions import connection
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+from psycopg.rows import dict_row
+from psycopg.types.string import TextLoader
+from psycopg2.extensions import connection, cursor
 from psycopg2.extras import DictCursor
 
-from postgres_to_es.settings import BACKOFF_CONFIG, ELASTIC_DSN, POSTGRES_DSN
+from postgres_to_es.settings import (
+    APP_CONFIG,
+    BACKOFF_CONFIG,
+    ELASTIC_CLIENT_CONFIG,
+    ELASTIC_DSN,
+    POSTGRES_DSN,
+)
 
 logger = logging.getLogger(__name__)
 
+_shared_client: Elasticsearch | None = None
+_shared_client_lock = threading.Lock()
+# asynchronous client is used only by event loop of asyncio ETL round
+_shared_async_client: AsyncElasticsearch | None = None
+
 
 @backoff.on_exception(**BACKOFF_CONFIG)
 def get_postgres_connection() -> connection:
@@ -30,6 +47,105 @@ def get_postgres_connection() -> connection:
     return conn
 
 
+@contextmanager
+def open_cursor(conn: connection, name: str) -> Iterator[cursor]:
+    """Open cursor for reading possibly large result set.
+
+    If streaming is enabled in settings, opens named (server-side) cursor, which
+    fetches APP_CONFIG.postgres_itersize rows per round trip on iteration. Named
+    cursor lives only inside transaction, so autocommit is turned off while
+    cursor is open. Cursor is meant for reading, so transaction is rolled back
+    on exit.
+
+    Args:
+        conn: PostgreSQL connection.
+        name: Name of server-side cursor, unique within connection.
+
+    Yields:
+        Client-side or server-side cursor.
+    """
+    if not APP_CONFIG.stream_results:
+        with conn.cursor() as client_cursor:
+            yield client_cursor
+        return
+
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor(name=name) as server_cursor:
+            server_cursor.itersize = APP_CONFIG.postgres_itersize
+            yield server_cursor
+    finally:
+        if not conn.closed:
+            conn.rollback()
+            conn.autocommit = autocommit
+
+
+@backoff.on_exception(**BACKOFF_CONFIG)
+async def get_async_postgres_connection() -> psycopg.AsyncConnection:
+    """Return asynchronous PostgreSQL connection.
+
+    Rows are returned as dicts and uuids as strings, the same way as by
+    connection from get_postgres_connection(). Uses backoff to wait until
+    PostgreSQL is up.
+
+    Returns:
+        Asynchronous PostgeSQL connection.
+    """
+    conn = await psycopg.AsyncConnection.connect(
+        **POSTGRES_DSN.dict(),
+        autocommit=True,
+        row_factory=dict_row,
+    )
+    conn.adapters.register_loader("uuid", TextLoader)
+    return conn
+
+
+@asynccontextmanager
+async def open_async_cursor(
+    conn: psycopg.AsyncConnection,
+    name: str,
+) -> AsyncIterator[psycopg.AsyncCursor | psycopg.AsyncServerCursor]:
+    """Open asynchronous cursor for reading possibly large result set.
+
+    The same as open_cursor(), but for asynchronous connection.
+
+    Args:
+        conn: Asynchronous PostgreSQL connection.
+        name: Name of server-side cursor, unique within connection.
+
+    Yields:
+        Client-side or server-side cursor.
+    """
+    if not APP_CONFIG.stream_results:
+        async with conn.cursor() as client_cursor:
+            yield client_cursor
+        return
+
+    async with conn.transaction(force_rollback=True):
+        async with conn.cursor(name=name) as server_cursor:
+            server_cursor.itersize = APP_CONFIG.postgres_itersize
+            yield server_cursor
+
+
+def iter_chunks(rows: Iterable[Any], size: int) -> Iterator[list[Any]]:
+    """Split rows into lists of at most size elements.
+
+    Iterates rows lazily, so with server-side cursor at most size plus itersize
+    rows are held in memory.
+
+    Args:
+        rows: An iterable to split, e.g. cursor.
+        size: Maximum size of chunk.
+
+    Yields:
+        Lists of rows.
+    """
+    rows_iterator = iter(rows)
+    while chunk := list(itertools.islice(rows_iterator, size)):
+        yield chunk
+
+
 @backoff.on_exception(**BACKOFF_CONFIG)
 def get_elasticsearch_client() -> Elasticsearch:
     """Return Elasticsearch client.
@@ -46,6 +162,80 @@ def get_elasticsearch_client() -> Elasticsearch:
     return es
 
 
+def get_shared_elasticsearch_client() -> Elasticsearch:
+    """Return process-wide Elasticsearch client.
+
+    Client is created on first call and then reused, so connections in its pool
+    are kept alive between requests. Client is thread-safe. Unlike
+    get_elasticsearch_client() it doesn't check availability of Elasticsearch,
+    errors are raised on actual requests.
+
+    Returns:
+        Elasticsearch client.
+    """
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = Elasticsearch(
+                f"http://{ELASTIC_DSN.host}:{ELASTIC_DSN.port}",
+                **ELASTIC_CLIENT_CONFIG.dict(),
+            )
+        return _shared_client
+
+
+def get_shared_async_elasticsearch_client() -> AsyncElasticsearch:
+    """Return asynchronous Elasticsearch client shared by coroutines.
+
+    Client is created on first call and then reused the same as by
+    get_shared_elasticsearch_client(). Client is bound to running event loop,
+    so it should be reset by reset_shared_async_elasticsearch_client() before
+    the loop is closed.
+
+    Returns:
+        Asynchronous Elasticsearch client.
+    """
+    global _shared_async_client
+    if _shared_async_client is None:
+        _shared_async_client = AsyncElasticsearch(
+            f"http://{ELASTIC_DSN.host}:{ELASTIC_DSN.port}",
+            **ELASTIC_CLIENT_CONFIG.dict(),
+        )
+    return _shared_async_client
+
+
+def reset_shared_elasticsearch_client(*args: Any) -> None:
+    """Close process-wide Elasticsearch client.
+
+    Next call of get_shared_elasticsearch_client() creates new client. Accepts
+    and ignores any arguments, so can be used as backoff handler.
+
+    Args:
+        args: Ignored.
+    """
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is not None:
+            _shared_client.close()
+            _shared_client = None
+
+
+async def reset_shared_async_elasticsearch_client(*args: Any) -> None:
+    """Close asynchronous Elasticsearch client shared by coroutines.
+
+    Next call of get_shared_async_elasticsearch_client() creates new client.
+    Client is detached before closing, so concurrent coroutines don't get
+    closed one. Can be used as backoff handler, see
+    reset_shared_elasticsearch_client().
+
+    Args:
+        args: Ignored.
+    """
+    global _shared_async_client
+    client, _shared_async_client = _shared_async_client, None
+    if client is not None:
+        await client.close()
+
+
 def load_index_definition(file_path: Path) -> dict[str, Any]:
     """Load Elasticsearch index definition from json file.
 
@@ -66,61 +256,482 @@ def load_index_definition(file_path: Path) -> dict[str, Any]:
         raise
 
 
-@backoff.on_exception(**BACKOFF_CONFIG)
-def create_elasticsearch_index(index_name: str) -> None:
-    """Create Elasticsearch index.
+def get_index_definition(index_name: str) -> dict[str, Any]:
+    """Load definition of Elasticsearch index.
 
     Definition of index must be in json file in directory elasticsearch_indices.
     Name of index and name of file must be same.
 
     Args:
         index_name: Name of index.
+
+    Returns:
+        A dict containing Elasticsearch index definition.
     """
     path = (
         Path(__file__).resolve().parent / "elasticsearch_indices" / f"{index_name}.json"
     )
-    index_definition = load_index_definition(path)
+    return load_index_definition(path)
+
+
+def get_versioned_index_name(alias: str, version: int | str) -> str:
+    """Return name of concrete index of given version behind alias."""
+    return f"{alias}_v{version}"
+
+
+@backoff.on_exception(**BACKOFF_CONFIG)
+def create_elasticsearch_index(index_name: str) -> None:
+    """Create Elasticsearch index behind alias.
+
+    Index is created with version 1 and alias index_name, so it could be rebuilt
+    later without downtime, see reindex.py. Nothing is done if index or alias
+    with name index_name already exists.
+
+    Args:
+        index_name: Name of index, which is name of alias actually.
+    """
+    index_definition = get_index_definition(index_name)
 
     with closing(get_elasticsearch_client()) as es:
+        if es.indices.exists(index=index_name):
+            return
         es.options(ignore_status=http.HTTPStatus.BAD_REQUEST).indices.create(
-            index=index_name,
+            index=get_versioned_index_name(index_name, 1),
             settings=index_definition.get("settings"),
             mappings=index_definition.get("mappings"),
+            aliases={index_name: {}},
         )
 
 
-def get_query(timestamp: str) -> str:
-    """Return SQL query for extracting records.
+def get_modified_query(table: str) -> str:
+    """Return SQL query for extracting ids of records modified after keyset cursor.
+
+    Records are ordered by (modified, id), so records with same modified are
+    paginated without gaps and duplicates.
 
     Args:
-        timestamp: A timestamp to substitute into query.
+        table: Name of table with id and modified columns.
 
     Returns:
-        SQL query.
+        SQL query with three parameters - modified and id of last processed record
+        and maximum number of records to return.
     """
     return f"""
-SELECT
-    f.id,
-    f.rating AS imdb_rating,
-    ARRAY_AGG(DISTINCT g.name) AS genre,
-    f.title,
-    f.description,
-    ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'director') AS director,
-    ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'actor') AS actors_names,
-    ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'writer') AS writers_names,
+SELECT id, modified
+FROM {table}
+WHERE (modified, id) > (%s, %s)
+ORDER BY modified, id
+LIMIT %s
+    """
+
+
+def get_tombstone_query() -> str:
+    """Return SQL query for extracting ids of film_works deleted after keyset cursor.
+
+    Film_works created again with the same id are skipped. Time of deletion is
+    returned as modified, so tombstones are paginated like other tables.
+
+    Returns:
+        SQL query with three parameters - time of deletion and id of last
+        processed tombstone and maximum number of records to return.
+    """
+    return """
+SELECT t.id, t.deleted AS modified
+FROM film_work_tombstone t
+WHERE (t.deleted, t.id) > (%s, %s)
+    AND NOT EXISTS (SELECT 1 FROM film_work f WHERE f.id = t.id)
+ORDER BY t.deleted, t.id
+LIMIT %s
+    """
+
+
+def get_person_link_tombstone_query() -> str:
+    """Return SQL query for extracting ids of persons unlinked after keyset cursor.
+
+    Time of deletion of link is returned as modified, so tombstones are
+    paginated like other tables.
+
+    Returns:
+        SQL query with three parameters - time of deletion and person id of last
+        processed tombstone and maximum number of records to return.
+    """
+    return """
+SELECT t.person_id AS id, t.deleted AS modified
+FROM person_film_work_tombstone t
+WHERE (t.deleted, t.person_id) > (%s, %s)
+ORDER BY t.deleted, t.person_id
+LIMIT %s
+    """
+
+
+def get_deleted_query() -> str:
+    """Return SQL query for finding which of film_works are deleted.
+
+    Returns:
+        SQL query with one parameter - a list of film_work ids. Time of deletion
+        is null if film_work has no tombstone.
+    """
+    return f"""
+SELECT d.id, t.deleted, {VERSION_COLUMN}
+FROM unnest(%s::uuid[]) AS d (id)
+LEFT JOIN film_work_tombstone t ON t.id = d.id
+WHERE NOT EXISTS (SELECT 1 FROM film_work f WHERE f.id = d.id)
+    """
+
+
+def get_film_work_range_query() -> str:
+    """Return SQL query for paginating film_work ids in range.
+
+    Returns:
+        SQL query with three parameters - lower bound of ids (exclusive), upper
+        bound of ids (inclusive) and maximum number of ids to return.
+    """
+    return """
+SELECT id
+FROM film_work
+WHERE id > %s AND id <= %s
+ORDER BY id
+LIMIT %s
+    """
+
+
+def get_shard_bounds(shard: int, shards: int) -> tuple[str, str]:
+    """Return bounds of range of uuids for shard.
+
+    Space of uuids is split into ranges of equal size.
+
+    Args:
+        shard: Number of shard, starting from 0.
+        shards: Total number of shards.
+
+    Returns:
+        Lower (exclusive) and upper (inclusive) bounds of range.
+    """
+    space = 2**128
+    lower = uuid.UUID(int=space * shard // shards - (1 if shard else 0))
+    upper = uuid.UUID(int=space * (shard + 1) // shards - 1)
+    return str(lower), str(upper)
+
+
+def get_outbox_query(sharded: bool = False) -> str:
+    """Return SQL query for reading changes from outbox in order of recording.
+
+    Args:
+        sharded: Whether to read only records of given shards, see
+            get_outbox_shard_query().
+
+    Returns:
+        SQL query with parameters - id of last read record, total number of
+        shards and a list of shards if sharded, and maximum number of records
+        to return.
+    """
+    shard_filter = f"AND {get_outbox_shard_query()} = ANY(%s)" if sharded else ""
+    return f"""
+SELECT id, entity, entity_id
+FROM search_outbox
+WHERE id > %s {shard_filter}
+ORDER BY id
+LIMIT %s
+    """
+
+
+def get_outbox_shard_query() -> str:
+    """Return SQL expression of shard of outbox record.
+
+    Shard is defined by hash of id of changed entity, so changes of film_work
+    and its links fall into the same shard, but changes of person or genre
+    affect film_works of other shards. Worker also keeps reading shards until
+    next round, even if its lease expired meanwhile. So several workers could
+    load the same document from different snapshots concurrently, external
+    versioning makes the newest one win, see settings.
+
+    Returns:
+        SQL expression with one parameter - total number of shards.
+    """
+    # hashtext() could be negative, sign bit is cleared instead of abs(),
+    # which overflows on the minimal integer
+    return "mod(hashtext(entity_id::text) & 2147483647, %s)"
+
+
+def get_outbox_ack_query() -> str:
+    """Return SQL query for deleting processed records from outbox.
+
+    Returns:
+        SQL query with one parameter - a list of ids of processed records.
+    """
+    return "DELETE FROM search_outbox WHERE id = ANY(%s)"
+
+
+def get_outbox_purge_query() -> str:
+    """Return SQL query for deleting outdated records from outbox.
+
+    Returns:
+        SQL query with one parameter - age of records to delete in seconds.
+    """
+    return """
+DELETE FROM search_outbox WHERE created < now() - %s * interval '1 second'
+    """
+
+
+def get_film_work_ids_query() -> str:
+    """Return SQL query for mapping changed records to affected film_work ids.
+
+    Query takes named parameters film_work, person and genre, each is a list of
+    changed ids of corresponding table. Duplicates are removed by UNION.
+
+    Returns:
+        SQL query.
+    """
+    return """
+SELECT id FROM film_work WHERE id = ANY(%(film_work)s::uuid[])
+UNION
+SELECT film_work_id FROM person_film_work WHERE person_id = ANY(%(person)s::uuid[])
+UNION
+SELECT film_work_id FROM genre_film_work WHERE genre_id = ANY(%(genre)s::uuid[])
+    """
+
+
+# version of document for external versioning - start of query in microseconds,
+# so documents read later from newer snapshot have greater version, see
+# transformer._get_version(). Start of transaction, i.e. now(), doesn't fit, as
+# queries of chunks of streamed rounds run in one transaction, but under READ
+# COMMITTED each of them reads own snapshot.
+VERSION_COLUMN = (
+    "(extract(epoch FROM statement_timestamp()) * 1000000)::bigint AS version"
+)
+
+# fields of movie document, which depend on persons only
+PERSON_COLUMNS = """
+    COALESCE(
+        ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'director'), '{}'
+    ) AS director,
+    COALESCE(
+        ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'actor'), '{}'
+    ) AS actors_names,
+    COALESCE(
+        ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'writer'), '{}'
+    ) AS writers_names,
     ARRAY_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name))
         FILTER (WHERE pfw.role = 'actor') AS actors,
     ARRAY_AGG(DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name))
-        FILTER (WHERE pfw.role = 'writer') AS writers,
-    GREATEST(f.modified, MAX(p.modified), MAX(g.modified)) AS modified
+        FILTER (WHERE pfw.role = 'writer') AS writers
+""".strip()
+
+
+def get_query() -> str:
+    """Return SQL query for extracting documents of film_works.
+
+    Documents are built and kept up to date by triggers in table
+    film_work_document, see movies_database.ddl, so each document is read as
+    single row instead of aggregation of genres and persons.
+
+    Query takes one parameter - a list of film_work ids to extract.
+
+    Returns:
+        SQL query.
+    """
+    return f"""
+SELECT d.id, d.document, d.modified, {VERSION_COLUMN}
+FROM film_work_document AS d
+WHERE d.id = ANY(%s::uuid[])
+    """
+
+
+def get_person_film_work_ids_query() -> str:
+    """Return SQL query for finding film_works affected only by changed persons.
+
+    Query takes the same named parameters as get_film_work_ids_query(). Film_works
+    affected by changed film_works or genres are excluded.
+
+    Returns:
+        SQL query.
+    """
+    return """
+SELECT DISTINCT pfw.film_work_id AS id
+FROM person_film_work AS pfw
+WHERE
+    pfw.person_id = ANY(%(person)s::uuid[])
+    AND pfw.film_work_id <> ALL(%(film_work)s::uuid[])
+    AND NOT EXISTS (
+        SELECT 1
+        FROM genre_film_work AS gfw
+        WHERE
+            gfw.film_work_id = pfw.film_work_id
+            AND gfw.genre_id = ANY(%(genre)s::uuid[])
+    )
+    """
+
+
+def get_movie_persons_query() -> str:
+    """Return SQL query for extracting fields of movies, which depend on persons.
+
+    Fields are the same as in documents of get_query(), but genres are not
+    joined.
+
+    Returns:
+        SQL query with one parameter - a list of film_work ids.
+    """
+    return f"""
+SELECT
+    f.id,
+    {PERSON_COLUMNS}
 FROM
     film_work AS f
-    LEFT JOIN genre_film_work AS gfw ON f.id = gfw.film_work_id
-    LEFT JOIN genre AS g ON gfw.genre_id = g.id
     LEFT JOIN person_film_work AS pfw ON f.id = pfw.film_work_id
     LEFT JOIN person AS p ON pfw.person_id = p.id
 WHERE
-    GREATEST(f.modified, p.modified, g.modified) > '{timestamp}'
+    f.id = ANY(%s::uuid[])
 GROUP BY f.id
-ORDER BY modified ASC
     """
+
+
+def get_film_work_persons_query() -> str:
+    """Return SQL query for finding persons of film_works.
+
+    Returns:
+        SQL query with one parameter - a list of film_work ids.
+    """
+    return """
+SELECT DISTINCT person_id AS id
+FROM person_film_work
+WHERE film_work_id = ANY(%s::uuid[])
+    """
+
+
+def get_person_query() -> str:
+    """Return SQL query for extracting documents of persons.
+
+    Each person has a list of film_works with roles of person in them.
+
+    Returns:
+        SQL query with one parameter - a list of person ids.
+    """
+    return f"""
+SELECT
+    p.id,
+    p.full_name,
+    {VERSION_COLUMN},
+    COALESCE(
+        jsonb_agg(
+            jsonb_build_object('id', f.id, 'title', f.title, 'roles', r.roles)
+            ORDER BY f.title, f.id
+        ) FILTER (WHERE f.id IS NOT NULL),
+        '[]'
+    ) AS films
+FROM
+    person AS p
+    LEFT JOIN LATERAL (
+        SELECT pfw.film_work_id, ARRAY_AGG(DISTINCT pfw.role) AS roles
+        FROM person_film_work AS pfw
+        WHERE pfw.person_id = p.id
+        GROUP BY pfw.film_work_id
+    ) AS r ON TRUE
+    LEFT JOIN film_work AS f ON f.id = r.film_work_id
+WHERE
+    p.id = ANY(%s::uuid[])
+GROUP BY p.id
+    """
+
+
+def get_genre_query() -> str:
+    """Return SQL query for extracting documents of genres.
+
+    Returns:
+        SQL query with one parameter - a list of genre ids.
+    """
+    return f"""
+SELECT id, name, description, {VERSION_COLUMN}
+FROM genre
+WHERE id = ANY(%s::uuid[])
+    """
+
+
+def get_document_query() -> str:
+    """Return SQL query for extracting ready Elasticsearch documents.
+
+    Documents are the same as in get_query(), but returned as json text, so
+    they could be passed into bulk request as is.
+
+    Returns:
+        SQL query with the same parameter as get_query().
+    """
+    return f"""
+SELECT d.id, d.modified, d.version, d.document::text AS source
+FROM ({get_query()}) AS d
+    """
+
+
+def get_state_table_query() -> str:
+    """Return SQL query for creating table of ETL state, if it doesn't exist."""
+    return """
+CREATE TABLE IF NOT EXISTS etl_state (
+    namespace VARCHAR(255) NOT NULL,
+    key VARCHAR(255) NOT NULL,
+    value jsonb NOT NULL,
+    modified timestamp with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (namespace, key)
+)
+"""
+
+
+def get_lease_tables_query() -> str:
+    """Return SQL query for creating tables of leases of outbox shards.
+
+    Returns:
+        SQL query with one parameter - total number of shards, rows of missing
+        shards are inserted.
+    """
+    return """
+CREATE TABLE IF NOT EXISTS etl_worker (
+    worker VARCHAR(255) PRIMARY KEY,
+    expires timestamp with time zone NOT NULL
+);
+CREATE TABLE IF NOT EXISTS etl_lease (
+    shard integer PRIMARY KEY,
+    worker VARCHAR(255),
+    expires timestamp with time zone NOT NULL DEFAULT '-infinity'
+);
+INSERT INTO etl_lease (shard)
+SELECT generate_series(0, %s - 1)
+ON CONFLICT (shard) DO NOTHING;
+"""
+
+
+def get_lease_acquire_query() -> str:
+    """Return SQL query for leasing expired shards.
+
+    Shards leased concurrently by other workers are skipped.
+
+    Returns:
+        SQL query with named parameters - worker, ttl in seconds, total number
+        of shards and limit of number of shards to lease.
+    """
+    return """
+UPDATE etl_lease
+SET worker = %(worker)s, expires = now() + %(ttl)s * interval '1 second'
+WHERE shard IN (
+    SELECT shard
+    FROM etl_lease
+    WHERE shard < %(shards)s AND expires < now()
+    ORDER BY shard
+    LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING shard
+"""
+
+
+def get_state_save_query() -> str:
+    """Return SQL query for saving values of ETL state.
+
+    Returns:
+        SQL query with three parameters - namespace of state, a list of keys and
+        a list of json serialized values.
+    """
+    return """
+INSERT INTO etl_state (namespace, key, value, modified)
+SELECT %s, key, value::jsonb, now()
+FROM unnest(%s::text[], %s::text[]) AS s (key, value)
+ON CONFLICT (namespace, key)
+DO UPDATE SET value = EXCLUDED.value, modified = EXCLUDED.modified
+"""